@@ -0,0 +1,303 @@
+"""
+ Batched Monte Carlo spatial test for gridded forecasts.
+
+ csep.core.poisson_evaluations.spatial_test simulates one catalog at a time and draws new random numbers for every
+ forecast, although forecasts evaluated with the same seed and number of observed events use exactly the same random
+ numbers. The batch in this module draws the random numbers once, in chunks of simulations, and evaluates every
+ forecast on each chunk using vectorized operations. Memory use is bounded by the chunk size instead of the number of
+ simulations.
+
+ The simulations can be split into contiguous blocks that are evaluated by a pool of worker processes. The random
+ numbers of each block are taken from one of two seed streams:
+
+     legacy   the stream of numpy.random.seed(seed) followed by numpy.random.rand(n_obs) for each simulation, as used
+              by pyCSEP. Each worker skips ahead to the start of its block. The log-likelihoods are summed in the same
+              order as pyCSEP, so the results are identical to pyCSEP for any number of workers.
+     spawn    each block uses an independent child of numpy.random.SeedSequence(seed). The results are reproducible
+              for the same seed and number of workers, but differ from pyCSEP.
+
+ Typical usage:
+
+     batch = SpatialTestBatch(num_simulations=100000, seed=seed)
+     for fore in forecasts:
+         batch.add(fore, catalog)
+     results = batch.run(num_workers=4)
+"""
+# Python imports
+import multiprocessing
+import os
+
+# 3rd party imports
+import numpy as np
+import scipy.special
+
+# pycsep imports
+from csep.models import EvaluationResult
+from csep.utils.stats import poisson_joint_log_likelihood_ndarray
+
+
+# sources of the random numbers used to simulate catalogs
+SEED_STREAMS = ('legacy', 'spawn')
+
+
+def split_simulations(num_simulations, num_blocks):
+    """ Splits simulations into contiguous blocks of nearly equal size
+
+    Returns:
+        list: (start, stop) of each block
+    """
+    bounds = np.linspace(0, num_simulations, num_blocks + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+class SimulationBank:
+    """ Uniform random numbers used to simulate catalogs with a fixed number of events
+
+    The numbers are generated in chunks every time iter_chunks() is called, so the bank can be reused without keeping
+    all numbers in memory. The simulations are split into num_blocks blocks that can be generated independently.
+
+    Args:
+        num_simulations (int): number of simulated catalogs
+        num_events (int): number of events in each simulated catalog
+        seed (int): seed of the random number generator
+        chunk_size (int): number of simulated catalogs in each chunk
+        seed_stream (str): 'legacy' or 'spawn', see module docstring
+        num_blocks (int): number of blocks
+    """
+
+    def __init__(self, num_simulations, num_events, seed=None, chunk_size=10000, seed_stream='legacy', num_blocks=1):
+        if seed_stream not in SEED_STREAMS:
+            raise ValueError(f'seed_stream must be one of {SEED_STREAMS}, not {seed_stream!r}')
+        if seed is None:
+            # all blocks must be generated from the same seed
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.num_simulations = num_simulations
+        self.num_events = num_events
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.seed_stream = seed_stream
+        self.blocks = split_simulations(num_simulations, num_blocks)
+
+    def _iter_range(self, random_sample, start, stop):
+        for chunk_start in range(start, stop, self.chunk_size):
+            size = min(self.chunk_size, stop - chunk_start)
+            yield random_sample((size, self.num_events))
+
+    def iter_chunks(self, block=None):
+        """ Yields 2d arrays with shape (n, num_events) of uniform random numbers in [0, 1)
+
+        Args:
+            block (int): only yield the numbers of this block; yields all blocks in order if None
+        """
+        if self.seed_stream == 'legacy':
+            rng = np.random.RandomState(self.seed)
+            if block is None:
+                yield from self._iter_range(rng.random_sample, 0, self.num_simulations)
+                return
+            start, stop = self.blocks[block]
+            # skip the numbers of the preceding blocks in chunks
+            for _ in self._iter_range(rng.random_sample, 0, start):
+                pass
+            yield from self._iter_range(rng.random_sample, start, stop)
+        else:
+            children = np.random.SeedSequence(self.seed).spawn(len(self.blocks))
+            blocks = range(len(self.blocks)) if block is None else [block]
+            for b in blocks:
+                rng = np.random.default_rng(children[b])
+                yield from self._iter_range(rng.random, *self.blocks[b])
+
+
+def simulated_log_likelihoods(uniforms, sampling_weights, log_bin_expectations, expected_forecast_count):
+    """ Computes the joint log-likelihood of a chunk of simulated catalogs
+
+    Vectorized version of the simulation loop in csep.core.poisson_evaluations._poisson_likelihood_test. The sums over
+    occupied cells are computed for all simulations with the same number of occupied cells at once, which gives the
+    same floating point results as summing each simulation separately.
+
+    Args:
+        uniforms (numpy.ndarray): random numbers with shape (num_simulations, num_events)
+        sampling_weights (numpy.ndarray): normalized cumulative rates of the forecast
+        log_bin_expectations (numpy.ndarray): log rates of the forecast
+        expected_forecast_count (int): expected number of events
+
+    Returns:
+        numpy.ndarray: log-likelihood of each simulated catalog
+    """
+    num_simulations, num_events = uniforms.shape
+    if num_events == 0:
+        return np.full(num_simulations, 0.0 - 0.0 - expected_forecast_count)
+    # location of each simulated event, sorted so that events in the same cell are next to each other
+    pnts = np.searchsorted(sampling_weights, uniforms.ravel(), side='right').reshape(num_simulations, num_events)
+    pnts.sort(axis=1)
+    is_first = np.ones(pnts.shape, dtype=bool)
+    is_first[:, 1:] = pnts[:, 1:] != pnts[:, :-1]
+    # occupied cells and number of events in each cell, ordered by simulation then cell
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, pnts.size)).astype(np.float64)
+    cells = pnts.ravel()[starts]
+    rate_terms = log_bin_expectations[cells] * counts
+    penalty_terms = scipy.special.loggamma(counts + 1)
+    # sum terms of each simulation
+    num_cells = is_first.sum(axis=1)
+    offsets = np.cumsum(num_cells) - num_cells
+    sum_rates = np.empty(num_simulations)
+    sum_penalty = np.empty(num_simulations)
+    for k in np.unique(num_cells):
+        rows = np.flatnonzero(num_cells == k)
+        idx = offsets[rows, np.newaxis] + np.arange(k)
+        sum_rates[rows] = np.sum(rate_terms[idx], axis=1)
+        sum_penalty[rows] = np.sum(penalty_terms[idx], axis=1)
+    return sum_rates - sum_penalty - expected_forecast_count
+
+
+class _SpatialTest:
+    """ State of the spatial test of a single forecast; mirrors _poisson_likelihood_test with normalized rates """
+
+    def __init__(self, gridded_forecast, observed_catalog):
+        forecast_data = gridded_forecast.spatial_counts()
+        observed_data = observed_catalog.spatial_counts()
+        self.sim_name = gridded_forecast.name
+        self.obs_name = observed_catalog.name
+        try:
+            self.min_mw = np.min(gridded_forecast.magnitudes)
+        except AttributeError:
+            self.min_mw = -1
+        self.sampling_weights = np.cumsum(forecast_data.ravel()) / np.sum(forecast_data)
+        self.n_obs = np.sum(observed_data)
+        n_fore = np.sum(forecast_data)
+        self.expected_forecast_count = int(self.n_obs)
+        self.log_bin_expectations = np.log(forecast_data.ravel() * (self.n_obs / n_fore))
+        target_idx = np.nonzero(observed_data.ravel())
+        observed_data_nonzero = observed_data.ravel()[target_idx]
+        target_event_forecast = self.log_bin_expectations[target_idx] * observed_data_nonzero
+        self.observed_statistic = poisson_joint_log_likelihood_ndarray(target_event_forecast, observed_data_nonzero,
+                                                                       self.expected_forecast_count)
+        # set by SpatialTestBatch.run
+        self.test_distribution = None
+
+    def simulate(self, uniforms):
+        return simulated_log_likelihoods(uniforms, self.sampling_weights, self.log_bin_expectations,
+                                         self.expected_forecast_count)
+
+    def get_result(self):
+        result = EvaluationResult()
+        result.test_distribution = self.test_distribution
+        result.name = 'Poisson S-Test'
+        result.observed_statistic = self.observed_statistic
+        result.quantile = np.sum(self.test_distribution <= self.observed_statistic) / len(self.test_distribution)
+        result.sim_name = self.sim_name
+        result.obs_name = self.obs_name
+        result.status = 'normal'
+        result.min_mw = self.min_mw
+        return result
+
+
+class SpatialTestBatch:
+    """ Spatial tests of several gridded forecasts that share the simulated random numbers
+
+    Forecasts are added with the observed catalog used to evaluate them. The observations are gridded when the
+    forecast is added, so the catalog can be modified afterwards. Forecasts with the same number of observed events
+    are evaluated on the same random numbers, as they would be by calling pyCSEP with the same seed.
+
+    Args:
+        num_simulations (int): number of simulated catalogs
+        seed (int): seed of the random number generator
+        chunk_size (int): number of catalogs simulated at once
+        seed_stream (str): 'legacy' or 'spawn', see module docstring
+    """
+
+    def __init__(self, num_simulations=1000, seed=None, chunk_size=10000, seed_stream='legacy'):
+        if seed_stream not in SEED_STREAMS:
+            raise ValueError(f'seed_stream must be one of {SEED_STREAMS}, not {seed_stream!r}')
+        self.num_simulations = num_simulations
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.seed_stream = seed_stream
+        self.tests = []
+
+    def add(self, gridded_forecast, observed_catalog):
+        """ Adds forecast to the batch
+
+        Args:
+            gridded_forecast (:class:`csep.core.forecasts.GriddedForecast`): forecast to evaluate
+            observed_catalog (:class:`csep.core.catalogs.AbstractBaseCatalog`): evaluation catalog
+        """
+        self.tests.append(_SpatialTest(gridded_forecast, observed_catalog))
+
+    def get_groups(self):
+        """ Returns dict mapping the number of observed events to the indices of the tests sharing random numbers """
+        groups = {}
+        for idx, test in enumerate(self.tests):
+            groups.setdefault(int(test.n_obs), []).append(idx)
+        return groups
+
+    def get_bank(self, num_events, num_blocks=1):
+        """ Returns :class:`SimulationBank` for tests with num_events observed events """
+        return SimulationBank(self.num_simulations, num_events, seed=self.seed, chunk_size=self.chunk_size,
+                              seed_stream=self.seed_stream, num_blocks=num_blocks)
+
+    def simulate_block(self, bank, block, test_ids):
+        """ Computes the simulated log-likelihoods of a block of simulations
+
+        Returns:
+            list: numpy.ndarray for each test in test_ids
+        """
+        tests = [self.tests[idx] for idx in test_ids]
+        simulated_ll = [[] for _ in tests]
+        for uniforms in bank.iter_chunks(block):
+            for test, chunks in zip(tests, simulated_ll):
+                chunks.append(test.simulate(uniforms))
+        return [np.concatenate(chunks) if chunks else np.empty(0) for chunks in simulated_ll]
+
+    def run(self, verbose=False, num_workers=1):
+        """ Simulates catalogs and computes the results
+
+        Args:
+            verbose (bool): print progress
+            num_workers (int): number of worker processes; uses all cores if None. With the 'spawn' seed stream,
+                               the simulations are split into one block per worker, so the results depend on the
+                               number of workers.
+
+        Returns:
+            list: :class:`csep.models.EvaluationResult` for each forecast in the order they were added
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        tasks = []
+        for n_obs, test_ids in self.get_groups().items():
+            bank = self.get_bank(n_obs, num_blocks=num_workers)
+            for block in range(len(bank.blocks)):
+                tasks.append((bank, block, test_ids))
+        if num_workers > 1:
+            # the batch is sent once to each worker instead of with every task
+            with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+                distributions = self._collect(tasks, pool.imap(_simulate_block, tasks), verbose)
+        else:
+            distributions = self._collect(tasks, (self.simulate_block(*task) for task in tasks), verbose)
+        for test, test_distribution in zip(self.tests, distributions):
+            test.test_distribution = test_distribution
+        return [test.get_result() for test in self.tests]
+
+    def _collect(self, tasks, block_results, verbose):
+        distributions = [np.empty(self.num_simulations) for _ in self.tests]
+        for (bank, block, test_ids), simulated_ll in zip(tasks, block_results):
+            start, stop = bank.blocks[block]
+            for idx, values in zip(test_ids, simulated_ll):
+                distributions[idx][start:stop] = values
+            if verbose:
+                print(f'... {stop} catalogs simulated for {len(test_ids)} forecasts.')
+        return distributions
+
+
+_worker_state = {}
+
+
+def _init_worker(batch):
+    """ Stores batch in a worker process """
+    _worker_state['batch'] = batch
+
+
+def _simulate_block(task):
+    """ Computes a block of simulations in a worker process """
+    bank, block, test_ids = task
+    return _worker_state['batch'].simulate_block(bank, block, test_ids)
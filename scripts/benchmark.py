@@ -0,0 +1,482 @@
+"""
+ Benchmarks of the figure workflows with synthetic forecasts and catalogs.
+
+ The benchmarks do not need the data from Zenodo. For each size, the benchmark writes synthetic gridded forecasts in
+ the CSEP1 ASCII format, samples observed catalogs from them and writes a synthetic UCERF3-ETAS forecast in the merged
+ binary format and synthetic catalogs in the formats read by experiment_utilities.py. The following workflows are timed
+ with the stages of timing.py:
+
+     figure4    loading the gridded forecasts, Poisson N-test of each forecast and batched S-test of all forecasts
+     figure5    paired t-test and W-test of each forecast against the first forecast with PairedComparisons, and
+                with the functions of pyCSEP for reference
+     figure6    single pass over the UCERF3-ETAS forecast without and with the cache of filtered catalogs, N-test and
+                S-test of the catalog-based forecast
+     loaders    load_california_catalog and load_italian_catalog
+
+ The records of the stages are written to ../results/benchmarks/benchmark-<timestamp>.json along with the sizes and a
+ description of the environment, so runs can be compared over time with --compare.
+
+ Usage:
+
+     python benchmark.py [--sizes small medium] [--cases figure4 figure6] [-j 4] [--compare benchmark-<timestamp>.json]
+"""
+# Python imports
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+import csep
+from csep import poisson_evaluations as poisson
+from csep.core.catalogs import CSEPCatalog, UCERF3Catalog
+from csep.core.regions import CartesianGrid2D, create_space_magnitude_region, magnitude_bins
+from csep.models import Event
+from csep.utils.constants import SECONDS_PER_WEEK
+from csep.utils.time_utils import epoch_time_to_utc_datetime
+
+# local imports
+from batched_evaluations import SpatialTestBatch
+from catalog_bins import binned_catalog
+from catalog_pipeline import (
+    CatalogForecastPipeline,
+    EventCountAccumulator,
+    ExpectedRateAccumulator,
+    SpatialLikelihoodAccumulator,
+    number_test,
+    spatial_test
+)
+from comparison_tests import PairedComparisons
+from experiment_utilities import load_california_catalog, load_italian_catalog
+from forecast_registry import get_gridded_forecast
+import forecast_registry
+import timing
+from timing import stage
+
+# parameters of the synthetic data for each size
+SIZES = {
+    'small': {
+        'grid_shape': (40, 40),
+        'num_magnitude_bins': 41,
+        'num_forecasts': 3,
+        'num_events': 50,
+        'num_simulations': 1000,
+        'num_catalogs': 1000,
+        'events_per_catalog': 100,
+        'num_loader_events': 10000
+    },
+    'medium': {
+        'grid_shape': (100, 100),
+        'num_magnitude_bins': 41,
+        'num_forecasts': 4,
+        'num_events': 200,
+        'num_simulations': 10000,
+        'num_catalogs': 10000,
+        'events_per_catalog': 200,
+        'num_loader_events': 100000
+    },
+    'large': {
+        'grid_shape': (150, 150),
+        'num_magnitude_bins': 41,
+        'num_forecasts': 4,
+        'num_events': 500,
+        'num_simulations': 100000,
+        'num_catalogs': 50000,
+        'events_per_catalog': 200,
+        'num_loader_events': 1000000
+    }
+}
+
+CASES = ('figure4', 'figure5', 'figure6', 'loaders')
+
+# synthetic grid, forecast period and mainshock of the UCERF3-ETAS forecast
+GRID_ORIGIN = (-125.0, 32.0)
+GRID_SPACING = 0.1
+START_EPOCH = 1562383193000
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def synthetic_region(grid_shape, dh=GRID_SPACING, origin=GRID_ORIGIN):
+    """ Creates rectangular grid with grid_shape = (num_lons, num_lats) cells; latitudes vary fastest as in CSEP1 """
+    lons = origin[0] + dh * np.arange(grid_shape[0])
+    lats = origin[1] + dh * np.arange(grid_shape[1])
+    origins = np.column_stack([np.repeat(lons, len(lats)), np.tile(lats, len(lons))])
+    return CartesianGrid2D.from_origins(np.round(origins, 5), dh=dh)
+
+
+def synthetic_rates(region, magnitudes, total_rate, rng, num_clusters=10, b_value=1.0):
+    """ Creates smooth spatial rates with a few clusters and Gutenberg-Richter magnitude distribution
+
+    Args:
+        region (CartesianGrid2D): spatial region
+        magnitudes (numpy.ndarray): lower edges of the magnitude bins
+        total_rate (float): expected number of events of the forecast
+        rng (numpy.random.Generator): random number generator
+        num_clusters (int): number of clusters of seismicity
+        b_value (float): b-value of the magnitude distribution
+
+    Returns:
+        numpy.ndarray: rates with shape (num_nodes, num_magnitude_bins)
+    """
+    midpoints = region.midpoints()
+    centers = midpoints[rng.integers(0, len(midpoints), num_clusters)]
+    width = region.dh * max(np.sqrt(region.num_nodes) / 10, 1)
+    spatial = np.full(region.num_nodes, 1e-3)
+    for center in centers:
+        spatial += rng.uniform(0.5, 2) * np.exp(-np.sum((midpoints - center) ** 2, axis=1) / (2 * width ** 2))
+    magnitude = 10 ** (-b_value * (magnitudes - magnitudes[0]))
+    rates = np.outer(spatial, magnitude)
+    return rates * total_rate / rates.sum()
+
+
+def perturb_rates(rates, rng, sigma=0.5):
+    """ Multiplies the rate of each cell by a log-normal factor keeping the total rate """
+    perturbed = rates * rng.lognormal(0, sigma, size=(rates.shape[0], 1))
+    return perturbed * rates.sum() / perturbed.sum()
+
+
+def write_gridded_forecast(fname, region, magnitudes, rates):
+    """ Writes forecast in the CSEP1 ASCII format read by GriddedForecast.load_ascii """
+    dm = magnitudes[1] - magnitudes[0]
+    origins = np.repeat(region.origins(), len(magnitudes), axis=0)
+    mws = np.tile(magnitudes, region.num_nodes)
+    columns = np.column_stack([
+        origins[:, 0], origins[:, 0] + region.dh,
+        origins[:, 1], origins[:, 1] + region.dh,
+        np.zeros(len(mws)), np.full(len(mws), 30.0),
+        mws, mws + dm,
+        rates.ravel(),
+        np.ones(len(mws))
+    ])
+    np.savetxt(fname, columns, fmt=['%.5f'] * 8 + ['%.6e', '%d'], delimiter='\t')
+
+
+def sample_catalog(region, magnitudes, rates, rng, start_epoch=START_EPOCH, duration=SECONDS_PER_WEEK * 1000):
+    """ Samples observed catalog from gridded rates
+
+    Returns:
+        :class:`csep.core.catalogs.CSEPCatalog`
+    """
+    num_events = rng.poisson(rates.sum())
+    idx = rng.choice(rates.size, size=num_events, p=(rates / rates.sum()).ravel())
+    cells, mag_bins = np.divmod(idx, len(magnitudes))
+    origins = region.origins()[cells]
+    dm = magnitudes[1] - magnitudes[0]
+    events = np.zeros(num_events, dtype=CSEPCatalog.dtype)
+    events['id'] = np.arange(num_events).astype(str)
+    events['origin_time'] = np.sort(start_epoch + rng.integers(0, duration, num_events))
+    events['longitude'] = origins[:, 0] + rng.uniform(0.1, 0.9, num_events) * region.dh
+    events['latitude'] = origins[:, 1] + rng.uniform(0.1, 0.9, num_events) * region.dh
+    events['depth'] = rng.uniform(0, 20, num_events)
+    events['magnitude'] = magnitudes[mag_bins] + dm / 2
+    return CSEPCatalog(data=events, name='synthetic')
+
+
+def synthetic_ucerf3_events(num_events, center, rng, version=2):
+    """ Creates events in the UCERF3-ETAS layout around center with an exponential magnitude distribution
+
+    The events start one hour before START_EPOCH and span eight days.
+    """
+    events = np.zeros(num_events, dtype=UCERF3Catalog._get_catalog_dtype(version))
+    events['origin_time'] = np.sort(START_EPOCH - 3600000 + rng.integers(0, 8 * 86400000, num_events))
+    events['longitude'] = center[0] + rng.normal(0, 0.5, num_events)
+    events['latitude'] = center[1] + rng.normal(0, 0.5, num_events)
+    events['depth'] = rng.uniform(0, 20, num_events)
+    events['magnitude'] = np.round(2.0 + rng.exponential(0.45, num_events), 2)
+    return events
+
+
+def write_ucerf3_forecast(fname, num_catalogs, events_per_catalog, center, rng, version=2):
+    """ Writes synthetic forecast in the merged UCERF3-ETAS binary format
+
+    Args:
+        fname (str): path to the forecast file; the file is gzipped if fname ends with .gz
+        num_catalogs (int): number of simulated catalogs
+        events_per_catalog (float): mean number of events of the catalogs
+        center (tuple): longitude and latitude of the center of the events
+        rng (numpy.random.Generator): random number generator
+        version (int): version of the catalog records
+    """
+    open_file = gzip.open if fname.endswith('.gz') else open
+    with open_file(fname, 'wb') as f:
+        f.write(np.array([num_catalogs], dtype='>i4').tobytes())
+        for num_events in rng.poisson(events_per_catalog, num_catalogs):
+            f.write(np.array([version], dtype='>i2').tobytes())
+            f.write(np.array([num_events], dtype='>i4').tobytes())
+            f.write(synthetic_ucerf3_events(num_events, center, rng, version=version).tobytes())
+
+
+def write_california_catalog(fname, num_events, rng):
+    """ Writes synthetic catalog in the format of Table 1 in Zechar et al., 2013 """
+    months = np.array(MONTH_NAMES)[rng.integers(0, 12, num_events)]
+    with open(fname, 'w') as f:
+        for row in zip(rng.integers(1000000, 10000000, num_events), rng.integers(1, 29, num_events), months,
+                       rng.integers(2006, 2011, num_events), rng.integers(0, 24, num_events),
+                       rng.integers(0, 60, num_events), rng.uniform(32, 42, num_events),
+                       rng.uniform(-125, -113, num_events), rng.uniform(3.95, 7, num_events),
+                       rng.uniform(0, 20, num_events)):
+            f.write('{} {} {} {} {:02d}:{:02d} {:.4f} {:.4f} {:.2f} {:.2f}\n'.format(*row))
+
+
+def write_italian_catalog(fname, num_events, rng):
+    """ Writes synthetic catalog in the format read by load_italian_catalog """
+    with open(fname, 'w') as f:
+        for row in zip(rng.uniform(6, 18, num_events), rng.uniform(36, 47, num_events),
+                       rng.integers(2009, 2020, num_events), rng.integers(1, 13, num_events),
+                       rng.integers(1, 29, num_events), rng.integers(0, 24, num_events),
+                       rng.integers(0, 60, num_events), rng.uniform(0, 59.99, num_events),
+                       rng.uniform(2, 6, num_events), rng.uniform(0, 30, num_events)):
+            f.write('{:.3f} {:.3f} {} {} {} {} {} {:.2f} {:.1f} {:.1f}\n'.format(*row))
+
+
+def _write_gridded_forecasts(params, work_dir, rng):
+    """ Writes the synthetic gridded forecasts of a size and samples the observed catalog from the first forecast """
+    region = synthetic_region(params['grid_shape'])
+    magnitudes = magnitude_bins(4.95, 4.95 + 0.1 * (params['num_magnitude_bins'] - 1), 0.1)
+    rates = synthetic_rates(region, magnitudes, params['num_events'], rng)
+    paths = []
+    for i in range(params['num_forecasts']):
+        path = os.path.join(work_dir, f'forecast_{i}.dat')
+        write_gridded_forecast(path, region, magnitudes, rates if i == 0 else perturb_rates(rates, rng))
+        paths.append(path)
+    catalog = sample_catalog(region, magnitudes, rates, rng)
+    return paths, catalog
+
+
+def _load_gridded_forecasts(paths):
+    forecasts = []
+    for path in paths:
+        name = os.path.basename(path)[:-4]
+        with stage(f'load_forecast:{name}'):
+            fore = get_gridded_forecast(path)
+            fore.name = name.upper()
+        forecasts.append(fore)
+    return forecasts
+
+
+def benchmark_figure4(params, work_dir, rng, seed, num_workers=1):
+    """ Times loading the gridded forecasts, the N-tests and the batched S-test of the forecasts
+
+    The catalog is binned once for the grid shared by the forecasts like Fig. 4, see catalog_bins.py.
+    """
+    with stage('generate'):
+        paths, catalog = _write_gridded_forecasts(params, work_dir, rng)
+        catalog = binned_catalog(catalog)
+    forecasts = _load_gridded_forecasts(paths)
+    batch = SpatialTestBatch(num_simulations=params['num_simulations'], seed=seed)
+    for fore in forecasts:
+        catalog.region = fore.region
+        with stage(f'number_test:{fore.name.lower()}'):
+            poisson.number_test(fore, catalog)
+        batch.add(fore, catalog)
+    with stage('spatial_test'):
+        batch.run(num_workers=num_workers)
+
+
+def benchmark_figure5(params, work_dir, rng):
+    """ Times the paired t-tests and W-tests of the forecasts against the first forecast
+
+    The tests are computed with PairedComparisons like Fig. 5, and with the functions of pyCSEP for reference.
+    """
+    with stage('generate'):
+        paths, catalog = _write_gridded_forecasts(params, work_dir, rng)
+    benchmark, *forecasts = _load_gridded_forecasts(paths)
+    with stage('paired_comparisons'):
+        comparisons = PairedComparisons(forecasts + [benchmark], catalog)
+    for fore in forecasts:
+        with stage(f'paired_t_test:{fore.name.lower()}'):
+            comparisons.paired_t_test(fore.name, benchmark.name)
+        with stage(f'w_test:{fore.name.lower()}'):
+            comparisons.w_test(fore.name, benchmark.name)
+    catalog.region = benchmark.region
+    with stage('pycsep'):
+        for fore in forecasts:
+            with stage(f'paired_t_test:{fore.name.lower()}'):
+                poisson.paired_t_test(fore, benchmark, catalog)
+            with stage(f'w_test:{fore.name.lower()}'):
+                poisson.w_test(fore, benchmark, catalog)
+
+
+def benchmark_figure6(params, work_dir, rng, num_workers=1):
+    """ Times the single pass over the UCERF3-ETAS forecast, the N-test and the S-test """
+    region = synthetic_region(params['grid_shape'])
+    smr = create_space_magnitude_region(region, magnitude_bins(2.5, 8.95, 0.1))
+    center = region.midpoints()[region.num_nodes // 2]
+    fname = os.path.join(work_dir, 'results_complete.bin.gz')
+    with stage('generate'):
+        write_ucerf3_forecast(fname, params['num_catalogs'], params['events_per_catalog'], center, rng)
+        events = synthetic_ucerf3_events(rng.poisson(params['events_per_catalog']), center, rng)
+        catalog = UCERF3Catalog(data=events, region=smr).get_csep_format()
+    event = Event(id='mainshock', magnitude=7.1, latitude=center[1], longitude=center[0],
+                  time=epoch_time_to_utc_datetime(START_EPOCH))
+    start_epoch = START_EPOCH
+    end_epoch = start_epoch + SECONDS_PER_WEEK * 1000
+    filters = [
+        f'origin_time >= {start_epoch}',
+        f'origin_time < {end_epoch}',
+        'magnitude >= 2.5'
+    ]
+    with stage('filter_catalog'):
+        catalog = catalog.filter(filters).filter_spatial(region=smr)
+        catalog = catalog.apply_mct(event.magnitude, start_epoch)
+    for name in ('load_forecast', 'load_forecast:cached'):
+        pipeline = CatalogForecastPipeline(
+            fname,
+            start_time=epoch_time_to_utc_datetime(start_epoch),
+            end_time=epoch_time_to_utc_datetime(end_epoch),
+            region=smr,
+            event=event,
+            filters=filters,
+            filter_spatial=True,
+            apply_mct=True
+        )
+        pipeline.register(EventCountAccumulator())
+        pipeline.register(ExpectedRateAccumulator())
+        spatial_likelihoods = pipeline.register(SpatialLikelihoodAccumulator())
+        with stage(name):
+            pipeline.run(num_workers=num_workers)
+            forecast = pipeline.get_catalog_forecast()
+        pipeline.close()
+    with stage('spatial_test'):
+        spatial_test(forecast, catalog, spatial_likelihoods)
+    with stage('number_test'):
+        number_test(forecast, catalog)
+
+
+def benchmark_loaders(params, work_dir, rng):
+    """ Times the catalog loaders of experiment_utilities.py """
+    california_fname = os.path.join(work_dir, 'california.txt')
+    italy_fname = os.path.join(work_dir, 'italy.txt')
+    with stage('generate'):
+        write_california_catalog(california_fname, params['num_loader_events'], rng)
+        write_italian_catalog(italy_fname, params['num_loader_events'], rng)
+    with stage('load_catalog:california'):
+        load_california_catalog(california_fname)
+    with stage('load_catalog:italy'):
+        load_italian_catalog(italy_fname)
+
+
+def get_environment():
+    """ Returns description of the machine and the software versions """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pycsep': csep.__version__,
+        'commit': commit
+    }
+
+
+def run_benchmarks(sizes=('small',), cases=CASES, seed=123456, num_workers=1, work_dir=None):
+    """ Runs the benchmark cases for each size
+
+    Args:
+        sizes (tuple): names of sizes in SIZES
+        cases (tuple): names of cases in CASES
+        seed (int): seed of the synthetic data and the simulations of the S-test
+        num_workers (int): number of processes used by the S-test and the UCERF3-ETAS pipeline
+        work_dir (str): directory for the synthetic data; a temporary directory is created and removed if None
+
+    Returns:
+        dict: sizes, environment and records of the stages
+    """
+    timing.reset()
+    remove_work_dir = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='pycsep-benchmark-')
+    try:
+        for size in sizes:
+            params = SIZES[size]
+            with stage(size):
+                for case in cases:
+                    print(f'Running {case} with {size} size...', flush=True)
+                    # start from an empty directory, so the caches of an earlier run are not used
+                    case_dir = os.path.join(work_dir, size, case)
+                    shutil.rmtree(case_dir, ignore_errors=True)
+                    os.makedirs(case_dir)
+                    # forecasts of different sizes share the file names, so the registry must not hand out old ones
+                    forecast_registry.clear()
+                    rng = np.random.default_rng(seed)
+                    with stage(case):
+                        if case == 'figure4':
+                            benchmark_figure4(params, case_dir, rng, seed, num_workers=num_workers)
+                        elif case == 'figure5':
+                            benchmark_figure5(params, case_dir, rng)
+                        elif case == 'figure6':
+                            benchmark_figure6(params, case_dir, rng, num_workers=num_workers)
+                        elif case == 'loaders':
+                            benchmark_loaders(params, case_dir, rng)
+                        else:
+                            raise ValueError(f'case must be one of {CASES}, not {case!r}')
+    finally:
+        forecast_registry.clear()
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'seed': seed,
+        'num_workers': num_workers,
+        'sizes': {size: SIZES[size] for size in sizes},
+        'cases': list(cases),
+        'environment': get_environment(),
+        'records': timing.get_records()
+    }
+
+
+def print_summary(benchmark, baseline=None):
+    """ Prints wall time, CPU time and peak memory of each stage, and the speed-up over the baseline if given """
+    baseline_times = {}
+    if baseline is not None:
+        baseline_times = {record['stage']: record['wall_time'] for record in baseline['records']}
+    print(f'{"stage":<60}{"wall [s]":>10}{"cpu [s]":>10}{"rss [MiB]":>11}{"speed-up":>10}')
+    for record in benchmark['records']:
+        peak_rss = f'{record["peak_rss"]:.0f}' if record['peak_rss'] is not None else '-'
+        speed_up = '-'
+        if record['stage'] in baseline_times and record['wall_time'] > 0:
+            speed_up = f'{baseline_times[record["stage"]] / record["wall_time"]:.2f}x'
+        print(f'{"  " * record["depth"] + record["stage"].split("/")[-1]:<60}{record["wall_time"]:>10.3f}'
+              f'{record["cpu_time"] + record["children_cpu_time"]:>10.3f}{peak_rss:>11}{speed_up:>10}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the figure workflows with synthetic data.')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES),
+                        help='sizes of the synthetic data (default: small)')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES),
+                        help='workflows to benchmark (default: all)')
+    parser.add_argument('--seed', type=int, default=123456, help='seed of the synthetic data (default: 123456)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes used by the S-test and the UCERF3-ETAS pipeline (default: 1)')
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the synthetic data in this directory (default: temporary directory)')
+    parser.add_argument('--output', default='../results/benchmarks',
+                        help='directory for the benchmark results (default: ../results/benchmarks)')
+    parser.add_argument('--compare', default=None, help='earlier benchmark result to compare against')
+    args = parser.parse_args()
+    benchmark = run_benchmarks(sizes=tuple(args.sizes), cases=tuple(args.cases), seed=args.seed,
+                               num_workers=args.jobs, work_dir=args.work_dir)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_summary(benchmark, baseline=baseline)
+    os.makedirs(args.output, exist_ok=True)
+    fname = os.path.join(args.output, f'benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+    with open(fname, 'w') as f:
+        json.dump(benchmark, f, indent=4, separators=(',', ': '))
+    print(f'Wrote benchmark results to {fname}')
@@ -0,0 +1,144 @@
+"""
+ Bin indices of the observed catalog shared by all tests against forecasts on the same grid.
+
+ Each test of pyCSEP bins the observed catalog into the space-magnitude region of the forecast again, although all
+ forecasts of an experiment share one grid. BinnedCatalog is a CSEPCatalog that stores the spatial and magnitude bin
+ indices of its events per region fingerprint (see catalog_cache.region_fingerprint) and per set of magnitude bins, so
+ that the catalog is binned once per experiment even if its region is reassigned for each forecast. The indices are
+ kept by the catalog itself and are dropped if its events change, e.g., after filtering in place.
+
+ The counts of BinnedCatalog use the stored indices, so it can be passed to the tests of pyCSEP:
+
+     cat = binned_catalog(load_catalog(path, loader=loader))
+     for fore in forecasts:
+         cat.region = fore.region
+         poisson.spatial_test(fore, cat)    # bins the catalog only for the first forecast of the grid
+"""
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+from csep.core.catalogs import CSEPCatalog
+from csep.utils.calc import bin1d_vec
+
+# local imports
+from catalog_cache import region_fingerprint
+
+# default tolerance of the magnitude bins in pyCSEP
+MAGNITUDE_TOLERANCE = 0.00001
+
+
+class BinnedCatalog(CSEPCatalog):
+    """ CSEPCatalog whose binned counts reuse the bin indices of its events computed for earlier regions
+
+    The counts are the same as those of CSEPCatalog.
+    """
+
+    def __init__(self, **kwargs):
+        # ('spatial', region fingerprint) -> spatial index and ('magnitude', magnitude bins, tolerance) -> magnitude
+        # index of the events in _indexed_events
+        self._bin_indices = {}
+        self._indexed_events = None
+        # last region and its fingerprint, because the fingerprint is computed from all cells of the region
+        self._fingerprinted_region = (None, None)
+        super().__init__(**kwargs)
+
+    def _indices(self):
+        """ Returns the stored bin indices, or drops them if the events were replaced, e.g., by filter() """
+        if self._indexed_events is not self.catalog:
+            self._bin_indices = {}
+            self._indexed_events = self.catalog
+        return self._bin_indices
+
+    def _region_key(self, region):
+        if self._fingerprinted_region[0] is not region:
+            self._fingerprinted_region = (region, region_fingerprint(region))
+        return self._fingerprinted_region[1]
+
+    def spatial_index(self, region=None):
+        """ Returns index of the spatial cell of each event, computed once per region fingerprint
+
+        Args:
+            region (:class:`csep.core.regions.CartesianGrid2D`): spatial region; uses the region of the catalog if None
+
+        Returns:
+            numpy.ndarray: read-only index of the cell of each event
+        """
+        region = region if region is not None else self.region
+        indices = self._indices()
+        key = ('spatial', self._region_key(region))
+        if key not in indices:
+            # raises ValueError if an event is outside of the region, like pyCSEP
+            idx = region.get_index_of(self.get_longitudes(), self.get_latitudes())
+            idx.setflags(write=False)
+            indices[key] = idx
+        return indices[key]
+
+    def magnitude_index(self, magnitudes=None, tol=MAGNITUDE_TOLERANCE):
+        """ Returns index of the magnitude bin of each event, computed once per set of magnitude bins
+
+        Args:
+            magnitudes (numpy.ndarray): lower edges of the magnitude bins; uses the bins of the catalog region if None
+            tol (float): tolerance of the bin edges
+
+        Returns:
+            numpy.ndarray: read-only index of the magnitude bin of each event; -1 for magnitudes below the first bin
+        """
+        magnitudes = magnitudes if magnitudes is not None else self.region.magnitudes
+        indices = self._indices()
+        key = ('magnitude', np.asarray(magnitudes, dtype=np.float64).tobytes(), tol)
+        if key not in indices:
+            idx = np.asarray(bin1d_vec(self.get_magnitudes(), magnitudes, tol=tol, right_continuous=True))
+            idx.setflags(write=False)
+            indices[key] = idx
+        return indices[key]
+
+    def get_spatial_idx(self):
+        """ Return spatial index of region for a longitudes and latitudes in catalog. """
+        if self.region is None:
+            return super().get_spatial_idx()
+        return self.spatial_index()
+
+    def get_mag_idx(self):
+        """ Return magnitude index from region magnitudes """
+        if getattr(self.region, 'magnitudes', None) is None:
+            return super().get_mag_idx()
+        return self.magnitude_index()
+
+    def spatial_counts(self):
+        if self.event_count == 0 or self.region is None:
+            return super().spatial_counts()
+        counts = np.zeros(self.region.num_nodes)
+        np.add.at(counts, self.spatial_index(), 1)
+        return counts
+
+    def magnitude_counts(self, mag_bins=None, tol=MAGNITUDE_TOLERANCE, retbins=False):
+        if mag_bins is None:
+            mag_bins = getattr(self.region, 'magnitudes', None)
+        if mag_bins is None or self.event_count == 0:
+            return super().magnitude_counts(mag_bins=mag_bins, tol=tol, retbins=retbins)
+        counts = np.zeros(len(mag_bins))
+        np.add.at(counts, self.magnitude_index(mag_bins, tol=tol), 1)
+        return (mag_bins, counts) if retbins else counts
+
+    def spatial_magnitude_counts(self, mag_bins=None, tol=MAGNITUDE_TOLERANCE):
+        if mag_bins is None and self.region is not None:
+            mag_bins = self.region.magnitudes
+        if self.region is None or mag_bins is None or self.event_count == 0:
+            return super().spatial_magnitude_counts(mag_bins=mag_bins, tol=tol)
+        counts = np.zeros((self.region.num_nodes, len(mag_bins)))
+        spatial_idx = self.spatial_index()
+        mag_idx = self.magnitude_index(mag_bins, tol=tol)
+        if np.any(mag_idx == -1):
+            raise ValueError("at least one magnitude value outside of the valid region.")
+        np.add.at(counts, (spatial_idx, mag_idx), 1)
+        return counts
+
+
+def binned_catalog(catalog):
+    """ Returns BinnedCatalog with the events, name, region and filters of catalog; returns catalog if it is one """
+    if isinstance(catalog, BinnedCatalog):
+        return catalog
+    return BinnedCatalog(data=catalog.data, catalog_id=catalog.catalog_id, format=catalog.format, name=catalog.name,
+                         region=catalog.region, filters=catalog.filters, metadata=catalog.metadata,
+                         date_accessed=catalog.date_accessed)
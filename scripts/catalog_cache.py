@@ -0,0 +1,220 @@
+"""
+ On-disk cache of filtered UCERF3-ETAS catalogs.
+
+ Filtering the UCERF3-ETAS forecast requires decompressing and parsing the entire results_complete.bin.gz file, even
+ though the filtered result only depends on the input file and the filtering parameters. The cache stores the filtered
+ events of all catalogs as a flat binary array of event records along with an index containing the offset of each
+ catalog into that array. Subsequent runs memory-map the cache instead of reading the gzipped forecast.
+
+ Cache layout (one directory per cache key):
+     events.bin    flat array of event records with dtype CACHE_DTYPE
+     offsets.npy   int64 array with n_cat + 1 entries; catalog i is events[offsets[i]:offsets[i+1]]
+     meta.json     parameters used to create the cache; written last and marks the cache as complete
+"""
+# Python imports
+import hashlib
+import json
+import os
+import shutil
+
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+from csep.utils.time_utils import datetime_to_utc_epoch
+
+# bump this if the layout of the cache changes
+CACHE_VERSION = 1
+
+# only the columns needed to bin and plot catalogs are stored
+CACHE_DTYPE = np.dtype([
+    ('origin_time', '<i8'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('depth', '<f8'),
+    ('magnitude', '<f8')
+])
+
+
+def file_fingerprint(filename, sample_size=1024*1024):
+    """ Computes fingerprint of a large file without reading the entire file
+
+    The fingerprint uses the file size, the modification time and the contents of the first and last sample_size
+    bytes of the file.
+
+    Args:
+        filename (str): path to file
+        sample_size (int): number of bytes hashed at the start and end of the file
+
+    Returns:
+        str: hex digest
+    """
+    stat = os.stat(filename)
+    h = hashlib.sha1()
+    h.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(filename, 'rb') as f:
+        h.update(f.read(sample_size))
+        if stat.st_size > sample_size:
+            f.seek(max(stat.st_size - sample_size, sample_size))
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+
+
+def region_fingerprint(region):
+    """ Computes fingerprint of a space-magnitude region from its cell origins, spacing and magnitude bins """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(region.origins(), dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(region.bbox_mask, dtype=np.float64).tobytes())
+    h.update(repr(float(region.dh)).encode())
+    if region.magnitudes is not None:
+        h.update(np.ascontiguousarray(region.magnitudes, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def cache_key(filename, region, filters, filter_spatial, apply_mct, event):
+    """ Computes the cache key from the forecast file and all parameters that affect the filtered catalogs """
+    params = {
+        'version': CACHE_VERSION,
+        'file': file_fingerprint(filename),
+        'region': region_fingerprint(region),
+        'filters': list(filters),
+        'filter_spatial': bool(filter_spatial),
+        'apply_mct': bool(apply_mct),
+        'event': None
+    }
+    if apply_mct:
+        params['event'] = [float(event.magnitude), datetime_to_utc_epoch(event.time)]
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def to_cache_format(events):
+    """ Converts events in any structured format (e.g., big-endian UCERF3 records) into CACHE_DTYPE """
+    out = np.empty(len(events), dtype=CACHE_DTYPE)
+    for name in CACHE_DTYPE.names:
+        out[name] = events[name]
+    return out
+
+
+class FilteredCatalogCache:
+    """ Memory-mapped store of filtered catalogs
+
+    Args:
+        cache_dir (str): directory containing the cache for a single cache key
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.events = None
+        self.offsets = None
+
+    @property
+    def events_path(self):
+        return os.path.join(self.cache_dir, 'events.bin')
+
+    @property
+    def offsets_path(self):
+        return os.path.join(self.cache_dir, 'offsets.npy')
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, 'meta.json')
+
+    def exists(self):
+        """ Returns true if the cache is complete. meta.json is written after all other files. """
+        return os.path.exists(self.meta_path)
+
+    def open(self):
+        """ Memory-maps the events and loads the catalog offsets """
+        self.offsets = np.load(self.offsets_path)
+        if self.offsets[-1] == 0:
+            self.events = np.empty(0, dtype=CACHE_DTYPE)
+        else:
+            self.events = np.memmap(self.events_path, dtype=CACHE_DTYPE, mode='r')
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_events(self, catalog_id):
+        """ Returns the filtered events of a single catalog """
+        return self.events[self.offsets[catalog_id]:self.offsets[catalog_id + 1]]
+
+    def get_event_counts(self):
+        return np.diff(self.offsets)
+
+    def iter_catalogs(self):
+        """ Yields catalog_id and filtered events for each catalog in the cache """
+        if self.offsets is None:
+            self.open()
+        for catalog_id in range(len(self)):
+            yield catalog_id, self.get_events(catalog_id)
+
+    def writer(self, meta=None):
+        """ Returns :class:`FilteredCatalogCacheWriter` that builds this cache """
+        return FilteredCatalogCacheWriter(self.cache_dir, meta=meta)
+
+
+class FilteredCatalogCacheWriter:
+    """ Appends filtered catalogs to a temporary directory that is moved into place once all catalogs are written
+
+    Args:
+        cache_dir (str): final location of the cache
+        meta (dict): additional information stored in meta.json
+    """
+
+    def __init__(self, cache_dir, meta=None):
+        self.cache_dir = cache_dir
+        self.tmp_dir = f'{cache_dir}.tmp-{os.getpid()}'
+        self.meta = meta or {}
+        self.offsets = [0]
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._events_file = open(os.path.join(self.tmp_dir, 'events.bin'), 'wb')
+
+    def append(self, events):
+        """ Appends the filtered events of the next catalog """
+        self._events_file.write(to_cache_format(events).tobytes())
+        self.offsets.append(self.offsets[-1] + len(events))
+
+    def part_filename(self, part):
+        """ Returns filename for a part of the cache written by another process """
+        return os.path.join(self.tmp_dir, f'part-{part:06d}.bin')
+
+    def append_part(self, part, event_counts):
+        """ Appends catalogs written to part_filename(part) by another process
+
+        Args:
+            part (int): part number
+            event_counts (list): number of events in each catalog of the part
+        """
+        part_filename = self.part_filename(part)
+        with open(part_filename, 'rb') as part_file:
+            shutil.copyfileobj(part_file, self._events_file, 16*1024*1024)
+        os.remove(part_filename)
+        for count in event_counts:
+            self.offsets.append(self.offsets[-1] + count)
+
+    def commit(self):
+        """ Finalizes the cache and moves it to its final location """
+        self._events_file.close()
+        np.save(os.path.join(self.tmp_dir, 'offsets.npy'), np.array(self.offsets, dtype=np.int64))
+        meta = dict(self.meta)
+        meta.update({
+            'version': CACHE_VERSION,
+            'dtype': CACHE_DTYPE.descr,
+            'n_cat': len(self.offsets) - 1,
+            'n_events': self.offsets[-1]
+        })
+        with open(os.path.join(self.tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4, sort_keys=True)
+        try:
+            os.replace(self.tmp_dir, self.cache_dir)
+        except OSError:
+            # another process finished the same cache first
+            if not os.path.exists(self.cache_dir):
+                raise
+            shutil.rmtree(self.tmp_dir)
+
+    def abort(self):
+        """ Removes the partially written cache """
+        self._events_file.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
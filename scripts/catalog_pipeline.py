@@ -0,0 +1,769 @@
+"""
+ Single-pass evaluation pipeline for catalog-based forecasts stored in the merged UCERF3-ETAS binary format.
+
+ pyCSEP iterates through a CatalogForecast once for every quantity it needs (expected rates, spatial test and number
+ test each trigger a new pass), which means decompressing and parsing results_complete.bin.gz multiple times. The
+ pipeline in this module streams each simulated catalog exactly once, applies the filters, the time-dependent
+ magnitude of completeness and the spatial mask once, bins the events into the space-magnitude region once, and
+ feeds every registered accumulator from that single pass.
+
+ Typical usage:
+
+     pipeline = CatalogForecastPipeline(fname, region=smr, filters=filters, filter_spatial=True)
+     event_counts = pipeline.register(EventCountAccumulator())
+     pipeline.register(ExpectedRateAccumulator())
+     spatial_likelihoods = pipeline.register(SpatialLikelihoodAccumulator())
+     pipeline.run(verbose=True)
+
+     forecast = pipeline.get_catalog_forecast()
+     s_test = spatial_test(forecast, observed_catalog, spatial_likelihoods)
+     n_test = number_test(forecast, observed_catalog)
+
+ The filtered catalogs are written to a cache (see catalog_cache.py) during the first pass. Later runs with the same
+ forecast file and filtering parameters read the memory-mapped cache instead of the gzipped forecast file.
+
+ With run(num_workers=N), catalogs are processed by N worker processes. Each worker reads a contiguous range of
+ catalogs from the cache or from a block-gzip copy of the forecast file (see ucerf3_io.py), feeds fresh copies of the
+ registered accumulators, and the copies are merged in catalog order, so the results are identical to a sequential
+ run. The block-gzip copy is written during the first sequential pass over a gzipped forecast file.
+"""
+# Python imports
+import multiprocessing
+import os
+import time
+
+# 3rd party imports
+import numpy as np
+import scipy.sparse
+
+# pycsep imports
+from csep.core.catalogs import UCERF3Catalog
+from csep.core.exceptions import CSEPEvaluationException
+from csep.core.forecasts import CatalogForecast, GriddedForecast
+from csep.models import CatalogNumberTestResult, CatalogSpatialTestResult
+from csep.utils.calc import bin1d_vec, _compute_likelihood
+from csep.utils.stats import get_quantiles
+from csep.utils.time_utils import datetime_to_utc_epoch
+
+# local imports
+from catalog_cache import FilteredCatalogCache, cache_key, file_fingerprint, to_cache_format
+from ucerf3_io import BlockGzipIndex, BlockGzipWriter, UCERF3ForecastFile
+
+
+class BinnedCatalog:
+    """ Filtered simulated catalog along with its space-magnitude bin indices
+
+    Attributes:
+        catalog_id (int): index of the catalog in the forecast file
+        events (numpy.ndarray): structured array of filtered events
+        spatial_idx (numpy.ndarray): index of each event into region.polygons
+        magnitude_idx (numpy.ndarray): index of each event into region.magnitudes
+    """
+    __slots__ = ('catalog_id', 'events', 'spatial_idx', 'magnitude_idx')
+
+    def __init__(self, catalog_id, events, spatial_idx, magnitude_idx):
+        self.catalog_id = catalog_id
+        self.events = events
+        self.spatial_idx = spatial_idx
+        self.magnitude_idx = magnitude_idx
+
+    @property
+    def event_count(self):
+        return len(self.events)
+
+
+class CatalogAccumulator:
+    """ Base class for quantities accumulated from each simulated catalog during a single pass """
+
+    def start(self, pipeline):
+        """ Called once before the first catalog is processed """
+        pass
+
+    def add(self, binned):
+        """ Called once for every simulated catalog with a :class:`BinnedCatalog` """
+        raise NotImplementedError('add() not implemented.')
+
+    def spawn(self):
+        """ Returns an empty accumulator of the same kind, used by worker processes """
+        return type(self)()
+
+    def merge(self, other):
+        """ Merges accumulator from a worker that processed the catalogs following the ones seen by this accumulator """
+        raise NotImplementedError('merge() not implemented.')
+
+
+class EventCountAccumulator(CatalogAccumulator):
+    """ Number of events in each filtered catalog; used by the number test """
+
+    def __init__(self):
+        self.event_counts = []
+
+    def add(self, binned):
+        self.event_counts.append(binned.event_count)
+
+    def merge(self, other):
+        self.event_counts.extend(other.event_counts)
+
+    def get_event_counts(self):
+        return np.array(self.event_counts)
+
+
+class ExpectedRateAccumulator(CatalogAccumulator):
+    """ Sums the space-magnitude counts over all catalogs to compute the expected rates of the forecast
+
+    Most space-magnitude bins of a masked aftershock region never contain an event, so the counts are kept in
+    coordinate format: the sorted flat indices (cell * num_mag_bins + magnitude bin) of the occupied bins and their
+    counts. The flat indices of each catalog are buffered and summed into the counts once buffer_size events have been
+    collected. Memory scales with the number of occupied bins instead of the size of the region, and worker processes
+    send back only the occupied bins. The dense array is only created by get_expected_rates.
+
+    Args:
+        buffer_size (int): number of events collected before they are summed into the counts
+    """
+
+    def __init__(self, buffer_size=1000000):
+        self.buffer_size = buffer_size
+        self.shape = None
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._buffer = []
+        self._buffered_events = 0
+        self.region = None
+
+    def start(self, pipeline):
+        self.region = pipeline.region
+        self.shape = (self.region.num_nodes, len(self.region.magnitudes))
+
+    def spawn(self):
+        return type(self)(buffer_size=self.buffer_size)
+
+    def add(self, binned):
+        if binned.event_count == 0:
+            return
+        if np.any(binned.magnitude_idx == -1):
+            raise ValueError("at least one magnitude value outside of the valid region.")
+        self._buffer.append(np.ravel_multi_index((binned.spatial_idx, binned.magnitude_idx), self.shape))
+        self._buffered_events += binned.event_count
+        if self._buffered_events >= self.buffer_size:
+            self._compact()
+
+    def _sum(self, bins, counts):
+        """ Adds counts of the flat indices bins to the counts of the occupied bins """
+        bins = np.concatenate([self.bins] + bins)
+        counts = np.concatenate([self.counts] + counts)
+        self.bins, inverse = np.unique(bins, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+    def _compact(self):
+        """ Sums the buffered flat indices into the counts of the occupied bins """
+        if not self._buffer:
+            return
+        self._sum(self._buffer, [np.ones(self._buffered_events, dtype=np.int64)])
+        self._buffer = []
+        self._buffered_events = 0
+
+    def merge(self, other):
+        other._compact()
+        self._compact()
+        self._sum([other.bins], [other.counts])
+
+    def __getstate__(self):
+        # the region is large and already known to the main process, so only the occupied bins are sent back from
+        # workers
+        self._compact()
+        state = self.__dict__.copy()
+        state['region'] = None
+        return state
+
+    def to_coo(self):
+        """ Returns the summed counts as scipy.sparse.coo_matrix with a row for each cell and a column for each bin """
+        self._compact()
+        rows, cols = np.unravel_index(self.bins, self.shape)
+        return scipy.sparse.coo_matrix((self.counts, (rows, cols)), shape=self.shape)
+
+    def get_expected_rates(self, n_cat, start_time=None, end_time=None, name=None):
+        """ Returns :class:`csep.core.forecasts.GriddedForecast` with the mean rate in each space-magnitude bin """
+        self._compact()
+        data = np.zeros(self.shape)
+        data.flat[self.bins] = self.counts
+        return GriddedForecast(start_time, end_time, data=data / n_cat, region=self.region,
+                               magnitudes=self.region.magnitudes, name=name)
+
+
+class SpatialLikelihoodAccumulator(CatalogAccumulator):
+    """ Stores the sparse spatial counts of each catalog so the spatial test statistic can be computed after the pass
+
+    The spatial test needs the mean spatial rates of the entire forecast before the statistic of any single catalog can
+    be computed. Instead of reading the forecast a second time, the occupied cells and their counts are stored for each
+    catalog and the statistic is evaluated once the expected rates are known.
+    """
+
+    def __init__(self):
+        self.cells = []
+        self.counts = []
+
+    def add(self, binned):
+        cells, counts = np.unique(binned.spatial_idx, return_counts=True)
+        self.cells.append(cells.astype(np.int32))
+        self.counts.append(counts.astype(np.int32))
+
+    def merge(self, other):
+        self.cells.extend(other.cells)
+        self.counts.extend(other.counts)
+
+    def get_test_distribution(self, forecast_mean_spatial_rates, expected_cond_count, n_obs):
+        """ Computes the normalized pseudo-likelihood for each catalog
+
+        This computes the same values as csep.utils.calc._compute_likelihood, evaluated only at the occupied cells.
+
+        Args:
+            forecast_mean_spatial_rates (numpy.ndarray): mean spatial rates of the forecast
+            expected_cond_count (float): expected number of events in the forecast
+            n_obs (float): number of observed events
+
+        Returns:
+            numpy.ndarray: test distribution, including nan values for empty catalogs
+        """
+        test_distribution = np.full(len(self.cells), np.nan)
+        if n_obs == 0 or expected_cond_count == 0:
+            return test_distribution
+        norm_apprx_rate_density = forecast_mean_spatial_rates / np.sum(forecast_mean_spatial_rates)
+        with np.errstate(divide='ignore'):
+            for i, (cells, counts) in enumerate(zip(self.cells, self.counts)):
+                if len(cells) == 0:
+                    continue
+                gridded_data = counts.astype(np.float64)
+                test_distribution[i] = np.sum(gridded_data * np.log(norm_apprx_rate_density[cells])) \
+                    / np.sum(gridded_data)
+        return test_distribution
+
+
+class MagnitudeHistogramAccumulator(CatalogAccumulator):
+    """ Magnitude histogram of each catalog binned using region.magnitudes """
+
+    def __init__(self):
+        self.histograms = []
+        self.num_mag_bins = None
+
+    def start(self, pipeline):
+        self.num_mag_bins = len(pipeline.region.magnitudes)
+
+    def add(self, binned):
+        self.histograms.append(np.bincount(binned.magnitude_idx, minlength=self.num_mag_bins))
+
+    def merge(self, other):
+        self.histograms.extend(other.histograms)
+
+    def get_histograms(self):
+        """ Returns 2d numpy.ndarray with shape (n_cat, num_mag_bins) """
+        return np.array(self.histograms).reshape(-1, self.num_mag_bins)
+
+
+class CatalogStoreAccumulator(CatalogAccumulator):
+    """ Keeps the filtered events of every catalog in memory. Only use this for forecasts that fit into memory. """
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, binned):
+        self.events.append(binned.events)
+
+    def merge(self, other):
+        self.events.extend(other.events)
+
+
+class CatalogForecastPipeline:
+    """ Streams the catalogs from a UCERF3-ETAS forecast file once and feeds each registered accumulator
+
+    Filtering follows the same order as csep.core.forecasts.CatalogForecast: filter statements, then the
+    time-dependent magnitude of completeness, then the spatial filter.
+
+    Args:
+        filename (str): path to merged UCERF3-ETAS binary file
+        region: space-magnitude region used for filtering and binning
+        filters (list): filter statements applied to each catalog
+        event (csep.models.Event): mainshock, required if apply_mct is true
+        filter_spatial (bool): if true, removes events outside of the region
+        apply_mct (bool): if true, applies the time-dependent magnitude of completeness
+        start_time (datetime.datetime): start time of the forecast
+        end_time (datetime.datetime): end time of the forecast
+        name (str): name of the forecast
+        use_cache (bool): if true, reads filtered catalogs from the cache or writes the cache during the first pass
+        cache_dir (str): root directory of the cache; defaults to cache/ucerf3 next to the forecast file
+    """
+
+    def __init__(self, filename, region, filters=None, event=None, filter_spatial=False, apply_mct=False,
+                 start_time=None, end_time=None, name=None, use_cache=True, cache_dir=None):
+        if region is None or region.magnitudes is None:
+            raise AttributeError("Pipeline must have space-magnitude region to bin catalogs.")
+        if apply_mct and event is None:
+            raise AttributeError("Event must be provided to apply the time-dependent magnitude of completeness.")
+        self.filename = filename
+        self.region = region
+        self.filters = filters or []
+        self.event = event
+        self.filter_spatial = filter_spatial
+        self.apply_mct = apply_mct
+        self.start_time = start_time
+        self.end_time = end_time
+        self.name = name
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(filename)), 'cache', 'ucerf3')
+        self.accumulators = []
+        self.n_cat = None
+        self._cache = None
+        self._forecast_file = None
+        self._block_filename = None
+
+    def __getstate__(self):
+        # workers receive the pipeline configuration only; open files and results stay in the main process
+        state = self.__dict__.copy()
+        state['accumulators'] = []
+        state['_forecast_file'] = None
+        if self._cache is not None:
+            state['_cache'] = FilteredCatalogCache(self._cache.cache_dir)
+        return state
+
+    def register(self, accumulator):
+        """ Registers accumulator to receive every catalog during run(). Returns the accumulator for convenience. """
+        self.accumulators.append(accumulator)
+        return accumulator
+
+    def get_accumulator(self, accumulator_class):
+        """ Returns the first registered accumulator of type accumulator_class or None """
+        for accumulator in self.accumulators:
+            if isinstance(accumulator, accumulator_class):
+                return accumulator
+        return None
+
+    def filter_events(self, catalog_id, events):
+        """ Applies filters, magnitude of completeness and spatial filter to the raw events of a single catalog """
+        catalog = UCERF3Catalog(data=events, catalog_id=catalog_id, region=self.region, name=self.name,
+                                compute_stats=False)
+        if self.filters:
+            catalog = catalog.filter(self.filters)
+        if self.apply_mct and catalog.event_count > 0:
+            catalog = catalog.apply_mct(self.event.magnitude, datetime_to_utc_epoch(self.event.time))
+        if self.filter_spatial:
+            catalog = catalog.filter_spatial(self.region)
+        return catalog.data
+
+    def bin_events(self, catalog_id, events):
+        """ Computes the space-magnitude bin indices of filtered events """
+        if len(events) == 0:
+            empty = np.empty(0, dtype=int)
+            return BinnedCatalog(catalog_id, events, empty, empty)
+        spatial_idx = self.region.get_index_of(events['longitude'], events['latitude'])
+        magnitude_idx = bin1d_vec(events['magnitude'], self.region.magnitudes, tol=0.00001, right_continuous=True)
+        return BinnedCatalog(catalog_id, events, spatial_idx, magnitude_idx)
+
+    def get_cache(self):
+        """ Returns :class:`catalog_cache.FilteredCatalogCache` for this forecast file and filtering parameters """
+        if self._cache is None:
+            key = cache_key(self.filename, self.region, self.filters, self.filter_spatial, self.apply_mct, self.event)
+            self._cache = FilteredCatalogCache(os.path.join(self.cache_dir, key))
+        return self._cache
+
+    def get_forecast_file(self):
+        """ Returns :class:`ucerf3_io.UCERF3ForecastFile` that stays open to allow reading single catalogs """
+        if self._forecast_file is None:
+            self._forecast_file = UCERF3ForecastFile(self.filename)
+        return self._forecast_file
+
+    def get_block_filename(self):
+        """ Returns filename of the block-gzip copy of the forecast file used by parallel runs """
+        if self._block_filename is None:
+            self._block_filename = os.path.join(self.cache_dir, 'blocks', f'{file_fingerprint(self.filename)}.bin.gz')
+        return self._block_filename
+
+    def _iter_filtered_file(self, write_blocks=False):
+        forecast_file = self.get_forecast_file()
+        if not write_blocks:
+            for catalog_id, events in forecast_file.iter_catalogs():
+                yield catalog_id, self.filter_events(catalog_id, events)
+            return
+        writer = BlockGzipWriter(self.get_block_filename(), len(forecast_file))
+        completed = False
+        try:
+            for catalog_id, events, record in forecast_file.iter_catalogs(return_bytes=True):
+                writer.write_record(record)
+                yield catalog_id, self.filter_events(catalog_id, events)
+            completed = True
+        finally:
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
+
+    def _get_cache_meta(self):
+        return {
+            'filename': os.path.abspath(self.filename),
+            'filters': list(self.filters),
+            'filter_spatial': self.filter_spatial,
+            'apply_mct': self.apply_mct
+        }
+
+    def _iter_filtered_file_to_cache(self, cache, write_blocks=False):
+        writer = cache.writer(meta=self._get_cache_meta())
+        completed = False
+        try:
+            for catalog_id, events in self._iter_filtered_file(write_blocks=write_blocks):
+                writer.append(events)
+                yield catalog_id, events
+            completed = True
+        finally:
+            # only complete passes are written to the cache
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
+
+    def iter_filtered_catalogs(self, write_blocks=False):
+        """ Yields catalog_id and filtered events for each catalog in the forecast file
+
+        Args:
+            write_blocks (bool): if true and the forecast file is read, also writes the block-gzip copy used by
+                                 parallel runs
+        """
+        if not self.use_cache:
+            yield from self._iter_filtered_file(write_blocks=write_blocks)
+            return
+        cache = self.get_cache()
+        if cache.exists():
+            yield from cache.iter_catalogs()
+        else:
+            yield from self._iter_filtered_file_to_cache(cache, write_blocks=write_blocks)
+
+    def _get_parallel_source(self):
+        """ Returns 'cache' or 'blocks' if catalogs can be read in parallel, otherwise None """
+        if self.use_cache and self.get_cache().exists():
+            return 'cache'
+        if BlockGzipIndex.exists(self.get_block_filename()):
+            return 'blocks'
+        return None
+
+    def _iter_source_range(self, source, start, stop):
+        """ Yields filtered catalogs from a range of the cache (catalog ids) or the block-gzip file (block ids) """
+        if source == 'cache':
+            cache = FilteredCatalogCache(self.get_cache().cache_dir).open()
+            for catalog_id in range(start, stop):
+                yield catalog_id, cache.get_events(catalog_id)
+        else:
+            index = BlockGzipIndex(self.get_block_filename())
+            for catalog_id, events in index.iter_catalogs(start, stop):
+                yield catalog_id, self.filter_events(catalog_id, events)
+
+    def _run_parallel(self, num_workers, source, verbose=False):
+        if source == 'cache':
+            cache = self.get_cache()
+            if cache.offsets is None:
+                cache.open()
+            num_units = len(cache)
+        else:
+            num_units = BlockGzipIndex(self.get_block_filename()).num_blocks
+        # use more tasks than workers to balance the load between workers
+        bounds = np.unique(np.linspace(0, num_units, 4 * num_workers + 1).astype(int))
+        # filtered catalogs from the block-gzip file are written to the cache in parts and concatenated in order
+        writer = None
+        if source == 'blocks' and self.use_cache:
+            writer = self.get_cache().writer(meta=self._get_cache_meta())
+        tasks = []
+        for part, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            part_filename = writer.part_filename(part) if writer is not None else None
+            tasks.append((source, int(start), int(stop), part_filename))
+        if verbose:
+            print(f'Processing catalogs from {source} using {num_workers} processes')
+        n_cat = 0
+        t0 = time.time()
+        completed = False
+        try:
+            # the pipeline and accumulators are sent once to each worker instead of with every task
+            templates = [accumulator.spawn() for accumulator in self.accumulators]
+            with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self, templates)) as pool:
+                # imap returns results in task order, so merging is deterministic
+                for part, (accumulators, event_counts) in enumerate(pool.imap(_run_catalog_range, tasks)):
+                    for accumulator, other in zip(self.accumulators, accumulators):
+                        accumulator.merge(other)
+                    if writer is not None:
+                        writer.append_part(part, event_counts)
+                    n_cat += len(event_counts)
+                    if verbose:
+                        t1 = time.time()
+                        print(f'Processed {n_cat} catalogs in {t1 - t0} seconds', flush=True)
+            completed = True
+        finally:
+            if writer is not None:
+                if completed:
+                    writer.commit()
+                else:
+                    writer.abort()
+        self.n_cat = n_cat
+        return self
+
+    def run(self, verbose=False, num_workers=1):
+        """ Performs the single pass over the forecast file
+
+        Args:
+            verbose (bool): print progress
+            num_workers (int): number of worker processes; uses all cores if None. Catalogs are processed in parallel
+                               if the cache or the block-gzip copy of the forecast file exists. Otherwise, the first
+                               pass is sequential and writes the block-gzip copy for later runs.
+
+        Returns:
+            self
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        for accumulator in self.accumulators:
+            accumulator.start(self)
+        if num_workers > 1:
+            source = self._get_parallel_source()
+            if source is not None:
+                return self._run_parallel(num_workers, source, verbose=verbose)
+        if verbose and self.use_cache:
+            if self.get_cache().exists():
+                print(f'Reading filtered catalogs from cache {self.get_cache().cache_dir}')
+            else:
+                print(f'Writing filtered catalogs to cache {self.get_cache().cache_dir}')
+        n_cat = 0
+        t0 = time.time()
+        for catalog_id, events in self.iter_filtered_catalogs(write_blocks=num_workers > 1):
+            binned = self.bin_events(catalog_id, events)
+            for accumulator in self.accumulators:
+                accumulator.add(binned)
+            n_cat += 1
+            if verbose:
+                tens_exp = np.floor(np.log10(n_cat))
+                if n_cat % 10 ** tens_exp == 0:
+                    t1 = time.time()
+                    print(f'Processed {n_cat} catalogs in {t1 - t0} seconds', flush=True)
+        self.n_cat = n_cat
+        return self
+
+    def fetch_catalog(self, catalog_id):
+        """ Reads and filters a single catalog without loading the other catalogs into memory
+
+        The catalog is read from the cache if available. Otherwise, the forecast file is read starting at the closest
+        position recorded during run().
+
+        Args:
+            catalog_id (int): index of catalog in the forecast file
+
+        Returns:
+            :class:`csep.core.catalogs.UCERF3Catalog`
+        """
+        if self.use_cache and self.get_cache().exists():
+            cache = self.get_cache()
+            if cache.offsets is None:
+                cache.open()
+            events = cache.get_events(catalog_id)
+        else:
+            events = self.filter_events(catalog_id, self.get_forecast_file().read_catalog(catalog_id))
+        return self.to_catalog(catalog_id, events)
+
+    def select_percentile_catalogs(self, percentiles):
+        """ Returns the catalogs whose event counts are closest to percentiles of the event counts of all catalogs
+
+        The event counts are gathered by the EventCountAccumulator during run(), and only the selected catalogs are
+        read again in the order of the forecast file, so memory holds the selected catalogs only.
+
+        Args:
+            percentiles (list): percentiles between 0 and 100
+
+        Returns:
+            list: :class:`csep.core.catalogs.UCERF3Catalog` for each percentile
+        """
+        count_accumulator = self.get_accumulator(EventCountAccumulator)
+        if self.n_cat is None or count_accumulator is None:
+            raise RuntimeError("Pipeline must be run with EventCountAccumulator before selecting catalogs.")
+        catalog_ids = percentile_catalog_ids(count_accumulator.get_event_counts(), percentiles)
+        catalogs = {catalog_id: self.fetch_catalog(catalog_id) for catalog_id in sorted(set(catalog_ids))}
+        return [catalogs[catalog_id] for catalog_id in catalog_ids]
+
+    def close(self):
+        """ Closes the forecast file """
+        if self._forecast_file is not None:
+            self._forecast_file.close()
+            self._forecast_file = None
+
+    def to_catalog(self, catalog_id, events):
+        """ Wraps filtered events into a catalog object, e.g., for plotting """
+        return UCERF3Catalog(filename=self.filename, data=events, catalog_id=catalog_id, region=self.region,
+                             name=self.name)
+
+    def _load_filtered_catalogs(self, **kwargs):
+        """ Loader passed to CatalogForecast; catalogs are already filtered when produced by the pipeline """
+        for catalog_id, events in self.iter_filtered_catalogs():
+            yield self.to_catalog(catalog_id, events)
+
+    def get_catalog_forecast(self):
+        """ Returns :class:`csep.core.forecasts.CatalogForecast` populated with the results of the pass
+
+        The expected rates and event counts are attached to the forecast, so pyCSEP functions that only need these
+        (e.g., plotting) will not read the forecast file again.
+        """
+        if self.n_cat is None:
+            raise RuntimeError("Pipeline must be run before creating the forecast.")
+        expected_rates = None
+        rate_accumulator = self.get_accumulator(ExpectedRateAccumulator)
+        if rate_accumulator is not None:
+            expected_rates = rate_accumulator.get_expected_rates(self.n_cat, start_time=self.start_time,
+                                                                 end_time=self.end_time, name=self.name)
+        forecast = CatalogForecast(filename=self.filename, name=self.name, region=self.region,
+                                   expected_rates=expected_rates, start_time=self.start_time,
+                                   end_time=self.end_time, n_cat=self.n_cat, event=self.event,
+                                   loader=self._load_filtered_catalogs, catalog_type='ucerf3', store=False)
+        count_accumulator = self.get_accumulator(EventCountAccumulator)
+        if count_accumulator is not None:
+            forecast._event_counts = list(count_accumulator.event_counts)
+        return forecast
+
+
+def percentile_catalog_ids(event_counts, percentiles):
+    """ Returns index of the first catalog whose event count is closest to each percentile of the event counts
+
+    The percentiles are interpolated between event counts, so they are not always the event count of a catalog.
+
+    Args:
+        event_counts (numpy.ndarray): number of events in each catalog
+        percentiles (list): percentiles between 0 and 100
+
+    Returns:
+        list: index of a catalog for each percentile
+    """
+    event_counts = np.asarray(event_counts)
+    if len(event_counts) == 0:
+        raise ValueError("Unable to select catalogs from a forecast without catalogs.")
+    return [int(np.argmin(np.abs(event_counts - target))) for target in np.percentile(event_counts, percentiles)]
+
+
+_worker_state = {}
+
+
+def _init_worker(pipeline, accumulators):
+    """ Stores pipeline and accumulator templates in a worker process """
+    _worker_state['pipeline'] = pipeline
+    _worker_state['accumulators'] = accumulators
+
+
+def _run_catalog_range(task):
+    """ Processes a range of catalogs in a worker process
+
+    Args:
+        task (tuple): source, start, stop and part_filename. If part_filename is not None, the filtered events are
+                      written to this file in the cache format.
+
+    Returns:
+        accumulators (list), event_counts (list)
+    """
+    source, start, stop, part_filename = task
+    pipeline = _worker_state['pipeline']
+    accumulators = [accumulator.spawn() for accumulator in _worker_state['accumulators']]
+    for accumulator in accumulators:
+        accumulator.start(pipeline)
+    part_file = open(part_filename, 'wb') if part_filename is not None else None
+    event_counts = []
+    try:
+        for catalog_id, events in pipeline._iter_source_range(source, start, stop):
+            if part_file is not None:
+                part_file.write(to_cache_format(events).tobytes())
+            binned = pipeline.bin_events(catalog_id, events)
+            for accumulator in accumulators:
+                accumulator.add(binned)
+            event_counts.append(len(events))
+    finally:
+        if part_file is not None:
+            part_file.close()
+    return accumulators, event_counts
+
+
+def number_test(forecast, observed_catalog):
+    """ Catalog-based number test using the event counts gathered by the pipeline
+
+    Same as csep.core.catalog_evaluations.number_test, but does not iterate through the forecast.
+
+    Args:
+        forecast (:class:`csep.core.forecasts.CatalogForecast`): forecast from CatalogForecastPipeline
+        observed_catalog (:class:`csep.core.catalogs.AbstractBaseCatalog`): evaluation catalog
+
+    Returns:
+        :class:`csep.models.CatalogNumberTestResult`
+    """
+    event_counts = forecast.get_event_counts()
+    obs_count = observed_catalog.event_count
+    delta_1, delta_2 = get_quantiles(event_counts, obs_count)
+    result = CatalogNumberTestResult(test_distribution=event_counts,
+                                     name='Catalog N-Test',
+                                     observed_statistic=obs_count,
+                                     quantile=(delta_1, delta_2),
+                                     status='normal',
+                                     obs_catalog_repr=str(observed_catalog),
+                                     sim_name=forecast.name,
+                                     min_mw=forecast.min_magnitude,
+                                     obs_name=observed_catalog.name)
+    return result
+
+
+def spatial_test(forecast, observed_catalog, spatial_likelihoods):
+    """ Catalog-based spatial test using the sparse spatial counts gathered by the pipeline
+
+    Same as csep.core.catalog_evaluations.spatial_test, but does not iterate through the forecast.
+
+    Args:
+        forecast (:class:`csep.core.forecasts.CatalogForecast`): forecast from CatalogForecastPipeline
+        observed_catalog (:class:`csep.core.catalogs.AbstractBaseCatalog`): evaluation catalog
+        spatial_likelihoods (:class:`SpatialLikelihoodAccumulator`): accumulator registered with the pipeline
+
+    Returns:
+        :class:`csep.models.CatalogSpatialTestResult`
+    """
+    if forecast.region is None:
+        raise CSEPEvaluationException("Forecast must have region member to perform spatial test.")
+    if forecast.expected_rates is None:
+        raise CSEPEvaluationException("Pipeline must register ExpectedRateAccumulator to perform spatial test.")
+
+    if observed_catalog.event_count == 0:
+        print('Spatial test not-invalid because no events in observed catalog.')
+
+    expected_cond_count = forecast.expected_rates.sum()
+    forecast_mean_spatial_rates = forecast.expected_rates.spatial_counts()
+    gridded_obs = observed_catalog.spatial_counts()
+    n_obs = np.sum(gridded_obs)
+
+    test_distribution = spatial_likelihoods.get_test_distribution(forecast_mean_spatial_rates,
+                                                                  expected_cond_count, n_obs)
+
+    _, obs_lh_norm = _compute_likelihood(gridded_obs, forecast_mean_spatial_rates, expected_cond_count, n_obs)
+    # if obs_lh is -numpy.inf, recompute but only for indexes where obs and simulated are non-zero
+    message = "normal"
+    if obs_lh_norm == -np.inf:
+        idx_good_sim = forecast_mean_spatial_rates != 0
+        new_gridded_obs = gridded_obs[idx_good_sim]
+        new_n_obs = np.sum(new_gridded_obs)
+        print(f"Found -inf as the observed likelihood score. "
+              f"Assuming event(s) occurred in undersampled region of forecast.\n"
+              f"Recomputing with {new_n_obs} events after removing {n_obs - new_n_obs} events.")
+        new_ard = forecast_mean_spatial_rates[idx_good_sim]
+        _, obs_lh_norm = _compute_likelihood(new_gridded_obs, new_ard, expected_cond_count, n_obs)
+        message = "undersampled"
+
+    # remove nans from the spatial distribution, these come from catalogs without events
+    if np.isnan(np.sum(test_distribution)):
+        test_distribution = test_distribution[~np.isnan(test_distribution)]
+
+    if n_obs == 0 or np.isnan(obs_lh_norm):
+        message = "not-valid"
+        delta_1, delta_2 = -1, -1
+    else:
+        delta_1, delta_2 = get_quantiles(test_distribution, obs_lh_norm)
+
+    result = CatalogSpatialTestResult(test_distribution=test_distribution,
+                                      name='S-Test',
+                                      observed_statistic=obs_lh_norm,
+                                      quantile=(delta_1, delta_2),
+                                      status=message,
+                                      min_mw=forecast.min_magnitude,
+                                      obs_catalog_repr=str(observed_catalog),
+                                      sim_name=forecast.name,
+                                      obs_name=observed_catalog.name)
+    return result
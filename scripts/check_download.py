@@ -0,0 +1,136 @@
+"""
+ Checks the parallel range downloads of download_data.py against a local HTTP server.
+
+ The server sends each response in small pieces with a short pause, so that the segments of a file are written
+ concurrently and the checksum computed during the download reads the .part file while later segments are still
+ missing. The segments are much smaller than the read buffer of the checksum. Each case downloads a file of random
+ bytes and fails if the file or its checksum differ from the data that were served:
+
+ * new downloads with several chunk sizes
+ * a resumed download whose segments stopped at offsets that are not aligned with the chunks
+ * a download whose first range request after the start of the file is answered with the whole file, which must be
+   detected and retried
+
+ Usage:
+
+     python check_download.py
+"""
+# Python imports
+import hashlib
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+# local imports
+from download_data import _PartialDownload, download_file
+
+# size of the served file in bytes; not a multiple of the chunk sizes or the number of segments
+FILE_SIZE = 1000003
+NUM_CONNECTIONS = 4
+CHUNK_SIZES = (10000, 50000)
+
+# bytes sent by the server at once and pause between them in seconds
+SEND_SIZE = 4096
+SEND_PAUSE = 0.001
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves server.payload and answers range requests with the requested bytes
+
+    The first server.wrong_ranges range requests that do not start at the first byte are answered with the whole file
+    and status 206, like a misbehaving proxy.
+    """
+
+    def do_GET(self):
+        payload = self.server.payload
+        start, stop = 0, len(payload)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            stop = int(match.group(2)) + 1 if match.group(2) else len(payload)
+            with self.server.lock:
+                if start > 0 and self.server.wrong_ranges > 0:
+                    self.server.wrong_ranges -= 1
+                    start, stop = 0, len(payload)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{len(payload)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(stop - start))
+        self.end_headers()
+        try:
+            for offset in range(start, stop, SEND_SIZE):
+                self.wfile.write(payload[offset:min(offset + SEND_SIZE, stop)])
+                time.sleep(SEND_PAUSE)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(payload):
+    """ Starts HTTP server serving payload on a free local port; call shutdown() on the returned server to stop it """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.daemon_threads = True
+    server.payload = payload
+    server.lock = threading.Lock()
+    server.wrong_ranges = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_resume(url, filename, payload, num_segments):
+    """ Writes .part file and state of a download whose segments stopped at unaligned offsets """
+    download = _PartialDownload(url, filename, len(payload), num_segments)
+    with open(download.part_filename, 'r+b') as f:
+        for i, segment in enumerate(download.segments):
+            start, stop, _ = segment
+            done = min(stop - start - 1, 12345 * (i + 1) + 7)
+            f.seek(start)
+            f.write(payload[start:start + done])
+            segment[2] = done
+    download.save(force=True)
+
+
+def check_case(name, url, filename, payload, chunk_size, resume=False):
+    """ Downloads url into filename and returns true if the file and its checksum match payload """
+    if resume:
+        prepare_resume(url, filename, payload, NUM_CONNECTIONS)
+    digest = download_file(url, filename, num_connections=NUM_CONNECTIONS, chunk_size=chunk_size,
+                           min_segment_size=len(payload) // NUM_CONNECTIONS, algorithm='md5')
+    with open(filename, 'rb') as f:
+        file_ok = f.read() == payload
+    digest_ok = digest == hashlib.md5(payload).hexdigest()
+    print(f'{name:<40}file {"ok" if file_ok else "WRONG"}, checksum {"ok" if digest_ok else "WRONG"}', flush=True)
+    os.remove(filename)
+    return file_ok and digest_ok
+
+
+def main():
+    payload = os.urandom(FILE_SIZE)
+    server = serve(payload)
+    url = f'http://127.0.0.1:{server.server_address[1]}/data.bin'
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            filename = os.path.join(work_dir, 'data.bin')
+            for chunk_size in CHUNK_SIZES:
+                ok &= check_case(f'new download, chunk size {chunk_size}', url, filename, payload, chunk_size)
+            ok &= check_case('resumed download, unaligned segments', url, filename, payload, CHUNK_SIZES[0],
+                             resume=True)
+            server.wrong_ranges = 1
+            ok &= check_case('whole file instead of requested range', url, filename, payload, CHUNK_SIZES[0])
+    finally:
+        server.shutdown()
+    if not ok:
+        print('Download check failed')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+ Compares the evaluation results of a run against the expected results.
+
+ Each result in expected_output/results is compared with the result of the same name in results. Scalars are compared
+ with a relative and absolute tolerance, strings and None must be equal. Test distributions are compared element-wise
+ and summarized by the maximum absolute difference and the two-sample Kolmogorov-Smirnov distance. Results written in
+ either format of results_io.py can be compared.
+
+ The files are compared in parallel. The script prints a summary, optionally writes a JSON report and exits with
+ status 1 if any result does not match.
+
+ Usage:
+
+     python check_results.py [--results ../results] [--expected ../expected_output/results] [--report report.json]
+"""
+# Python imports
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+# 3rd party imports
+import numpy as np
+
+# local imports
+from results_io import load_result_dict
+
+
+def ks_distance(x, y):
+    """ Computes the two-sample Kolmogorov-Smirnov distance between samples x and y """
+    x = np.sort(np.asarray(x, dtype=np.float64))
+    y = np.sort(np.asarray(y, dtype=np.float64))
+    if len(x) == 0 or len(y) == 0:
+        return float('nan')
+    values = np.concatenate([x, y])
+    cdf_x = np.searchsorted(x, values, side='right') / len(x)
+    cdf_y = np.searchsorted(y, values, side='right') / len(y)
+    return float(np.max(np.abs(cdf_x - cdf_y)))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compare_values(value, expected, rtol=1e-6, atol=1e-9):
+    """ Compares scalars and (nested) lists of scalars
+
+    Returns:
+        tuple: passed (bool), max_abs_diff (float or None)
+    """
+    if _is_number(value) and _is_number(expected):
+        diff = abs(value - expected)
+        if np.isnan(value) and np.isnan(expected):
+            return True, 0.0
+        return bool(diff <= atol + rtol * abs(expected)), float(diff)
+    if isinstance(value, list) and isinstance(expected, list):
+        if len(value) != len(expected):
+            return False, None
+        passed = True
+        max_diff = None
+        for v, e in zip(value, expected):
+            item_passed, diff = compare_values(v, e, rtol=rtol, atol=atol)
+            passed = passed and item_passed
+            if diff is not None:
+                max_diff = diff if max_diff is None else max(max_diff, diff)
+        return passed, max_diff
+    return value == expected, None
+
+
+def compare_distributions(values, expected, rtol=1e-6, atol=1e-9, ks_tol=None):
+    """ Compares test distributions
+
+    Args:
+        values (array-like): test distribution of the result
+        expected (array-like): expected test distribution
+        rtol (float): relative tolerance for the element-wise comparison
+        atol (float): absolute tolerance for the element-wise comparison
+        ks_tol (float): if not None, distributions that differ element-wise pass if their KS distance is at most ks_tol
+
+    Returns:
+        dict: summary of the comparison
+    """
+    values = np.asarray(values)
+    expected = np.asarray(expected)
+    numeric = values.dtype.kind in 'biuf' and expected.dtype.kind in 'biuf'
+    if not numeric:
+        # e.g., name and mean of the distribution used by the Poisson N-test
+        passed, max_diff = compare_values(values.tolist(), expected.tolist(), rtol=rtol, atol=atol)
+        return {'passed': passed, 'max_abs_diff': max_diff}
+    summary = {'size': int(values.size), 'expected_size': int(expected.size), 'max_abs_diff': None,
+               'ks_distance': ks_distance(values.ravel(), expected.ravel())}
+    passed = False
+    if values.shape == expected.shape:
+        diff = np.abs(values.astype(np.float64) - expected)
+        summary['max_abs_diff'] = float(np.max(diff)) if diff.size else 0.0
+        passed = bool(np.all((diff <= atol + rtol * np.abs(expected)) | (np.isnan(values) & np.isnan(expected))))
+    if not passed and ks_tol is not None:
+        passed = bool(summary['ks_distance'] <= ks_tol)
+    summary['passed'] = passed
+    return summary
+
+
+def compare_result_files(result_fname, expected_fname, rtol=1e-6, atol=1e-9, ks_tol=None, ignore=()):
+    """ Compares a single result against the expected result
+
+    Returns:
+        dict: file name, passed and the comparison of each key
+    """
+    report = {'file': os.path.basename(expected_fname), 'passed': False, 'checks': {}}
+    if not os.path.exists(result_fname):
+        report['error'] = 'missing result'
+        return report
+    try:
+        result = load_result_dict(result_fname)
+        expected = load_result_dict(expected_fname)
+    except (OSError, ValueError) as err:
+        report['error'] = f'unable to read result: {err}'
+        return report
+    for key in sorted(set(result) | set(expected)):
+        if key in ignore:
+            continue
+        if key not in result or key not in expected:
+            report['checks'][key] = {'passed': False, 'error': 'missing key'}
+        elif key == 'test_distribution':
+            report['checks'][key] = compare_distributions(result[key], expected[key], rtol=rtol, atol=atol,
+                                                          ks_tol=ks_tol)
+        else:
+            passed, max_diff = compare_values(result[key], expected[key], rtol=rtol, atol=atol)
+            report['checks'][key] = {'passed': passed, 'max_abs_diff': max_diff}
+    report['passed'] = all(check['passed'] for check in report['checks'].values())
+    return report
+
+
+def _compare_task(task):
+    return compare_result_files(*task[:2], **task[2])
+
+
+def check_results(results_dir, expected_dir, num_workers=None, **kwargs):
+    """ Compares all expected results against the results of a run
+
+    Args:
+        results_dir (str): directory with the results of the run
+        expected_dir (str): directory with the expected results
+        num_workers (int): number of processes; uses all cores if None
+        **kwargs: passed to compare_result_files, e.g., rtol, atol, ks_tol or ignore
+
+    Returns:
+        dict: report with the overall status and the comparison of each file
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    expected_files = sorted(glob.glob(os.path.join(expected_dir, '*.json')))
+    tasks = [(os.path.join(results_dir, os.path.basename(fname)), fname, kwargs) for fname in expected_files]
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(num_workers, len(tasks))) as pool:
+            files = pool.map(_compare_task, tasks)
+    else:
+        files = [_compare_task(task) for task in tasks]
+    expected_names = set(os.path.basename(fname) for fname in expected_files)
+    unexpected = sorted(os.path.basename(fname) for fname in glob.glob(os.path.join(results_dir, '*.json'))
+                        if os.path.basename(fname) not in expected_names)
+    return {
+        'passed': bool(files) and all(report['passed'] for report in files),
+        'results_dir': results_dir,
+        'expected_dir': expected_dir,
+        'num_files': len(files),
+        'num_failed': sum(not report['passed'] for report in files),
+        'unexpected_files': unexpected,
+        'files': files
+    }
+
+
+def print_report(report):
+    for file_report in report['files']:
+        status = 'ok' if file_report['passed'] else 'FAILED'
+        print(f'{status:<8}{file_report["file"]}')
+        if 'error' in file_report:
+            print(f'        {file_report["error"]}')
+        for key, check in file_report['checks'].items():
+            if not check['passed']:
+                details = ', '.join(f'{name}={value}' for name, value in check.items() if name != 'passed')
+                print(f'        {key}: {details}')
+    for fname in report['unexpected_files']:
+        print(f'{"extra":<8}{fname}')
+    print(f'{report["num_files"] - report["num_failed"]} of {report["num_files"]} results match the expected results.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares evaluation results against the expected results.')
+    parser.add_argument('--results', default='../results', help='directory with results (default: ../results)')
+    parser.add_argument('--expected', default='../expected_output/results',
+                        help='directory with expected results (default: ../expected_output/results)')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='relative tolerance (default: 1e-6)')
+    parser.add_argument('--atol', type=float, default=1e-9, help='absolute tolerance (default: 1e-9)')
+    parser.add_argument('--ks-tol', type=float, default=None,
+                        help='accept test distributions that differ element-wise if their KS distance is at most '
+                             'this value (default: element-wise comparison only)')
+    parser.add_argument('--ignore', nargs='*', default=[], help='keys that are not compared, e.g., obs_catalog_repr')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--report', default=None, help="write JSON report to this file; '-' writes to stdout")
+    args = parser.parse_args()
+    t0 = time.time()
+    report = check_results(args.results, args.expected, num_workers=args.jobs, rtol=args.rtol, atol=args.atol,
+                           ks_tol=args.ks_tol, ignore=tuple(args.ignore))
+    report['wall_time'] = time.time() - t0
+    if args.report == '-':
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        print('')
+    else:
+        print_report(report)
+        print(f'Checked results in {report["wall_time"]:.3f} seconds.')
+        if args.report is not None:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+    sys.exit(0 if report['passed'] else 1)
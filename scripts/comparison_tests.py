@@ -0,0 +1,292 @@
+"""
+ Paired T-test and W-test for all pairs of gridded forecasts.
+
+ csep.core.poisson_evaluations.paired_t_test and w_test compare one forecast against one benchmark, and each call bins
+ the observed catalog and extracts the rates of both forecasts at the observed events again. PairedComparisons
+ extracts the log-rates of every forecast at the observed events once, and computes the information gains, T
+ statistics and W statistics of all pairs of forecasts with array operations. The results are the same as pyCSEP's:
+
+     comparisons = PairedComparisons(forecasts, catalog)
+     t_test = comparisons.paired_t_test('ebel', 'helmstetter')   # same as poisson.paired_t_test(ebel, helmstetter, cat)
+     w_test = comparisons.w_test('ebel', 'helmstetter')          # same as poisson.w_test(ebel, helmstetter, cat)
+     matrices = comparisons.t_test_matrix()                      # statistics of all pairs as N x N arrays
+
+ The forecasts are binned on their own regions, so forecasts on different grids can be compared, but the catalog is
+ only binned once for each region and set of magnitude bins (see catalog_bins.py).
+
+ The matrices of the forecasts of an experiment can also be written to a JSON file:
+
+     python comparison_tests.py ../experiments/california.yml [--output ../results/cali_comparisons.json]
+"""
+# Python imports
+import argparse
+import json
+import os
+import warnings
+
+# 3rd party imports
+import numpy as np
+import scipy.stats
+
+# pycsep imports
+from csep import load_catalog
+from csep.models import EvaluationResult
+
+# local imports
+from catalog_bins import binned_catalog
+from experiment_utilities import load_experiment_config
+from forecast_registry import get_gridded_forecast
+
+
+def _count_ties(values):
+    """ Returns sum of t * (t**2 - 1) over groups of t equal non-zero values in each row of a 2d array """
+    num_rows, num_cols = values.shape
+    if num_cols == 0:
+        return np.zeros(num_rows)
+    values = np.sort(values, axis=1)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = values[:, 1:] != values[:, :-1]
+    group = np.cumsum(starts.ravel()) - 1
+    counts = np.bincount(group).astype(float)
+    rows = np.repeat(np.arange(num_rows), num_cols)[starts.ravel()]
+    nonzero = values.ravel()[starts.ravel()] != 0
+    return np.bincount(rows[nonzero], weights=(counts * (counts ** 2 - 1))[nonzero], minlength=num_rows)
+
+
+def _w_test_rows(x, m):
+    """ Wilcoxon signed-rank test of each row of x against the median m of the row
+
+    Same as csep.core.poisson_evaluations._w_test_ndarray applied to each row.
+
+    Args:
+        x (numpy.ndarray): paired differences, one row per test
+        m (numpy.ndarray): designated median of each row
+
+    Returns:
+        z_statistic (numpy.ndarray), probability (numpy.ndarray)
+    """
+    d = x - m[:, None]
+    nonzero = d != 0
+    count = nonzero.sum(axis=1)
+    if np.any(count < 10):
+        warnings.warn("Sample size too small for normal approximation.")
+    absd = np.abs(d)
+    # zeros are ranked first and excluded, so the ranks of the non-zero differences are shifted by the number of zeros
+    ranks = scipy.stats.rankdata(absd, axis=1) - (d.shape[1] - count)[:, None]
+    r_plus = np.sum((d > 0) * ranks, axis=1)
+    r_minus = np.sum((d < 0) * ranks, axis=1)
+    t = np.minimum(r_plus, r_minus)
+    mn = count * (count + 1.) * 0.25
+    se = count * (count + 1.) * (2. * count + 1.)
+    # correction for repeated ranks
+    se = se - 0.5 * _count_ties(absd)
+    se = np.sqrt(se / 24)
+    z = (t - mn) / se
+    prob = 2. * scipy.stats.distributions.norm.sf(np.abs(z))
+    return z, prob
+
+
+class PairedComparisons:
+    """ Compares every pair of gridded forecasts with the paired T-test and W-test
+
+    Args:
+        forecasts (list): :class:`csep.core.forecasts.GriddedForecast` with distinct names
+        catalog (:class:`csep.core.catalogs.CSEPCatalog`): observed catalog
+        scale (bool): if true, scale forecasted rates down to a single day, see paired_t_test
+    """
+
+    def __init__(self, forecasts, catalog, scale=False):
+        self.forecasts = list(forecasts)
+        self.names = [forecast.name for forecast in self.forecasts]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('The names of the forecasts must be distinct.')
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.catalog = catalog
+        self.n_obs = catalog.event_count
+        self.log_rates, self.event_counts = self._target_event_log_rates(scale)
+
+    def _target_event_log_rates(self, scale):
+        """ Returns log-rates of the forecasts at the observed events and the total rate of each forecast """
+        log_rates = np.empty((len(self.forecasts), self.n_obs))
+        event_counts = np.empty(len(self.forecasts))
+        # the catalog is binned once per grid, see catalog_bins.py
+        catalog = binned_catalog(self.catalog)
+        for i, forecast in enumerate(self.forecasts):
+            idx = catalog.spatial_index(forecast.region)
+            idm = catalog.magnitude_index(forecast.magnitudes)
+            if np.any(idm == -1):
+                raise ValueError("mags outside the range of forecast magnitudes.")
+            data = forecast.data
+            if scale:
+                data = data / (forecast.end_time - forecast.start_time).days
+            log_rates[i] = np.log(data[idx, idm])
+            event_counts[i] = np.sum(data)
+        return log_rates, event_counts
+
+    def _rows(self, names):
+        return list(range(len(self.names))) if names is None else [self.index[name] for name in names]
+
+    def t_test_matrix(self, alpha=0.05, forecasts=None, benchmarks=None):
+        """ Computes the paired T-test of each forecast against each benchmark
+
+        Args:
+            alpha (float): tolerance level for the type-i error rate of the statistical test
+            forecasts (list): names of the forecasts (rows); all forecasts if None
+            benchmarks (list): names of the benchmarks (columns); all forecasts if None
+
+        Returns:
+            dict: 'information_gain', 't_statistic', 'ig_lower' and 'ig_upper' as arrays with one row per forecast and
+                  one column per benchmark, and 't_critical'
+        """
+        rows, cols = self._rows(forecasts), self._rows(benchmarks)
+        N = self.n_obs
+        names = ('information_gain', 't_statistic', 'ig_lower', 'ig_upper')
+        out = {name: np.empty((len(rows), len(cols))) for name in names}
+        t_critical = scipy.stats.t.ppf(1 - (alpha / 2), N - 1)
+        benchmark_log_rates = self.log_rates[cols]
+        for k, i in enumerate(rows):
+            # differences of the log-rates against all benchmarks, summed in the same order as pyCSEP
+            diff = self.log_rates[i] - benchmark_log_rates
+            sum_diff = np.sum(diff, axis=1)
+            information_gain = (sum_diff - (self.event_counts[i] - self.event_counts[cols])) / N
+            first_term = (np.sum(np.power(diff, 2), axis=1)) / (N - 1)
+            second_term = np.power(sum_diff, 2) / (np.power(N, 2) - N)
+            forecast_std = np.sqrt(first_term - second_term)
+            out['information_gain'][k] = information_gain
+            out['t_statistic'][k] = information_gain / (forecast_std / np.sqrt(N))
+            out['ig_lower'][k] = information_gain - (t_critical * forecast_std / np.sqrt(N))
+            out['ig_upper'][k] = information_gain + (t_critical * forecast_std / np.sqrt(N))
+        out['t_critical'] = t_critical
+        return out
+
+    def w_test_matrix(self, forecasts=None, benchmarks=None):
+        """ Computes the W-test of each forecast against each benchmark
+
+        Args:
+            forecasts (list): names of the forecasts (rows); all forecasts if None
+            benchmarks (list): names of the benchmarks (columns); all forecasts if None
+
+        Returns:
+            dict: 'z_statistic' and 'probability' as arrays with one row per forecast and one column per benchmark
+        """
+        rows, cols = self._rows(forecasts), self._rows(benchmarks)
+        out = {name: np.empty((len(rows), len(cols))) for name in ('z_statistic', 'probability')}
+        benchmark_log_rates = self.log_rates[cols]
+        for k, i in enumerate(rows):
+            median = (self.event_counts[i] - self.event_counts[cols]) / self.n_obs
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out['z_statistic'][k], out['probability'][k] = _w_test_rows(self.log_rates[i] - benchmark_log_rates,
+                                                                            median)
+        return out
+
+    def paired_t_test(self, forecast, benchmark, alpha=0.05):
+        """ Returns the paired T-test of forecast against benchmark as returned by pyCSEP
+
+        Args:
+            forecast (str): name of the forecast
+            benchmark (str): name of the benchmark
+            alpha (float): tolerance level for the type-i error rate of the statistical test
+
+        Returns:
+            :class:`csep.models.EvaluationResult`
+        """
+        out = self.t_test_matrix(alpha=alpha, forecasts=[forecast], benchmarks=[benchmark])
+        result = EvaluationResult()
+        result.name = 'Paired T-Test'
+        result.test_distribution = (out['ig_lower'][0, 0], out['ig_upper'][0, 0])
+        result.observed_statistic = out['information_gain'][0, 0]
+        result.quantile = (out['t_statistic'][0, 0], out['t_critical'])
+        result.sim_name = (forecast, benchmark)
+        result.obs_name = self.catalog.name
+        result.status = 'normal'
+        result.min_mw = np.min(self.forecasts[self.index[forecast]].magnitudes)
+        return result
+
+    def w_test(self, forecast, benchmark):
+        """ Returns the W-test of forecast against benchmark as returned by pyCSEP
+
+        Args:
+            forecast (str): name of the forecast
+            benchmark (str): name of the benchmark
+
+        Returns:
+            :class:`csep.models.EvaluationResult`
+        """
+        out = self.w_test_matrix(forecasts=[forecast], benchmarks=[benchmark])
+        result = EvaluationResult()
+        result.name = 'W-Test'
+        result.test_distribution = 'normal'
+        result.observed_statistic = out['z_statistic'][0, 0]
+        result.quantile = out['probability'][0, 0]
+        result.sim_name = (forecast, benchmark)
+        result.obs_name = self.catalog.name
+        result.status = 'normal'
+        result.min_mw = np.min(self.forecasts[self.index[forecast]].magnitudes)
+        return result
+
+
+def lazy_comparisons(forecasts, catalog, scale=False):
+    """ Returns function that creates PairedComparisons on its first call and returns the same instance afterwards
+
+    Used with the cache of evaluation results (see result_cache.py), so that the catalog is only binned and the rates
+    are only extracted if a result is not cached:
+
+        get_comparisons = lazy_comparisons(forecasts, catalog)
+        cache.evaluate(lambda: get_comparisons().w_test(name, benchmark_name), 'w_test', [fore, benchmark], catalog)
+    """
+    comparisons = []
+
+    def get_comparisons():
+        if not comparisons:
+            comparisons.append(PairedComparisons(forecasts, catalog, scale=scale))
+        return comparisons[0]
+
+    return get_comparisons
+
+
+def compare_experiment(config_file, alpha=0.05):
+    """ Computes the paired T-tests and W-tests between all forecasts of an experiment
+
+    Args:
+        config_file (str): path to the experiment configuration
+        alpha (float): tolerance level for the type-i error rate of the T-test
+
+    Returns:
+        dict: names of the forecasts and the statistics of all pairs as nested lists; row i, column j compares forecast
+              i against forecast j
+    """
+    config = load_experiment_config(config_file)
+    catalog = load_catalog(config.evaluation_catalog, loader=config.catalog_loader)
+    forecasts = []
+    for name, path in config.forecasts.items():
+        fore = get_gridded_forecast(path, **config.forecast_options)
+        fore.start_time = config.start_time
+        fore.end_time = config.end_time
+        fore.name = name
+        forecasts.append(fore)
+    if config.min_magnitude == 'forecast':
+        catalog.filter(f'magnitude >= {max(fore.min_magnitude for fore in forecasts)}')
+    elif config.min_magnitude is not None:
+        catalog.filter(f'magnitude >= {config.min_magnitude}')
+    comparisons = PairedComparisons(forecasts, catalog)
+    out = {'experiment': config.name, 'forecasts': comparisons.names, 'n_obs': comparisons.n_obs}
+    for name, value in {**comparisons.t_test_matrix(alpha=alpha), **comparisons.w_test_matrix()}.items():
+        out[name] = np.asarray(value).tolist()
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares all pairs of forecasts of an experiment with the paired '
+                                                 'T-test and the W-test.')
+    parser.add_argument('config', help='experiment configuration')
+    parser.add_argument('--alpha', type=float, default=0.05, help='type-i error rate of the T-test (default: 0.05)')
+    parser.add_argument('--output', default=None,
+                        help='output file (default: ../results/<result_prefix>_comparisons.json)')
+    args = parser.parse_args()
+    matrices = compare_experiment(args.config, alpha=args.alpha)
+    fname = args.output or os.path.join('../results',
+                                        f'{load_experiment_config(args.config).result_prefix}_comparisons.json')
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(matrices, f, indent=4)
+    print(f'Wrote comparisons of {len(matrices["forecasts"])} forecasts to {fname}')
@@ -1,49 +1,401 @@
+# Python imports
+import argparse
+import hashlib
+import json
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 3rd party imports
 import requests
-import hashlib
-import argparse
 
 
-def check_hash(filename, checksum):
-    algorithm, value = checksum.split(':')
-    if not os.path.exists(filename):
-        return value, 'invalid'
+def hash_file(filename, algorithm, buffer_size=16*1024*1024):
+    """ Computes digest of file using large unbuffered reads into a reusable buffer """
     h = hashlib.new(algorithm)
-    with open(filename, 'rb') as f:
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
         while True:
-            data = f.read(4096)
-            if not data:
+            num_bytes = f.readinto(buffer)
+            if not num_bytes:
                 break
-            h.update(data)
-    digest = h.hexdigest()
+            h.update(view[:num_bytes])
+    return h.hexdigest()
+
+
+class ChecksumManifest:
+    """ Checksums of files that have been verified, along with the size and modification time of the files
+
+    A file whose size and modification time did not change since it was verified does not need to be hashed again.
+
+    Args:
+        filename (str): path to the manifest
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def is_verified(self, path, checksum):
+        """ Returns true if path was verified against checksum and has not changed since """
+        entry = self.entries.get(os.path.normpath(path))
+        if entry is None or entry['checksum'] != checksum:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def add(self, path, checksum):
+        """ Records that path matches checksum """
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[os.path.normpath(path)] = {
+                'checksum': checksum,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns
+            }
+            tmp_filename = f'{self.filename}.tmp-{os.getpid()}'
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.entries, f, indent=4, sort_keys=True)
+            os.replace(tmp_filename, self.filename)
+
+
+def check_hash(filename, checksum, manifest=None):
+    """ Computes digest of filename unless the manifest shows that the file was already verified
+
+    Returns:
+        value (str): expected digest, digest (str): digest of the file or 'invalid' if the file does not exist
+    """
+    algorithm, value = checksum.split(':')
+    if not os.path.exists(filename):
+        return value, 'invalid'
+    if manifest is not None and manifest.is_verified(filename, checksum):
+        return value, value
+    digest = hash_file(filename, algorithm)
+    if manifest is not None and digest == value:
+        manifest.add(filename, checksum)
     return value, digest
 
 
-def download_file(url, filename):
-    progress_bar_length = 72
-    block_size = 1024
-    r = requests.get(url, stream=True)
+class _PartialDownload:
+    """ Progress of a download into filename.part, stored in filename.part.json so that the download can be resumed
+
+    The file is split into segments that are downloaded with separate range requests. For each segment, the state
+    stores the start and stop offset and the number of bytes that have been written to the .part file.
+
+    Args:
+        url (str): url of the file
+        filename (str): final location of the file
+        size (int): size of the file in bytes
+        num_segments (int): number of segments used for a new download
+    """
+
+    def __init__(self, url, filename, size, num_segments):
+        self.url = url
+        self.filename = filename
+        self.size = size
+        self.part_filename = filename + '.part'
+        self.state_filename = filename + '.part.json'
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.segments = self._load_segments()
+        if self.segments is None:
+            bounds = [size * i // num_segments for i in range(num_segments + 1)]
+            self.segments = [[start, stop, 0] for start, stop in zip(bounds[:-1], bounds[1:])]
+            with open(self.part_filename, 'wb') as f:
+                f.truncate(size)
+            self.save(force=True)
+
+    def _load_segments(self):
+        """ Returns segments of a previous download of the same file or None """
+        if not os.path.exists(self.part_filename) or not os.path.exists(self.state_filename):
+            return None
+        try:
+            with open(self.state_filename, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('size') != self.size or os.path.getsize(self.part_filename) != self.size:
+            return None
+        return state['segments']
+
+    @property
+    def downloaded(self):
+        return sum(done for _, _, done in self.segments)
+
+    def contiguous_size(self):
+        """ Returns number of bytes at the start of the file that have been downloaded """
+        with self.lock:
+            for start, stop, done in self.segments:
+                if start + done < stop:
+                    return start + done
+        return self.size
+
+    def save(self, force=False):
+        """ Writes state to disk; at most once per second unless force is true """
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_save < 1.0:
+                return
+            tmp_filename = f'{self.state_filename}.tmp-{threading.get_ident()}'
+            with open(tmp_filename, 'w') as f:
+                json.dump({'url': self.url, 'size': self.size, 'segments': self.segments}, f)
+            os.replace(tmp_filename, self.state_filename)
+            self.last_save = now
+
+    def add(self, segment_id, num_bytes):
+        """ Records that num_bytes of the segment were written and flushed to the .part file """
+        with self.lock:
+            self.segments[segment_id][2] += num_bytes
+        self.save()
+
+    def finish(self):
+        """ Moves the complete .part file to its final location """
+        os.replace(self.part_filename, self.filename)
+        os.remove(self.state_filename)
+
+
+class _PrefixHasher(threading.Thread):
+    """ Hashes a .part file while it is downloaded
+
+    The segments are downloaded concurrently, so the thread hashes the contiguous part of the file that has been
+    downloaded so far. The data are read right after they were written and usually come from the page cache.
+
+    Args:
+        download (:class:`_PartialDownload`): download to hash
+        algorithm (str): name of hash algorithm, e.g., 'md5'
+        buffer_size (int): number of bytes read at once
+    """
+
+    def __init__(self, download, algorithm, buffer_size=8*1024*1024):
+        super().__init__(daemon=True)
+        self.download = download
+        self.hash = hashlib.new(algorithm)
+        self.buffer_size = buffer_size
+        self.offset = 0
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        try:
+            # unbuffered, because a buffered reader reads ahead past the contiguous part into bytes that other
+            # segments have not written yet and returns its stale copy of them later
+            with open(self.download.part_filename, 'rb', buffering=0) as f:
+                while self.offset < self.download.size and not self.stopped.is_set():
+                    available = self.download.contiguous_size() - self.offset
+                    if available <= 0:
+                        self.stopped.wait(0.05)
+                        continue
+                    num_bytes = f.readinto(view[:min(available, self.buffer_size)])
+                    if not num_bytes:
+                        raise IOError(f'Unexpected end of {self.download.part_filename} at byte {self.offset}')
+                    self.hash.update(view[:num_bytes])
+                    self.offset += num_bytes
+        except OSError as err:
+            self.error = err
+
+    def hexdigest(self):
+        """ Waits until the whole file is hashed and returns the digest """
+        self.join()
+        if self.error is not None:
+            raise self.error
+        if self.offset != self.download.size:
+            raise IOError(f'Hashing of {self.download.part_filename} stopped before the end of the file')
+        return self.hash.hexdigest()
+
+
+class _Progress:
+    """ Prints progress of a download at most every interval seconds """
+
+    def __init__(self, name, total_size, interval=5.0):
+        self.name = name
+        self.total_size = total_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_print = time.time()
+
+    def update(self, download_size, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_print < self.interval:
+                return
+            self.last_print = now
+        if self.total_size:
+            print(f'{self.name}: {download_size / 1024 ** 2:.1f} of {self.total_size / 1024 ** 2:.1f} MiB '
+                  f'({100 * download_size / self.total_size:.1f}%)', flush=True)
+        else:
+            print(f'{self.name}: {download_size / 1024 ** 2:.1f} MiB', flush=True)
+
+
+def probe_url(url, timeout=60):
+    """ Returns size of the file at url and whether the server supports range requests
+
+    Uses a request for the first byte of the file instead of HEAD, because not all servers answer HEAD requests.
+
+    Returns:
+        url (str): url after redirects, size (int or None), accept_ranges (bool)
+    """
+    r = requests.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=timeout)
     try:
-        total_size = int(r.headers.get('content-length'))
-    except TypeError:
-        total_size = None
+        r.raise_for_status()
+        if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+            size = r.headers['Content-Range'].rsplit('/', 1)[1]
+            if size != '*':
+                return r.url, int(size), True
+        try:
+            size = int(r.headers.get('content-length'))
+        except TypeError:
+            size = None
+        return r.url, size, False
+    finally:
+        r.close()
+
+
+def _download_segment(download, segment_id, chunk_size, progress, retries=5, timeout=60):
+    """ Downloads the missing part of a segment with range requests, retrying after connection errors """
+    for attempt in range(retries + 1):
+        start, stop, done = download.segments[segment_id]
+        if start + done >= stop:
+            return
+        try:
+            headers = {'Range': f'bytes={start + done}-{stop - 1}'}
+            with requests.get(download.url, headers=headers, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise IOError(f'Server ignored range request for {download.url}')
+                # the body is written at start + done, so a response with another range would corrupt the file
+                content_range = re.match(r'bytes (\d+)-\d+/', r.headers.get('Content-Range', ''))
+                if content_range is None or int(content_range.group(1)) != start + done:
+                    raise IOError(f'Server returned range {r.headers.get("Content-Range")} instead of '
+                                  f'{headers["Range"]} for {download.url}')
+                with open(download.part_filename, 'r+b') as f:
+                    f.seek(start + done)
+                    for data in r.iter_content(chunk_size=chunk_size):
+                        data = data[:stop - start - download.segments[segment_id][2]]
+                        f.write(data)
+                        f.flush()
+                        download.add(segment_id, len(data))
+                        progress.update(download.downloaded)
+            if download.segments[segment_id][2] < stop - start:
+                raise IOError(f'Connection closed before the end of the segment {start}-{stop}')
+            return
+        except (requests.RequestException, IOError) as err:
+            if attempt == retries:
+                raise
+            print(f'Retrying segment {start}-{stop} of {os.path.basename(download.filename)} after error: {err}',
+                  flush=True)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _download_stream(url, filename, chunk_size, progress, algorithm=None, timeout=60):
+    """ Downloads file with a single request into filename.part and returns its digest if algorithm is given """
+    part_filename = filename + '.part'
+    h = hashlib.new(algorithm) if algorithm is not None else None
     download_size = 0
+    with requests.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        with open(part_filename, 'wb') as f:
+            for data in r.iter_content(chunk_size=chunk_size):
+                download_size += len(data)
+                f.write(data)
+                if h is not None:
+                    h.update(data)
+                progress.update(download_size)
+    if progress.total_size and download_size != progress.total_size:
+        raise IOError(f'Expected {progress.total_size} bytes from {url}, but received {download_size}')
+    os.replace(part_filename, filename)
+    return h.hexdigest() if h is not None else None
+
+
+def download_file(url, filename, num_connections=4, chunk_size=8*1024*1024, min_segment_size=64*1024*1024,
+                  algorithm=None):
+    """ Downloads file using parallel range requests if the server supports them
+
+    The data are written into filename.part, which is moved to filename once the download is complete. If the server
+    supports range requests, files larger than min_segment_size are split into up to num_connections segments that
+    are downloaded concurrently, and an interrupted download resumes from the .part file.
+
+    Args:
+        url (str): url of file
+        filename (str): destination of file
+        num_connections (int): maximum number of concurrent range requests for this file
+        chunk_size (int): number of bytes read from the connection at once
+        min_segment_size (int): minimum number of bytes downloaded by a single range request
+        algorithm (str): if given, the file is hashed with this algorithm during the download
+
+    Returns:
+        str: digest of the file or None if algorithm is None
+    """
+    url, total_size, accept_ranges = probe_url(url)
+    name = os.path.basename(filename)
     if total_size:
-        print(f'Downloading file with size of {total_size / block_size:.3f} kB')
+        print(f'Downloading {name} with size of {total_size / 1024:.3f} kB')
+    else:
+        print(f'Downloading {name} with unknown size')
+    progress = _Progress(name, total_size)
+    digest = None
+    if not accept_ranges or not total_size:
+        digest = _download_stream(url, filename, chunk_size, progress, algorithm=algorithm)
     else:
-        print(f'Downloading file with unknown size')
-    with open(filename, 'wb') as f:
-        for data in r.iter_content(chunk_size=block_size):
-            download_size += len(data)
-            f.write(data)
-            # for progress bar
-            if total_size:
-                progress = int(progress_bar_length*download_size/total_size)
-                sys.stdout.write('\r[{}{}] {:.1f}%'.format('█'*progress, '.' * (progress_bar_length-progress),
-                    100*download_size/total_size))
-                sys.stdout.flush()
-        sys.stdout.write('\n')
+        num_segments = max(1, min(num_connections, total_size // min_segment_size))
+        download = _PartialDownload(url, filename, total_size, num_segments)
+        if download.downloaded:
+            print(f'Resuming download of {name} at {100 * download.downloaded / total_size:.1f}%')
+        pending = [idx for idx, (start, stop, done) in enumerate(download.segments) if start + done < stop]
+        hasher = None
+        if algorithm is not None:
+            hasher = _PrefixHasher(download, algorithm)
+            hasher.start()
+        try:
+            with ThreadPoolExecutor(max_workers=min(num_connections, len(pending) or 1)) as executor:
+                futures = [executor.submit(_download_segment, download, idx, chunk_size, progress) for idx in pending]
+                for future in futures:
+                    future.result()
+        finally:
+            # keep the latest progress for the next attempt
+            download.save(force=True)
+            if hasher is not None and download.contiguous_size() < total_size:
+                hasher.stopped.set()
+        if hasher is not None:
+            digest = hasher.hexdigest()
+        download.finish()
+    progress.update(total_size or os.path.getsize(filename), force=True)
+    return digest
+
+
+def download_files(downloads, num_jobs=4, num_connections=4):
+    """ Downloads several files concurrently and hashes them during the download
+
+    At most num_jobs files are downloaded at the same time, each with at most num_connections range requests.
+
+    Args:
+        downloads (list): (url, filename, algorithm) of each file; algorithm can be None
+        num_jobs (int): maximum number of files downloaded at the same time
+        num_connections (int): maximum number of range requests per file
+
+    Returns:
+        list: digest of each file
+    """
+    if not downloads:
+        return []
+    with ThreadPoolExecutor(max_workers=min(num_jobs, len(downloads))) as executor:
+        futures = [executor.submit(download_file, url, filename, num_connections=num_connections, algorithm=algorithm)
+                   for url, filename, algorithm in downloads]
+        return [future.result() for future in futures]
 
 
 def main():
@@ -97,6 +449,14 @@ def main():
     parser.add_argument("record_id", help="record id associated with zenodo data")
     parser.add_argument("--full", help="download full version of reproducibility package. default: false",
                         action='store_true')
+    parser.add_argument("--jobs", type=int, default=4, help="number of files downloaded at the same time. default: 4")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="number of parallel range requests for large files. default: 4")
+    parser.add_argument("--zenodo-url", default="https://zenodo.org",
+                        help="base url of the Zenodo API, e.g., a local mirror. default: https://zenodo.org")
+    parser.add_argument("--manifest", default=".download_manifest.json",
+                        help="file storing verified checksums with file size and modification time, so that "
+                             "unchanged files are not hashed again. default: .download_manifest.json")
     args = parser.parse_args()
 
     # This can be found in the DOI for the Zenodo record
@@ -106,11 +466,14 @@ def main():
     download_type = 'full' if args.full else 'light'
 
     # Grab the urls and filenames and checksums
-    r = requests.get(f"https://zenodo.org/api/records/{record_id}")
+    r = requests.get(f"{args.zenodo_url}/api/records/{record_id}")
     download_urls = [f['links']['self'] for f in r.json()['files']]
     filenames = [(f['key'], f['checksum']) for f in r.json()['files']]
 
-    # Download and verify checksums
+    # Find files that need to be downloaded
+    manifest = ChecksumManifest(args.manifest)
+    downloads = []
+    checksums = []
     for (fname, checksum), url in zip(filenames, download_urls):
         if not fname in file_manifest[download_type]:
             continue
@@ -120,18 +483,30 @@ def main():
         except FileExistsError:
             pass
         full_path = os.path.join(dir_map[fname], fname)
+        checksums.append((full_path, checksum))
         if os.path.exists(full_path):
             print(f'Found file {fname}, checking checksum to see if download is required.')
-            value, digest = check_hash(full_path, checksum)
+            value, digest = check_hash(full_path, checksum, manifest=manifest)
             if value != digest:
                 print(f"Checksum is different: re-downloading {fname} from Zenodo...")
-                download_file(url, full_path)
+                downloads.append((url, full_path, checksum))
         else:
             print(f"Downloading {fname} from Zenodo...")
-            download_file(url, full_path)
-        value, digest = check_hash(full_path, checksum)
+            downloads.append((url, full_path, checksum))
+
+    # Download files concurrently; the files are hashed during the download
+    digests = download_files([(url, full_path, checksum.split(':')[0]) for url, full_path, checksum in downloads],
+                             num_jobs=args.jobs, num_connections=args.connections)
+    for (url, full_path, checksum), digest in zip(downloads, digests):
+        if digest == checksum.split(':')[1]:
+            manifest.add(full_path, checksum)
+
+    # Verify checksums; only files that changed since they were verified are hashed again
+    for full_path, checksum in checksums:
+        value, digest = check_hash(full_path, checksum, manifest=manifest)
         if value != digest:
-            print("Error: Checksum does not match. Please contact wsavran [at] usc.edu for assistance.")
+            print(f"Error: Checksum of {full_path} does not match. "
+                  f"Please contact wsavran [at] usc.edu for assistance.")
             sys.exit(-1)
 
 
@@ -1,79 +1,137 @@
-from datetime import datetime
+import datetime
+import json
+import os
 
 import numpy as np
 
-from csep.utils.time_utils import (
-    strptime_to_utc_datetime,
-    strptime_to_utc_epoch,
-    datetime_to_utc_epoch
-)
+from csep.core.catalogs import CSEPCatalog
+from csep.utils.time_utils import strptime_to_utc_datetime
+
+try:
+    import yaml
+except ImportError:
+    try:
+        # provided by the conda environment
+        import ruamel_yaml as yaml
+    except ImportError:
+        yaml = None
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# experiment configurations shipped with the package
+EXPERIMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'experiments')
+
+# tests that can be listed in an experiment configuration
+SINGLE_FORECAST_TESTS = ('number_test', 'spatial_test', 'magnitude_test', 'likelihood_test',
+                         'conditional_likelihood_test')
+COMPARISON_TESTS = ('paired_t_test', 'w_test')
+
 
 class EvaluationConfig:
 
     def __init__(self):
+        self.name = None
+        self.result_prefix = None
         self.start_time = None
         self.end_time = None
         self.forecasts = {}
+        self.forecast_options = {}
         self.evaluation_catalog = None
         self.catalog_loader = None
+        self.min_magnitude = None
         self.seed = None
+        self.num_simulations = 1000
         self.t_test_benchmark = None
+        self.tests = []
+
+
+def _utc_epoch_millis(year, month, day, hour, minute, second=0, microsecond=0):
+    """ Vectorized version of csep.utils.time_utils.datetime_to_utc_epoch
+
+    Args:
+        year, month, day, hour, minute, second, microsecond (numpy.ndarray): integer components of UTC times
+
+    Returns:
+        numpy.ndarray: epoch times in milliseconds with the same rounding as datetime_to_utc_epoch
+    """
+    months = (np.asarray(year) - 1970).astype('datetime64[Y]') + (np.asarray(month) - 1).astype('timedelta64[M]')
+    days = months.astype('datetime64[D]') + (np.asarray(day) - 1).astype('timedelta64[D]')
+    seconds = days.astype(np.int64) * 86400 + np.asarray(hour) * 3600 + np.asarray(minute) * 60 + second
+    # datetime_to_utc_epoch computes the time in float seconds from integer microseconds and truncates the millis
+    total_seconds = (seconds * 1000000 + microsecond).astype(np.float64) / 1e6
+    return np.trunc(1000.0 * total_seconds).astype(np.int64)
 
 
-def load_california_catalog(filename):
-    """ Loads catalog as presented by Table 1 in Zechar et al., 2013 """
-    month_str_to_num = {
-        'Jan': 1,
-        'Feb': 2,
-        'Mar': 3,
-        'Apr': 4,
-        'May': 5,
-        'Jun': 6,
-        'Jul': 7,
-        'Aug': 8,
-        'Sep': 9,
-        'Oct': 10,
-        'Nov': 11,
-        'Dec': 12
-    }
-    eventlist = []
+def _make_catalog(event_id, origin_time, latitude, longitude, depth, magnitude, eventlist=False):
+    """ Arranges columns into structured array with CSEPCatalog.dtype or into list of tuples if eventlist is true """
+    if eventlist:
+        return list(zip(event_id.tolist(), origin_time.tolist(), latitude.tolist(), longitude.tolist(),
+                        depth.tolist(), magnitude.tolist()))
+    catalog = np.empty(len(origin_time), dtype=CSEPCatalog.dtype)
+    catalog['id'] = event_id
+    catalog['origin_time'] = origin_time
+    catalog['latitude'] = latitude
+    catalog['longitude'] = longitude
+    catalog['depth'] = depth
+    catalog['magnitude'] = magnitude
+    return catalog
+
+
+def load_california_catalog(filename, eventlist=False):
+    """ Loads catalog as presented by Table 1 in Zechar et al., 2013
+
+    Args:
+        filename (str): path to catalog file
+        eventlist (bool): if true, returns list of event tuples instead of structured array
+
+    Returns:
+        numpy.ndarray with CSEPCatalog.dtype or list of tuples
+    """
+    month_names = np.array(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+    # split hh:mm into separate columns, so the entire file can be parsed at once
     with open(filename, 'r') as f:
-        for line in f.readlines():
-            line = line.strip().split()
-            # event_id
-            event_id = line[0]
-            # day of month
-            day = line[1]
-            # month
-            month_str = line[2]
-            month = month_str_to_num[month_str]
-            # year
-            year = line[3]
-            # time string
-            time = line[4]
-            # create origin time
-            time_string = "{0}-{1}-{2} {3}".format(year, month, day, time)
-            origin_time = strptime_to_utc_epoch(time_string, format="%Y-%m-%d %H:%M")
-            # latitude
-            latitude = float(line[5])
-            # longitude
-            longitude = float(line[6])
-            # magnitude
-            magnitude = float(line[7])
-            # depth
-            depth = float(line[8])
-            event_tuple = (
-                event_id,
-                origin_time,
-                latitude,
-                longitude,
-                depth,
-                magnitude
-            )
-            eventlist.append(event_tuple)
-    return eventlist
-
-def load_italian_catalog(fname):
+        lines = f.read().replace(':', ' ').splitlines()
+    columns = np.loadtxt(lines, usecols=range(10), ndmin=1, dtype=[
+        ('event_id', 'S256'),
+        ('day', np.int64),
+        ('month', 'U3'),
+        ('year', np.int64),
+        ('hour', np.int64),
+        ('minute', np.int64),
+        ('latitude', np.float64),
+        ('longitude', np.float64),
+        ('magnitude', np.float64),
+        ('depth', np.float64)
+    ])
+    # month lookup
+    sort_idx = np.argsort(month_names)
+    pos = np.searchsorted(month_names, columns['month'], sorter=sort_idx) % len(month_names)
+    month_idx = sort_idx[pos]
+    unknown = month_names[month_idx] != columns['month']
+    if np.any(unknown):
+        raise KeyError(columns['month'][unknown][0])
+    origin_time = _utc_epoch_millis(columns['year'], month_idx + 1, columns['day'], columns['hour'], columns['minute'])
+    event_id = columns['event_id'].astype(str) if eventlist else columns['event_id']
+    return _make_catalog(event_id, origin_time, columns['latitude'], columns['longitude'],
+                         columns['depth'], columns['magnitude'], eventlist=eventlist)
+
+
+def load_italian_catalog(fname, eventlist=False):
+    """ Loads catalog as presented by Table S1 in Taroni et al., 2018
+
+    Args:
+        fname (str): path to catalog file
+        eventlist (bool): if true, returns list of event tuples instead of structured array
+
+    Returns:
+        numpy.ndarray with CSEPCatalog.dtype or list of tuples
+    """
     class ColumnIndex:
         Longitude = 0
         Latitude = 1
@@ -86,67 +144,110 @@ def load_italian_catalog(fname):
         Magnitude = 8
         Depth = 9
 
-    def parse_datetime(line):
-        year = int(line[ColumnIndex.DecimalYear])
-        month = int(line[ColumnIndex.Month])
-        day = int(line[ColumnIndex.Day])
-        hour = int(line[ColumnIndex.Hour])
-        minute = int(line[ColumnIndex.Minute])
-        decimal_second = line[ColumnIndex.Second]
-        seconds = int(np.floor(decimal_second))
-        microseconds = int((decimal_second - seconds) * 1e6)
-        dt = datetime(
-            year,
-            month,
-            day,
-            hour,
-            minute,
-            seconds,
-            microseconds
-        )
-        return dt
-
-    # arrange file into list of tuples
-    out = []
-    catalog_data = np.loadtxt(fname)
-    for event_id, line in enumerate(catalog_data):
-        event_tuple = ()
-        event_tuple = (
-            event_id,
-            datetime_to_utc_epoch(parse_datetime(line)),
-            line[ColumnIndex.Latitude],
-            line[ColumnIndex.Longitude],
-            line[ColumnIndex.Depth],
-            line[ColumnIndex.Magnitude],
-        )
-        out.append(event_tuple)
-    return out
+    catalog_data = np.loadtxt(fname, ndmin=2)
+    decimal_second = catalog_data[:, ColumnIndex.Second]
+    seconds = np.floor(decimal_second)
+    microseconds = ((decimal_second - seconds) * 1e6).astype(np.int64)
+    origin_time = _utc_epoch_millis(
+        catalog_data[:, ColumnIndex.DecimalYear].astype(np.int64),
+        catalog_data[:, ColumnIndex.Month].astype(np.int64),
+        catalog_data[:, ColumnIndex.Day].astype(np.int64),
+        catalog_data[:, ColumnIndex.Hour].astype(np.int64),
+        catalog_data[:, ColumnIndex.Minute].astype(np.int64),
+        seconds.astype(np.int64),
+        microseconds
+    )
+    return _make_catalog(np.arange(len(catalog_data)), origin_time, catalog_data[:, ColumnIndex.Latitude],
+                         catalog_data[:, ColumnIndex.Longitude], catalog_data[:, ColumnIndex.Depth],
+                         catalog_data[:, ColumnIndex.Magnitude], eventlist=eventlist)
 
-# configuration for california testing regions
-california_experiment = EvaluationConfig()
-california_experiment.start_time = strptime_to_utc_datetime('2006-01-01 00:00:00.0')
-california_experiment.end_time = strptime_to_utc_datetime('2011-01-01 00:00:00.0')
-california_experiment.evaluation_catalog = '../data/evaluation_catalog_zechar2013_merge.txt'
-california_experiment.catalog_loader = load_california_catalog
-california_experiment.forecasts = {
-    'helmstetter': '../forecasts/helmstetter_et_al.hkj.aftershock-fromXML.dat',
-    'bird_liu': '../forecasts/bird_liu.neokinema-fromXML.dat',
-    'ebel': '../forecasts/ebel.aftershock.corrected-fromXML.dat'
-}
-california_experiment.seed = 123456
-california_experiment.t_test_benchmark = 'helmstetter'
 
-# configuration for italian testing region
-italy_experiment = EvaluationConfig()
-italy_experiment.start_time = strptime_to_utc_datetime('2010-01-01 00:00:00.0')
-italy_experiment.end_time = strptime_to_utc_datetime('2015-01-01 00:00:00.0')
-italy_experiment.evaluation_catalog = '../data/SRL_2018031_esupp_Table_S1.txt'
-italy_experiment.catalog_loader = load_italian_catalog
-italy_experiment.forecasts = {
-    'lombardi': '../forecasts/lombardi.DBM.italy.5yr.2010-01-01.dat',
-    'meletti': '../forecasts/meletti.MPS04.italy.5yr.2010-01-01.dat',
-    'werner-m1': '../forecasts/werner.HiResSmoSeis-m1.italy.5yr.2010-01-01.dat'
+# catalog loaders that can be named in an experiment configuration
+CATALOG_LOADERS = {
+    'load_california_catalog': load_california_catalog,
+    'load_italian_catalog': load_italian_catalog
 }
-italy_experiment.seed = 123456
-italy_experiment.t_test_benchmark = 'meletti'
 
+
+def read_config_file(fname):
+    """ Reads YAML (.yml, .yaml), TOML (.toml) or JSON (.json) file into a dictionary """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.yml', '.yaml'):
+        if yaml is None:
+            raise ImportError('Reading YAML files requires PyYAML or ruamel.yaml.')
+        with open(fname, 'r') as f:
+            return yaml.safe_load(f)
+    if ext == '.toml':
+        if tomllib is None:
+            raise ImportError('Reading TOML files requires Python 3.11 or tomli.')
+        with open(fname, 'rb') as f:
+            return tomllib.load(f)
+    if ext == '.json':
+        with open(fname, 'r') as f:
+            return json.load(f)
+    raise ValueError(f'Unknown format of configuration file {fname}. Use .yml, .yaml, .toml or .json.')
+
+
+def _to_utc_datetime(value):
+    """ Converts strings and naive datetimes parsed from YAML or TOML into time-zone aware datetimes in UTC """
+    if isinstance(value, str):
+        return strptime_to_utc_datetime(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc)
+    raise ValueError(f'Unable to convert {value!r} into datetime.')
+
+
+def load_experiment_config(fname):
+    """ Loads experiment configuration from YAML, TOML or JSON file
+
+    Relative paths of the catalog and the forecasts are relative to the directory of the configuration file. See
+    experiments/italy.yml for the available keys.
+
+    Args:
+        fname (str): path to configuration file
+
+    Returns:
+        :class:`EvaluationConfig`
+    """
+    adict = read_config_file(fname)
+    base_dir = os.path.dirname(os.path.abspath(fname))
+
+    def resolve(path):
+        return os.path.normpath(os.path.join(base_dir, path))
+
+    config = EvaluationConfig()
+    config.name = adict.get('name', os.path.splitext(os.path.basename(fname))[0])
+    config.result_prefix = adict.get('result_prefix', config.name)
+    config.start_time = _to_utc_datetime(adict['start_time'])
+    config.end_time = _to_utc_datetime(adict['end_time'])
+    config.forecasts = {name: resolve(path) for name, path in adict['forecasts'].items()}
+    config.forecast_options = dict(adict.get('forecast_options', {}))
+    catalog = adict['catalog']
+    config.evaluation_catalog = resolve(catalog['path'])
+    loader = catalog.get('loader')
+    if loader is not None and loader not in CATALOG_LOADERS:
+        raise ValueError(f'Unknown catalog loader {loader!r} in {fname}. Choose from {list(CATALOG_LOADERS)}.')
+    config.catalog_loader = CATALOG_LOADERS.get(loader)
+    config.min_magnitude = catalog.get('min_magnitude')
+    if config.min_magnitude not in (None, 'forecast') and not isinstance(config.min_magnitude, (int, float)):
+        raise ValueError(f"min_magnitude must be a number or 'forecast', not {config.min_magnitude!r}.")
+    config.seed = adict.get('seed')
+    config.num_simulations = adict.get('num_simulations', config.num_simulations)
+    config.t_test_benchmark = adict.get('benchmark')
+    config.tests = list(adict.get('tests', []))
+    for test in config.tests:
+        if test not in SINGLE_FORECAST_TESTS + COMPARISON_TESTS:
+            raise ValueError(f'Unknown test {test!r} in {fname}. '
+                             f'Choose from {SINGLE_FORECAST_TESTS + COMPARISON_TESTS}.')
+        if test in COMPARISON_TESTS and config.t_test_benchmark not in config.forecasts:
+            raise ValueError(f'{test} requires benchmark to name one of the forecasts in {fname}.')
+    return config
+
+
+# configuration for california testing regions
+california_experiment = load_experiment_config(os.path.join(EXPERIMENTS_DIR, 'california.yml'))
+
+# configuration for italian testing region
+italy_experiment = load_experiment_config(os.path.join(EXPERIMENTS_DIR, 'italy.yml'))
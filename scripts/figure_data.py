@@ -0,0 +1,183 @@
+"""
+ Store of the data drawn by the figures.
+
+ The figures store the forecasts, catalogs and arrays they draw in results/figure_data/<figure>, so that they can be
+ drawn again without computing them, e.g., to change the resolution or the style of a figure (see the render_only
+ argument of the main() function of the figures). Evaluation results are not stored here, because Fig. 4, Fig. 5 and
+ Fig. 6 read them from the results directory.
+
+ Layout (one directory per figure and one entry per key):
+     <key>/rates.npy, <key>/region.npz, <key>/forecast.json   gridded forecast, see gridded_cache.py
+     <key>/events.npy, <key>/region.npz, <key>/catalog.json   catalog, the region is omitted if the catalog has none
+     <key>/region.npz                                         spatial region
+     <key>.npz                                                arrays
+
+ The files are replaced when a figure is created again.
+
+ Typical usage:
+
+     data = FigureData('figure7')
+     data.save_arrays('rate_ratio', rate_diff=rate_diff)
+     ...
+     rate_diff = data.load_arrays('rate_ratio')['rate_diff']
+"""
+# Python imports
+import argparse
+import json
+import os
+import shutil
+
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+from csep.core.catalogs import CSEPCatalog, UCERF3Catalog
+from csep.utils.time_utils import datetime_to_utc_epoch, epoch_time_to_utc_datetime
+
+# local imports
+from gridded_cache import read_gridded_cache, read_region, write_region
+
+DEFAULT_DATA_DIR = '../results/figure_data'
+
+# catalog classes that can be stored, keyed by class name
+CATALOG_CLASSES = {cls.__name__: cls for cls in (CSEPCatalog, UCERF3Catalog)}
+
+
+def render_arguments(description):
+    """ Returns parser of the command line arguments shared by the figures """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--render-only', action='store_true',
+                        help='draw the figure from the data stored by an earlier run instead of computing it')
+    parser.add_argument('--dpi', type=int, default=300, help='resolution of the figure (default: 300)')
+    return parser
+
+
+def _to_epoch(time):
+    return datetime_to_utc_epoch(time) if time is not None else None
+
+
+def _to_datetime(epoch):
+    return epoch_time_to_utc_datetime(epoch) if epoch is not None else None
+
+
+def _write_region(fname, region):
+    """ Writes region along with the magnitude bins of space-magnitude regions """
+    write_region(fname, region, magnitudes=getattr(region, 'magnitudes', None))
+
+
+def _read_region(fname):
+    region, magnitudes = read_region(fname)
+    if magnitudes is not None:
+        region.magnitudes = magnitudes
+    return region
+
+
+class FigureData:
+    """ Stores the data drawn by a figure
+
+    Args:
+        figure (str): name of the figure, e.g., 'figure3'
+        data_dir (str): root directory of the store
+    """
+
+    def __init__(self, figure, data_dir=DEFAULT_DATA_DIR):
+        self.figure = figure
+        self.data_dir = data_dir
+
+    def path(self, key):
+        """ Returns path of the entry stored under key """
+        return os.path.join(self.data_dir, self.figure, key)
+
+    def _write_dir(self, key, write):
+        """ Calls write with a temporary directory that replaces the entry of key once complete """
+        entry_dir = self.path(key)
+        tmp_dir = f'{entry_dir}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            write(tmp_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+    def _check(self, fname):
+        if not os.path.exists(fname):
+            raise FileNotFoundError(f'{fname} not found. Create {self.figure} without render_only first.')
+
+    def save_forecast(self, key, forecast):
+        """ Stores gridded forecast, e.g., the expected rates of a catalog-based forecast """
+
+        def write(entry_dir):
+            # same files as the cache of gridded forecasts, so that read_gridded_cache can load them
+            np.save(os.path.join(entry_dir, 'rates.npy'), forecast.data)
+            write_region(os.path.join(entry_dir, 'region.npz'), forecast.region, magnitudes=forecast.magnitudes)
+            with open(os.path.join(entry_dir, 'forecast.json'), 'w') as f:
+                json.dump({'name': forecast.name,
+                           'start_time': _to_epoch(forecast.start_time),
+                           'end_time': _to_epoch(forecast.end_time)}, f, indent=4)
+
+        self._write_dir(key, write)
+
+    def load_forecast(self, key):
+        """ Returns gridded forecast stored with save_forecast """
+        fname = os.path.join(self.path(key), 'forecast.json')
+        self._check(fname)
+        with open(fname, 'r') as f:
+            meta = json.load(f)
+        return read_gridded_cache(self.path(key), _to_datetime(meta['start_time']), _to_datetime(meta['end_time']),
+                                  meta['name'])
+
+    def save_catalog(self, key, catalog):
+        """ Stores events, name and region of a catalog """
+        if type(catalog).__name__ not in CATALOG_CLASSES:
+            raise TypeError(f'Unable to store catalogs of type {type(catalog).__name__}.')
+
+        def write(entry_dir):
+            np.save(os.path.join(entry_dir, 'events.npy'), catalog.data)
+            # the JSON format of pycsep does not keep the mask of the region, so the region is stored separately
+            if catalog.region is not None:
+                _write_region(os.path.join(entry_dir, 'region.npz'), catalog.region)
+            with open(os.path.join(entry_dir, 'catalog.json'), 'w') as f:
+                json.dump({'class': type(catalog).__name__, 'name': catalog.name}, f, indent=4)
+
+        self._write_dir(key, write)
+
+    def load_catalog(self, key):
+        """ Returns catalog stored with save_catalog """
+        fname = os.path.join(self.path(key), 'catalog.json')
+        self._check(fname)
+        with open(fname, 'r') as f:
+            meta = json.load(f)
+        region = None
+        region_fname = os.path.join(self.path(key), 'region.npz')
+        if os.path.exists(region_fname):
+            region = _read_region(region_fname)
+        events = np.load(os.path.join(self.path(key), 'events.npy'))
+        return CATALOG_CLASSES[meta['class']](data=events, name=meta['name'], region=region)
+
+    def save_region(self, key, region):
+        """ Stores spatial region """
+        self._write_dir(key, lambda entry_dir: _write_region(os.path.join(entry_dir, 'region.npz'), region))
+
+    def load_region(self, key):
+        """ Returns spatial region stored with save_region """
+        fname = os.path.join(self.path(key), 'region.npz')
+        self._check(fname)
+        return _read_region(fname)
+
+    def save_arrays(self, key, **arrays):
+        """ Stores named arrays """
+        fname = self.path(key) + '.npz'
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = f'{self.path(key)}.tmp-{os.getpid()}.npz'
+        np.savez(tmp_fname, **arrays)
+        os.replace(tmp_fname, fname)
+
+    def load_arrays(self, key):
+        """ Returns dictionary of the arrays stored with save_arrays """
+        fname = self.path(key) + '.npz'
+        self._check(fname)
+        with np.load(fname) as npz:
+            return {name: npz[name] for name in npz.files}
@@ -0,0 +1,59 @@
+"""
+ In-process registry of gridded forecasts.
+
+ The figures load the same ASCII forecasts several times when plot_all.py runs them in a single process. The registry
+ parses each forecast once and hands out shallow copies, so each script can set name, start_time, end_time or scale
+ on its own copy. The rates and the region are shared between copies. The rates are marked read-only, so modifying
+ them in place raises an error instead of changing the forecast used by other scripts.
+
+ Typical usage:
+
+     fore = get_gridded_forecast(path, swap_latlon=True)
+     fore.name = 'meletti'
+"""
+# Python imports
+import copy
+import os
+
+# pycsep imports
+from csep import load_gridded_forecast
+
+# local imports
+from gridded_cache import load_cached_gridded_forecast
+
+# loaded forecasts keyed by path, modification time and loader arguments
+_forecasts = {}
+
+
+def _forecast_key(path, kwargs):
+    path = os.path.abspath(path)
+    return path, os.stat(path).st_mtime_ns, tuple(sorted(kwargs.items()))
+
+
+def get_gridded_forecast(path, **kwargs):
+    """ Returns gridded forecast from path, parsing the file only the first time it is requested
+
+    Forecasts in the CSEP1 ASCII format are read through the binary cache in gridded_cache.py.
+
+    Args:
+        path (str): path to forecast file
+        **kwargs: passed to the loader, e.g., swap_latlon
+
+    Returns:
+        :class:`csep.core.forecasts.GriddedForecast`: shallow copy of the registered forecast
+    """
+    key = _forecast_key(path, kwargs)
+    forecast = _forecasts.get(key)
+    if forecast is None:
+        if path.endswith('.dat'):
+            forecast = load_cached_gridded_forecast(path, **kwargs)
+        else:
+            forecast = load_gridded_forecast(path, **kwargs)
+        forecast._data.setflags(write=False)
+        _forecasts[key] = forecast
+    return copy.copy(forecast)
+
+
+def clear():
+    """ Removes all forecasts from the registry """
+    _forecasts.clear()
@@ -0,0 +1,123 @@
+"""
+ On-disk cache of gridded forecasts stored in the CSEP1 ASCII format.
+
+ Parsing the ASCII forecasts with numpy.loadtxt is the most expensive step of the figures using gridded forecasts. The
+ first time a forecast is loaded, the rates are written to a .npy file and the cell bounding boxes, cell mask and
+ magnitude bins to a sidecar .npz file. Later loads memory-map the rates and rebuild the region from the sidecar.
+
+ The cache is stored in cache/gridded next to the forecast file, in one directory per cache key. The key is computed
+ from the contents of the forecast file and the swap_latlon flag, so the cache is invalidated when the file changes.
+"""
+# Python imports
+import hashlib
+import os
+import shutil
+
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+import csep
+from csep.core.forecasts import GriddedForecast
+from csep.core.regions import CartesianGrid2D
+from csep.models import Polygon
+
+# bump this if the layout of the cache changes
+CACHE_VERSION = 1
+
+
+def gridded_cache_key(fname, swap_latlon=False, chunk_size=16*1024*1024):
+    """ Computes cache key from the contents of the forecast file and the loader arguments """
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    h.update(f'{CACHE_VERSION}:{csep.__version__}:{bool(swap_latlon)}'.encode())
+    return h.hexdigest()
+
+
+def write_region(fname, region, magnitudes=None):
+    """ Writes cell bounding boxes, cell mask, spacing and magnitude bins of a region into a .npz file """
+    arrays = {
+        'bboxes': np.array([polygon.points for polygon in region.polygons]),
+        'poly_mask': region.poly_mask,
+        'dh': region.dh
+    }
+    if magnitudes is not None:
+        arrays['magnitudes'] = magnitudes
+    np.savez(fname, **arrays)
+
+
+def read_region(fname):
+    """ Reads region written by write_region
+
+    Returns:
+        region (CartesianGrid2D): spatial region
+        magnitudes (numpy.ndarray): magnitude bins or None
+    """
+    with np.load(fname) as sidecar:
+        polygons = [Polygon(tuple(map(tuple, bbox))) for bbox in sidecar['bboxes']]
+        region = CartesianGrid2D(polygons, float(sidecar['dh']), mask=sidecar['poly_mask'])
+        magnitudes = sidecar['magnitudes'] if 'magnitudes' in sidecar else None
+    return region, magnitudes
+
+
+def write_gridded_cache(forecast, cache_dir):
+    """ Writes rates and region of forecast into cache_dir
+
+    The files are written into a temporary directory that is moved into place once complete.
+    """
+    tmp_dir = f'{cache_dir}.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        np.save(os.path.join(tmp_dir, 'rates.npy'), forecast._data)
+        write_region(os.path.join(tmp_dir, 'region.npz'), forecast.region, magnitudes=forecast.magnitudes)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # another process finished the same cache first
+        if not os.path.exists(cache_dir):
+            raise
+        shutil.rmtree(tmp_dir)
+
+
+def read_gridded_cache(cache_dir, start_date=None, end_date=None, name=None):
+    """ Creates forecast from cache_dir with memory-mapped rates
+
+    Returns:
+        :class:`csep.core.forecasts.GriddedForecast`
+    """
+    rates = np.load(os.path.join(cache_dir, 'rates.npy'), mmap_mode='r')
+    region, magnitudes = read_region(os.path.join(cache_dir, 'region.npz'))
+    return GriddedForecast(start_date, end_date, magnitudes=magnitudes, name=name, region=region, data=rates)
+
+
+def load_cached_gridded_forecast(fname, start_date=None, end_date=None, name=None, swap_latlon=False,
+                                 cache_dir=None):
+    """ Loads CSEP1 ASCII forecast using the binary cache
+
+    Same as csep.load_gridded_forecast for .dat files, but parses the ASCII file only if the cache is missing.
+
+    Args:
+        fname (str): path to forecast in CSEP1 ASCII format
+        start_date (datetime.datetime): start time of forecast
+        end_date (datetime.datetime): end time of forecast
+        name (str): name of forecast; defaults to the filename without extension
+        swap_latlon (bool): if true, reads forecast spatial cells as lat_0, lat_1, lon_0, lon_1
+        cache_dir (str): root directory of the cache; defaults to cache/gridded next to the forecast file
+
+    Returns:
+        :class:`csep.core.forecasts.GriddedForecast`
+    """
+    if name is None:
+        name = os.path.basename(fname[:-4])
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fname)), 'cache', 'gridded')
+    key_dir = os.path.join(cache_dir, gridded_cache_key(fname, swap_latlon=swap_latlon))
+    if not os.path.exists(key_dir):
+        forecast = GriddedForecast.load_ascii(fname, swap_latlon=swap_latlon)
+        write_gridded_cache(forecast, key_dir)
+    return read_gridded_cache(key_dir, start_date=start_date, end_date=end_date, name=name)
@@ -71,17 +71,63 @@
              - '../forecasts/werner.HiResSmoSeis-m1.italy.5yr.2010-01-01.dat'
          Outputs:
              - '../figures/figure7.png'
+
+ Usage:
+
+     python plot_all.py [--jobs N] [--render-only] [--dpi DPI] [--offline-basemaps] [--trace FILE] [--profile-dir DIR]
+
+ With --jobs N, up to N figures are created at the same time, each in its own process. The output of each figure is
+ written to '../results/logs/<figure>.log' and the wall time and peak memory of each figure are reported at the end.
+
+ With --render-only, Fig. 3 to Fig. 7 are drawn from the evaluation results in '../results' and the data stored in
+ '../results/figure_data' by an earlier run (see figure_data.py), e.g., to change the resolution with --dpi. Fig. 2
+ is created as usual.
+
+ The basemap tiles of the maps are read from a local cache and only downloaded if they are missing (see
+ tile_cache.py). With --offline-basemaps, no tiles are downloaded and missing tiles are drawn blank; download the tiles
+ beforehand with 'python tile_cache.py seed'.
+
+ With --trace FILE, the wall time, CPU time and peak memory of each stage of the figures (see timing.py) are written to
+ FILE as JSON, or as CSV if FILE ends with .csv. With --profile-dir DIR, each figure is also profiled with cProfile and
+ the statistics are written to DIR.
 """
 
+import argparse
+import contextlib
+import importlib
+import multiprocessing
 import os
+import queue
 import time
+import traceback
+
+# the figures, pyCSEP and cartopy are imported when a figure is created, so that starting this script, e.g., to check
+# the data or to create the figures in separate processes, takes a fraction of a second (see startup_benchmark.py)
+from results_io import RESULT_FORMATS
+from timing import configure, get_peak_rss, get_records, stage, write_trace
+
+# figures in the order of the manuscript along with the version of the package they require
+figure_tasks = [
+    ('figure2', 'light'),
+    ('figure3', 'full'),
+    ('figure4', 'light'),
+    ('figure5', 'light'),
+    ('figure6', 'full'),
+    ('figure7', 'light')
+]
+
+# figures that read catalogs or simulate catalogs with their own pool of processes
+multiprocess_figures = ('figure3', 'figure4', 'figure6')
+
+# figures that write evaluation results
+result_figures = ('figure4', 'figure5', 'figure6')
+
+# figures that reuse evaluation results of earlier runs with the same inputs
+cached_figures = ('figure4', 'figure5')
+
+# figures that can be drawn from the results and data stored by an earlier run (see figure_data.py)
+rendered_figures = ('figure3', 'figure4', 'figure5', 'figure6', 'figure7')
 
-import plot_figure2
-import plot_figure3
-import plot_figure4
-import plot_figure5
-import plot_figure6
-import plot_figure7
 
 def verify_file_manifest():
     """ Checks directories for data and forecasts to determine which version of the reproducibility package to run.
@@ -133,7 +179,18 @@ def verify_file_manifest():
     return output
 
 
-def main(version):
+def figure_main(name):
+    """ Imports the script of a figure and returns its main() function """
+    return importlib.import_module(f'plot_{name}').main
+
+
+def configure_basemaps(offline=False):
+    """ Configures the tile cache of the basemaps, see tile_cache.configure """
+    from tile_cache import configure as configure_tile_cache
+    configure_tile_cache(offline=offline)
+
+
+def main(version, result_format='json', use_result_cache=True, render_only=False, dpi=300):
 
     print(f'\n\nRunning {version} version of the reproducibility package. See README.md for more information.')
     print('=========================================================================================')
@@ -141,45 +198,208 @@ def main(version):
     print('')
     print('Generating Fig. 2')
     print('=================')
-    plot_figure2.main()
+    with stage('figure2'):
+        figure_main('figure2')()
 
-    if ver == 'full':
+    if version == 'full':
         print('')
         print('Generating Fig. 3')
         print('=================')
-        plot_figure3.main()
+        with stage('figure3'):
+            figure_main('figure3')(render_only=render_only, dpi=dpi)
     else:
         print("Skipping Fig. 3. See README for more information.")
 
     print('')
     print('Generating Fig. 4')
     print('=================')
-    plot_figure4.main()
+    with stage('figure4'):
+        figure_main('figure4')(result_format=result_format, use_result_cache=use_result_cache,
+                               render_only=render_only, dpi=dpi)
 
 
     print('')
     print('Generating Fig. 5')
     print('=================')
-    plot_figure5.main()
+    with stage('figure5'):
+        figure_main('figure5')(result_format=result_format, use_result_cache=use_result_cache,
+                               render_only=render_only, dpi=dpi)
     
     
-    if ver == 'full':
+    if version == 'full':
         print('')
         print('Generating Fig. 6')
         print('=================')
-        plot_figure6.main()
+        with stage('figure6'):
+            figure_main('figure6')(result_format=result_format, render_only=render_only, dpi=dpi)
     else:
         print("Skipping Fig. 6. See README for more information.")
 
     print('')
     print('Generating Fig. 7')
     print('=================')
-    plot_figure7.main()
+    with stage('figure7'):
+        figure_main('figure7')(render_only=render_only, dpi=dpi)
+
+
+def run_figure(name, kwargs, log_dir, profile_dir=None, offline_basemaps=False):
+    """ Creates a single figure with its output redirected into a log file
+
+    Args:
+        name (str): name of the figure, e.g., 'figure2'
+        kwargs (dict): passed to the main() function of the figure
+        log_dir (str): directory of the log file
+        profile_dir (str): if not None, the figure is profiled with cProfile and the statistics are written to this
+                           directory
+        offline_basemaps (bool): draw basemaps only from the tile cache without network access (see tile_cache.py)
+
+    Returns:
+        dict: name, status, wall time, peak memory, log file and timing records of the figure
+    """
+    configure(profile_dir=profile_dir)
+    configure_basemaps(offline=offline_basemaps)
+    log_file = os.path.join(log_dir, f'{name}.log')
+    status = 'done'
+    t0 = time.time()
+    with open(log_file, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            with stage(name):
+                figure_main(name)(**kwargs)
+        except Exception:
+            traceback.print_exc()
+            status = 'failed'
+    t1 = time.time()
+    return {'name': name, 'status': status, 'wall_time': t1 - t0, 'peak_rss': get_peak_rss(), 'log_file': log_file,
+            'trace': get_records()}
+
+
+def _run_figure_process(name, kwargs, log_dir, profile_dir, offline_basemaps, results):
+    results.put(run_figure(name, kwargs, log_dir, profile_dir=profile_dir, offline_basemaps=offline_basemaps))
+
+
+def print_summary(results):
+    print('')
+    print(f'{"figure":<10}{"status":<10}{"wall time (s)":>15}{"peak RSS (MiB)":>16}  log file')
+    for result in results:
+        peak_rss = f'{result["peak_rss"]:.1f}' if result['peak_rss'] is not None else 'n/a'
+        print(f'{result["name"]:<10}{result["status"]:<10}{result["wall_time"]:>15.3f}{peak_rss:>16}  '
+              f'{result["log_file"]}')
+
+
+def main_parallel(version, jobs, log_dir='../results/logs', result_format='json', profile_dir=None,
+                  use_result_cache=True, render_only=False, dpi=300, offline_basemaps=False):
+    """ Creates the figures concurrently using up to jobs processes
+
+    Each figure runs in a new process, so that the memory reported for each figure only includes this figure. The
+    figures that use a pool of processes share the cores with the other figures.
+
+    Args:
+        version (str): 'full' or 'light'
+        jobs (int): maximum number of figures created at the same time
+        log_dir (str): directory for the log files of the figures
+        result_format (str): format of the evaluation results, 'json' or 'npy' (see results_io.py)
+        profile_dir (str): if not None, each figure is profiled with cProfile and the statistics are written to this
+                           directory
+        use_result_cache (bool): reuse evaluation results of earlier runs with the same inputs (see result_cache.py)
+        render_only (bool): draw the figures in rendered_figures from the results and data stored by an earlier run
+        dpi (int): resolution of the figures in rendered_figures
+        offline_basemaps (bool): draw basemaps only from the tile cache without network access (see tile_cache.py)
+
+    Returns:
+        list: result of each figure, see run_figure()
+    """
+    print(f'\n\nRunning {version} version of the reproducibility package using {jobs} processes. '
+          f'See README.md for more information.')
+    print('=========================================================================================')
+    os.makedirs(log_dir, exist_ok=True)
+    pending = []
+    for name, required_version in figure_tasks:
+        if required_version == 'full' and version != 'full':
+            print(f"Skipping {name}. See README for more information.")
+            continue
+        kwargs = {}
+        if name in multiprocess_figures:
+            kwargs['num_workers'] = max(1, os.cpu_count() // jobs)
+        if name in result_figures:
+            kwargs['result_format'] = result_format
+        if name in cached_figures:
+            kwargs['use_result_cache'] = use_result_cache
+        if name in rendered_figures:
+            kwargs['render_only'] = render_only
+            kwargs['dpi'] = dpi
+        pending.append((name, kwargs))
+    order = [name for name, _ in pending]
+
+    results = multiprocessing.Queue()
+    running = {}
+    finished = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            name, kwargs = pending.pop(0)
+            # figures are not run in a multiprocessing.Pool, because daemon processes cannot create their own pool
+            process = multiprocessing.Process(target=_run_figure_process,
+                                              args=(name, kwargs, log_dir, profile_dir, offline_basemaps, results),
+                                              name=name)
+            process.start()
+            running[name] = process
+            print(f'Started {name}, writing output to {os.path.join(log_dir, name + ".log")}', flush=True)
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            # catch processes that exited without reporting a result, e.g., killed by the OOM killer. processes that
+            # exit normally always put their result into the queue first.
+            for name, process in list(running.items()):
+                if not process.is_alive() and process.exitcode != 0:
+                    process.join()
+                    running.pop(name)
+                    finished[name] = {'name': name, 'status': f'exit {process.exitcode}', 'wall_time': float('nan'),
+                                      'peak_rss': None, 'log_file': os.path.join(log_dir, f'{name}.log'),
+                                      'trace': []}
+            continue
+        running.pop(result['name']).join()
+        finished[result['name']] = result
+        print(f'Finished {result["name"]} ({result["status"]}) in {result["wall_time"]:.3f} seconds', flush=True)
+    summary = [finished[name] for name in order]
+    print_summary(summary)
+    return summary
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recreates the figures from Savran et al.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of figures created at the same time (default: 1)')
+    parser.add_argument('--result-format', choices=RESULT_FORMATS, default='json',
+                        help="format of the evaluation results; 'npy' stores test distributions in .npy files "
+                             "(default: json)")
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='recompute all evaluations instead of reusing results of earlier runs with the same inputs')
+    parser.add_argument('--render-only', action='store_true',
+                        help='draw Fig. 3 to Fig. 7 from the results and data stored by an earlier run instead of '
+                             'computing them')
+    parser.add_argument('--dpi', type=int, default=300, help='resolution of Fig. 3 to Fig. 7 (default: 300)')
+    parser.add_argument('--offline-basemaps', action='store_true',
+                        help='draw basemaps only from the tile cache without network access; seed the cache with '
+                             'python tile_cache.py seed')
+    parser.add_argument('--trace', default=None,
+                        help='write wall time, CPU time and peak memory of each stage to this JSON or CSV file')
+    parser.add_argument('--profile-dir', default=None,
+                        help='profile each figure with cProfile and write the statistics to this directory')
+    args = parser.parse_args()
     ver = verify_file_manifest()
     t0 = time.time()
-    main(ver)
+    if args.jobs > 1:
+        summary = main_parallel(ver, args.jobs, result_format=args.result_format, profile_dir=args.profile_dir,
+                                use_result_cache=not args.no_result_cache, render_only=args.render_only,
+                                dpi=args.dpi, offline_basemaps=args.offline_basemaps)
+        records = [record for result in summary for record in result['trace']]
+    else:
+        configure(profile_dir=args.profile_dir)
+        configure_basemaps(offline=args.offline_basemaps)
+        main(ver, result_format=args.result_format, use_result_cache=not args.no_result_cache,
+             render_only=args.render_only, dpi=args.dpi)
+        records = get_records()
     t1 = time.time()
     print(f'Computed results in {t1 - t0:.3f} seconds.')
+    if args.trace is not None:
+        write_trace(args.trace, records)
+        print(f'Wrote timing of {len(records)} stages to {args.trace}')
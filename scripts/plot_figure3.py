@@ -3,12 +3,11 @@ import os
 import json
 
 # 3rd party impoorts
-import numpy as np
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 
 # pycsep imports
-from csep import load_catalog_forecast, load_json
+from csep import load_json
 from csep.models import Event
 from csep.core.regions import (
     Polygon,
@@ -22,8 +21,30 @@ from csep.utils.plots import plot_catalog, add_labels_for_publication
 from csep.utils.scaling_relationships import WellsAndCoppersmith
 from csep.utils.time_utils import epoch_time_to_utc_datetime
 
+# local imports
+from catalog_pipeline import (
+    CatalogForecastPipeline,
+    EventCountAccumulator,
+    ExpectedRateAccumulator
+)
+from figure_data import FigureData, render_arguments
+from tile_cache import cached_basemaps
+from timing import stage
+
+# percentiles of the event counts of the catalogs plotted in the figure
+PERCENTILES = [5, 50, 95, 99.9]
+
+
+def compute(num_workers=None):
+    """ Computes the expected rates of the UCERF3-ETAS forecast and selects the catalogs plotted in the figure
+
+    Args:
+        num_workers (int): number of processes used to read the UCERF3-ETAS catalogs; uses all cores if None
 
-def main():
+    Returns:
+        expected_rates (:class:`csep.core.forecasts.GriddedForecast`): expected rates of the forecast
+        catalogs (list): :class:`csep.core.catalogs.UCERF3Catalog` with the event count closest to each percentile
+    """
 
     # file-path for results
     simulation_dir = '../forecasts'
@@ -36,9 +57,6 @@ def main():
     max_mw = 8.95
     dmw = 0.2
 
-    # percentiles to plot in figure
-    perc = [5, 50, 95, 99.9]
-
     # define start and end epoch of the forecast
     with open(ucerf3_config, 'r') as config_file:
         config = json.load(config_file)
@@ -59,31 +77,32 @@ def main():
     mw_bins = magnitude_bins(min_mw, max_mw, dmw)
     smr = create_space_magnitude_region(aftershock_region, mw_bins)
 
-    # create forecast object
-    u3etas_forecast = load_catalog_forecast(
+    # create forecast object by streaming the forecast file once
+    pipeline = CatalogForecastPipeline(
         ucerf3_raw_data,
         start_time = epoch_time_to_utc_datetime(start_epoch),
         end_time = epoch_time_to_utc_datetime(end_epoch),
         filters = [f'magnitude >= {min_mw}', f'origin_time >= {start_epoch}', f'origin_time < {end_epoch}'],
         region=smr,
         event=event,
-        type='ucerf3',
-        filter_spatial=True,
-        apply_filters=True
+        filter_spatial=True
     )
-
-    # plot forecast; will add catalog to plot, calling first because u3etas is a generator and not subscriptable
-    _ = u3etas_forecast.get_expected_rates(verbose=True)
-
-    # determine catalogs with percentile counts
-    ecs = u3etas_forecast.get_event_counts()
-    catalogs = []
-    for p in perc:
-        ec = np.percentile(ecs, p)
-        idx = int(np.argwhere(ecs == ec)[0])
-        catalogs.append(u3etas_forecast.catalogs[idx])
-
-    # plotting goes here
+    pipeline.register(EventCountAccumulator())
+    pipeline.register(ExpectedRateAccumulator())
+    with stage('load_forecast'):
+        pipeline.run(verbose=True, num_workers=num_workers)
+        u3etas_forecast = pipeline.get_catalog_forecast()
+
+    # determine catalogs with percentile counts, only the selected catalogs are read again
+    with stage('load_catalog'):
+        catalogs = pipeline.select_percentile_catalogs(PERCENTILES)
+        pipeline.close()
+    return u3etas_forecast.expected_rates, catalogs
+
+
+@cached_basemaps()
+def render(expected_rates, catalogs, dpi=300):
+    """ Draws the expected rates along with each catalog """
     fig = plt.figure(figsize=(18,10))
     axs = []
     for i in range(len(catalogs)):
@@ -106,14 +125,41 @@ def main():
         'legend_titlesize': 14
     }
 
-    for i, (ax, cat) in enumerate(zip(axs, catalogs)):
-        if i == 3:
-            args_dict.pop('clabel', None)
-        h = u3etas_forecast.expected_rates.plot(plot_args=args_dict, ax=ax)
-        h = plot_catalog(cat, plot_args=args_dict, ax=h)
-    add_labels_for_publication(fig)
-    ax.get_figure().savefig('../figures/figure3.png', dpi=300)
+    with stage('plot'):
+        for i, (ax, cat) in enumerate(zip(axs, catalogs)):
+            if i == 3:
+                args_dict.pop('clabel', None)
+            h = expected_rates.plot(plot_args=args_dict, ax=ax)
+            h = plot_catalog(cat, plot_args=args_dict, ax=h)
+        add_labels_for_publication(fig)
+    with stage('savefig'):
+        ax.get_figure().savefig('../figures/figure3.png', dpi=dpi)
+
+
+def main(num_workers=None, render_only=False, dpi=300):
+    """ Creates the figure
+
+    Args:
+        num_workers (int): number of processes used to read the UCERF3-ETAS catalogs; uses all cores if None
+        render_only (bool): draw the figure from the expected rates and catalogs stored by an earlier run instead of
+                            processing the UCERF3-ETAS catalogs
+        dpi (int): resolution of the figure
+    """
+    figure_data = FigureData('figure3')
+    if render_only:
+        with stage('load_figure_data'):
+            expected_rates = figure_data.load_forecast('expected_rates')
+            catalogs = [figure_data.load_catalog(f'percentile_{p}') for p in PERCENTILES]
+    else:
+        expected_rates, catalogs = compute(num_workers=num_workers)
+        with stage('write_figure_data'):
+            figure_data.save_forecast('expected_rates', expected_rates)
+            for p, cat in zip(PERCENTILES, catalogs):
+                figure_data.save_catalog(f'percentile_{p}', cat)
+
+    render(expected_rates, catalogs, dpi=dpi)
 
 
 if __name__ == "__main__":
-    main()
+    args = render_arguments('Creates Fig. 3.').parse_args()
+    main(render_only=args.render_only, dpi=args.dpi)
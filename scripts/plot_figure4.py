@@ -1,63 +1,115 @@
 # Python imports
 import time
-import json
 
 # 3rd party impoorts
 import numpy as np
 import matplotlib.pyplot as plt
 
 # pycsep imports
-from csep import load_gridded_forecast, load_catalog
+from csep import load_catalog
 from csep import poisson_evaluations as poisson
 from csep.utils.plots import plot_poisson_consistency_test, add_labels_for_publication
 from csep.core.repositories import FileSystem
 
 # local imports
+from batched_evaluations import SpatialTestBatch
+from catalog_bins import binned_catalog
 from experiment_utilities import california_experiment, italy_experiment
+from figure_data import render_arguments
+from forecast_registry import get_gridded_forecast
+from result_cache import EvaluationResultCache
+from results_io import load_result, result_filename, write_result
+from timing import stage
 
 
-def main():
+def evaluate(num_workers=None, use_result_cache=True):
+    """ Computes the N-tests of the California forecasts and the S-tests of the Italian forecasts
+
+    Returns:
+        california_results (list): :class:`csep.models.EvaluationResult` of each California forecast
+        italy_results (list): :class:`csep.models.EvaluationResult` of each Italian forecast
+    """
+    cache = EvaluationResultCache(enabled=use_result_cache)
 
     # evaluate california_experiment
     california_results = []
-    cat = load_catalog(
-        california_experiment.evaluation_catalog,
-        loader=california_experiment.catalog_loader,
-    )
+    with stage('load_catalog:california'):
+        # the catalog is binned once for the grid shared by the forecasts, see catalog_bins.py
+        cat = binned_catalog(load_catalog(
+            california_experiment.evaluation_catalog,
+            loader=california_experiment.catalog_loader,
+        ))
     print(cat)
 
     for name, path in california_experiment.forecasts.items():
 
         print(f'Loading {name} forecast for California...')
-        fore = load_gridded_forecast(path)
-        fore.start_time = california_experiment.start_time
-        fore.end_time = california_experiment.end_time
-        fore.name = name.upper()
+        with stage(f'load_forecast:{name}'):
+            fore = get_gridded_forecast(path)
+            fore.start_time = california_experiment.start_time
+            fore.end_time = california_experiment.end_time
+            fore.name = name.upper()
         cat.region = fore.region
         print(f'Computing N-test results...')
-        california_results.append(poisson.number_test(fore, cat))
+        with stage(f'number_test:{name}'):
+            california_results.append(cache.evaluate(lambda: poisson.number_test(fore, cat), 'number_test', fore, cat))
 
-    # evaluate italy_experiment
-    italy_results = []
+    # evaluate italy_experiment; forecasts share the simulated catalogs of the S-test
     seed = italy_experiment.seed
-    cat = load_catalog(
-        italy_experiment.evaluation_catalog,
-        loader=italy_experiment.catalog_loader,
-    )
+    italy_batch = SpatialTestBatch(num_simulations=italy_experiment.num_simulations, seed=seed)
+    italy_results = []
+    italy_keys = []
+    with stage('load_catalog:italy'):
+        # the catalog is binned once for the grid shared by the forecasts, see catalog_bins.py
+        cat = binned_catalog(load_catalog(
+            italy_experiment.evaluation_catalog,
+            loader=italy_experiment.catalog_loader,
+        ))
     for name, path in italy_experiment.forecasts.items():
 
         print(f'Loading {name} forecast for italy...')
-        fore = load_gridded_forecast(path, swap_latlon=True)
-        fore.start_time = italy_experiment.start_time
-        fore.end_time = italy_experiment.end_time
-        fore.name = name.upper()
+        with stage(f'load_forecast:{name}'):
+            fore = get_gridded_forecast(path, swap_latlon=True)
+            fore.start_time = italy_experiment.start_time
+            fore.end_time = italy_experiment.end_time
+            fore.name = name.upper()
         cat.region = fore.region
-        cat.filter(f'magnitude >= {fore.min_magnitude}')
-
-        print(f'Computing S-test results...')
-        italy_results.append(poisson.spatial_test(fore, cat, seed=seed, num_simulations=100000))
-
-    # plotting code below
+        with stage('filter_catalog'):
+            cat.filter(f'magnitude >= {fore.min_magnitude}')
+        # only forecasts without a cached result are simulated
+        key = cache.key('spatial_test', fore, cat, seed=seed, num_simulations=italy_batch.num_simulations,
+                        seed_stream=italy_batch.seed_stream)
+        italy_keys.append(key)
+        italy_results.append(cache.get(key))
+        if italy_results[-1] is None:
+            italy_batch.add(fore, cat)
+
+    print(f'Computing S-test results...')
+    with stage('spatial_test'):
+        if italy_batch.tests:
+            computed = iter(italy_batch.run(num_workers=num_workers))
+            for i, key in enumerate(italy_keys):
+                if italy_results[i] is None:
+                    italy_results[i] = next(computed)
+                    cache.put(key, italy_results[i])
+    return california_results, italy_results
+
+
+def load_results(results_dir='../results'):
+    """ Loads the results written by an earlier run of the figure """
+    california_results = [
+        load_result(result_filename(results_dir, california_experiment.result_prefix, name, 'Poisson N-Test'))
+        for name in california_experiment.forecasts
+    ]
+    italy_results = [
+        load_result(result_filename(results_dir, italy_experiment.result_prefix, name, 'Poisson S-Test'))
+        for name in italy_experiment.forecasts
+    ]
+    return california_results, italy_results
+
+
+def render(california_results, italy_results, dpi=300):
+    """ Draws the figure from the evaluation results """
     fig, (ax1, ax2) = plt.subplots(1,2, figsize=(12,5))
     args = {'title_fontsize': 18,
             'xticks_fontsize': 12,
@@ -68,31 +120,53 @@ def main():
             'capsize': 3,
             'hbars':True,
             'tight_layout': True}
-    args['xlabel'] = 'Event count'
-    ax1 = plot_poisson_consistency_test(california_results, plot_args=args, axes=ax1)
+    with stage('plot'):
+        args['xlabel'] = 'Event count'
+        ax1 = plot_poisson_consistency_test(california_results, plot_args=args, axes=ax1)
 
-    args['xlabel'] = 'Log-likelihood'
-    args['percentile'] = 99
-    ax2 = plot_poisson_consistency_test(italy_results, plot_args=args, one_sided_lower=True, axes=ax2)
+        args['xlabel'] = 'Log-likelihood'
+        args['percentile'] = 99
+        ax2 = plot_poisson_consistency_test(italy_results, plot_args=args, one_sided_lower=True, axes=ax2)
 
-    add_labels_for_publication(fig)
+        add_labels_for_publication(fig)
 
     print('Printing quantile scores')
     for res in italy_results:
         print(f'{res.sim_name}: {res.quantile}')
-    fig.savefig('../figures/figure4.png', dpi=300)
-
-    print('Saving evaluation results')
-    for res in california_results:
-        fname = f'../results/cali_{res.sim_name}_{res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True, default=str)
-            
-    for res in italy_results:
-        fname = f'../results/italy_{res.sim_name}_{res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True, default=str)
+    with stage('savefig'):
+        fig.savefig('../figures/figure4.png', dpi=dpi)
+
+
+def main(num_workers=None, result_format='json', use_result_cache=True, render_only=False, dpi=300):
+    """ Creates the figure
+
+    Args:
+        num_workers (int): number of processes used to simulate catalogs for the S-test; uses all cores if None
+        result_format (str): format of the evaluation results, 'json' or 'npy' (see results_io.py)
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+        render_only (bool): draw the figure from the results in ../results instead of computing them
+        dpi (int): resolution of the figure
+    """
+    if render_only:
+        with stage('load_results'):
+            california_results, italy_results = load_results()
+    else:
+        california_results, italy_results = evaluate(num_workers=num_workers, use_result_cache=use_result_cache)
+
+    render(california_results, italy_results, dpi=dpi)
+
+    if not render_only:
+        print('Saving evaluation results')
+        with stage('write_results'):
+            for res in california_results:
+                fname = result_filename('../results', california_experiment.result_prefix, res.sim_name, res.name)
+                write_result(res, fname, result_format=result_format)
+
+            for res in italy_results:
+                fname = result_filename('../results', italy_experiment.result_prefix, res.sim_name, res.name)
+                write_result(res, fname, result_format=result_format)
+
 
-            
 if __name__ == "__main__":
-    main()
+    args = render_arguments('Creates Fig. 4.').parse_args()
+    main(render_only=args.render_only, dpi=args.dpi)
@@ -1,17 +1,21 @@
 # Python imports
-import json
 import time
 
 # 3rd party impoorts
 import matplotlib.pyplot as plt
 
 # pycsep imports
-from csep import load_gridded_forecast, load_catalog
-from csep import poisson_evaluations as poisson
+from csep import load_catalog
 from csep.utils.plots import plot_comparison_test, add_labels_for_publication
 
 # local imports
+from comparison_tests import lazy_comparisons
 from experiment_utilities import california_experiment, italy_experiment
+from forecast_registry import get_gridded_forecast
+from result_cache import EvaluationResultCache
+from figure_data import render_arguments
+from results_io import load_result, result_filename, write_result
+from timing import stage
 
 
 def initalize_forecasts(config, **kwargs):
@@ -19,23 +23,32 @@ def initalize_forecasts(config, **kwargs):
     out = {}
     for name, path in config.forecasts.items():
         print(f'Loading {name} forecast...')
-        fore = load_gridded_forecast(path, **kwargs)
-        fore.start_time = config.start_time
-        fore.end_time = config.end_time
-        fore.name = name
+        with stage(f'load_forecast:{name}'):
+            fore = get_gridded_forecast(path, **kwargs)
+            fore.start_time = config.start_time
+            fore.end_time = config.end_time
+            fore.name = name
         out[name] = fore
     return out
 
 
-def main():
+def evaluate(use_result_cache=True):
+    """ Compares the forecasts of both experiments against their benchmarks
+
+    Returns:
+        dict: results of the paired T-tests and W-tests keyed by 'california_t', 'california_w', 'italy_t' and
+              'italy_w'
+    """
+    cache = EvaluationResultCache(enabled=use_result_cache)
 
     # evaluate california_experiment using helmstetter as benchmark
     california_t_results = []
     california_w_results = []
-    cat = load_catalog(
-        california_experiment.evaluation_catalog,
-        loader=california_experiment.catalog_loader,
-    )
+    with stage('load_catalog:california'):
+        cat = load_catalog(
+            california_experiment.evaluation_catalog,
+            loader=california_experiment.catalog_loader,
+        )
     print(cat)
 
     # load forecasts and store benchmark forecast
@@ -43,34 +56,70 @@ def main():
     benchmark = ca_fores.pop(california_experiment.t_test_benchmark)
 
     print(f'Computing t-test results...')
-    for _, fore in ca_fores.items():
+    for fore in ca_fores.values():
         fore.name = fore.name.upper()
-        california_t_results.append(poisson.paired_t_test(fore, benchmark, cat))
-        california_w_results.append(poisson.w_test(fore, benchmark, cat))
+    # the rates at the observed events are extracted once for all comparisons, and only if a result is not cached
+    get_comparisons = lazy_comparisons(list(ca_fores.values()) + [benchmark], cat)
+    for name, fore in ca_fores.items():
+        with stage(f'paired_t_test:{name}'):
+            california_t_results.append(cache.evaluate(
+                lambda: get_comparisons().paired_t_test(fore.name, benchmark.name), 'paired_t_test', [fore, benchmark],
+                cat))
+        with stage(f'w_test:{name}'):
+            california_w_results.append(cache.evaluate(
+                lambda: get_comparisons().w_test(fore.name, benchmark.name), 'w_test', [fore, benchmark], cat))
 
     # evaluate italy_experiment
     italy_t_results = []
     italy_w_results = []
-    cat = load_catalog(
-        italy_experiment.evaluation_catalog,
-        loader=italy_experiment.catalog_loader,
-    )
+    with stage('load_catalog:italy'):
+        cat = load_catalog(
+            italy_experiment.evaluation_catalog,
+            loader=italy_experiment.catalog_loader,
+        )
 
     # load forecasts and store benchmark forecast
     ita_fores = initalize_forecasts(italy_experiment, swap_latlon=True)
     benchmark = ita_fores.pop(italy_experiment.t_test_benchmark)
 
     # italian catalog needs to be filtered in magnitude for 5yr forecasts
-    cat.filter(f'magnitude >= {benchmark.min_magnitude}')
+    with stage('filter_catalog'):
+        cat.filter(f'magnitude >= {benchmark.min_magnitude}')
     print(cat)
 
     print(f'Computing t-test results...')
-    for _, fore in ita_fores.items():
+    for fore in ita_fores.values():
         fore.name = fore.name.upper()
-        italy_t_results.append(poisson.paired_t_test(fore, benchmark, cat))
-        italy_w_results.append(poisson.w_test(fore, benchmark, cat))
-
-    # plotting code below
+    # the rates at the observed events are extracted once for all comparisons, and only if a result is not cached
+    get_comparisons = lazy_comparisons(list(ita_fores.values()) + [benchmark], cat)
+    for name, fore in ita_fores.items():
+        with stage(f'paired_t_test:{name}'):
+            italy_t_results.append(cache.evaluate(
+                lambda: get_comparisons().paired_t_test(fore.name, benchmark.name), 'paired_t_test', [fore, benchmark],
+                cat))
+        with stage(f'w_test:{name}'):
+            italy_w_results.append(cache.evaluate(
+                lambda: get_comparisons().w_test(fore.name, benchmark.name), 'w_test', [fore, benchmark], cat))
+
+    return {'california_t': california_t_results, 'california_w': california_w_results,
+            'italy_t': italy_t_results, 'italy_w': italy_w_results}
+
+
+def load_results(results_dir='../results'):
+    """ Loads the results written by an earlier run of the figure """
+    results = {}
+    for key, config in (('california', california_experiment), ('italy', italy_experiment)):
+        benchmark = config.t_test_benchmark
+        for suffix, test_name in (('t', 'Paired T-Test'), ('w', 'W-Test')):
+            results[f'{key}_{suffix}'] = [
+                load_result(result_filename(results_dir, config.result_prefix, (name, benchmark), test_name))
+                for name in config.forecasts if name != benchmark
+            ]
+    return results
+
+
+def render(results, dpi=300):
+    """ Draws the figure from the evaluation results returned by evaluate() or load_results() """
     fig, (ax1, ax2) = plt.subplots(1,2, figsize=(12,5))
     args = {
         'figsize':(6,8),
@@ -85,33 +134,43 @@ def main():
         'xlim': [-0.5, 1.5],
         'xticklabels_rotation': 45
     }
-    ax1 = plot_comparison_test(california_t_results, california_w_results, plot_args=args, axes=ax1)
-
-    # args['ylabel'] = ''
-    ax2 = plot_comparison_test(italy_t_results, italy_w_results, plot_args=args, axes=ax2)
-    add_labels_for_publication(fig)
-    fig.tight_layout()
-    fig.savefig('../figures/figure5.png', dpi=300)
-
-    print("Saving evaluation results")
-    for t_res, w_res in zip(california_t_results, california_w_results):
-        fname = f'../results/cali_{t_res.sim_name[0]}_{t_res.sim_name[1]}_{t_res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(t_res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True)
-
-        fname = f'../results/cali_{w_res.sim_name[0]}_{w_res.sim_name[1]}_{w_res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(w_res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True)
-
-    for t_res, w_res in zip(italy_t_results, italy_w_results):
-        fname = f'../results/italy_{t_res.sim_name[0]}_{t_res.sim_name[1]}_{t_res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(t_res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True)
-
-        fname = f'../results/italy_{w_res.sim_name[0]}_{w_res.sim_name[1]}_{w_res.name}.json'.replace(' ','_').lower()
-        with open(fname, 'w') as wf:
-            json.dump(w_res.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True)
+    with stage('plot'):
+        ax1 = plot_comparison_test(results['california_t'], results['california_w'], plot_args=args, axes=ax1)
+
+        # args['ylabel'] = ''
+        ax2 = plot_comparison_test(results['italy_t'], results['italy_w'], plot_args=args, axes=ax2)
+        add_labels_for_publication(fig)
+        fig.tight_layout()
+    with stage('savefig'):
+        fig.savefig('../figures/figure5.png', dpi=dpi)
+
+
+def main(result_format='json', use_result_cache=True, render_only=False, dpi=300):
+    """ Creates the figure
+
+    Args:
+        result_format (str): format of the evaluation results, 'json' or 'npy' (see results_io.py)
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+        render_only (bool): draw the figure from the results in ../results instead of computing them
+        dpi (int): resolution of the figure
+    """
+    if render_only:
+        with stage('load_results'):
+            results = load_results()
+    else:
+        results = evaluate(use_result_cache=use_result_cache)
+
+    render(results, dpi=dpi)
+
+    if not render_only:
+        print("Saving evaluation results")
+        with stage('write_results'):
+            for key, config in (('california', california_experiment), ('italy', italy_experiment)):
+                for res in results[f'{key}_t'] + results[f'{key}_w']:
+                    fname = result_filename('../results', config.result_prefix, res.sim_name, res.name)
+                    write_result(res, fname, result_format=result_format)
 
 
 if __name__ == "__main__":
-    main()
+    args = render_arguments('Creates Fig. 5.').parse_args()
+    main(render_only=args.render_only, dpi=args.dpi)
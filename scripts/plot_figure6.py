@@ -9,7 +9,7 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 
 # pycsep imports
-from csep import load_catalog_forecast, load_json
+from csep import load_json
 from csep.models import Event, Polygon
 from csep.core.regions import (
     magnitude_bins,
@@ -18,18 +18,44 @@ from csep.core.regions import (
     masked_region
 )
 from csep.core.catalogs import CSEPCatalog
-from csep.core.catalog_evaluations import spatial_test, number_test
 from csep.utils.constants import SECONDS_PER_WEEK
 from csep.utils.plots import plot_number_test, plot_spatial_test, plot_catalog
 from csep.utils.scaling_relationships import WellsAndCoppersmith
 from csep.utils.time_utils import epoch_time_to_utc_datetime, datetime_to_utc_epoch
 
+# local imports
+from catalog_pipeline import (
+    CatalogForecastPipeline,
+    EventCountAccumulator,
+    ExpectedRateAccumulator,
+    SpatialLikelihoodAccumulator,
+    number_test,
+    spatial_test
+)
+from figure_data import FigureData, render_arguments
+from results_io import load_result, write_result
+from tile_cache import cached_basemaps
+from timing import stage
+
 
 def sort_by_longitude(coords):
     return coords[coords[:,0].argsort()]
 
 
-def main():
+def result_filename(test_name):
+    """ Returns filename of the evaluation result of the UCERF3-ETAS forecast """
+    return f'../results/u3etas_{test_name}.json'.replace(" ","_").lower()
+
+
+def evaluate(num_workers=None):
+    """ Evaluates the UCERF3-ETAS forecast
+
+    Returns:
+        n_test (:class:`csep.models.CatalogNumberTestResult`): result of the N-test
+        s_test (:class:`csep.models.CatalogSpatialTestResult`): result of the S-test
+        expected_rates (:class:`csep.core.forecasts.GriddedForecast`): expected rates of the forecast
+        catalog (:class:`csep.core.catalogs.CSEPCatalog`): evaluation catalog
+    """
 
     # file-path for results
     simulation_dir = f'../forecasts'
@@ -54,7 +80,8 @@ def main():
     num_radii = 3
 
     # load evaluation catalog
-    catalog = load_json(CSEPCatalog(), catalog_fname)
+    with stage('load_catalog'):
+        catalog = load_json(CSEPCatalog(), catalog_fname)
 
     # load event
     event = load_json(Event(), m71_event)
@@ -76,49 +103,67 @@ def main():
     ]
 
     print('After filtering observation catalog')
-    catalog = catalog.filter(filters).filter_spatial(region=smr)
-    catalog = catalog.apply_mct(event.magnitude, event_epoch)
+    with stage('filter_catalog'):
+        catalog = catalog.filter(filters).filter_spatial(region=smr)
+        catalog = catalog.apply_mct(event.magnitude, event_epoch)
     print(catalog)
 
-    u3etas_forecast = load_catalog_forecast(
+    # stream the forecast once and compute everything needed for the evaluations from that single pass
+    pipeline = CatalogForecastPipeline(
         ucerf3_raw_data,
         start_time = epoch_time_to_utc_datetime(start_epoch),
         end_time = epoch_time_to_utc_datetime(end_epoch),
         region=smr,
-        type='ucerf3',
         event=event,
         filters=filters,
         filter_spatial=True,
-        apply_mct=True,
-        apply_filters=True,
-        store=False
+        apply_mct=True
     )
+    pipeline.register(EventCountAccumulator())
+    pipeline.register(ExpectedRateAccumulator())
+    spatial_likelihoods = pipeline.register(SpatialLikelihoodAccumulator())
+
+    print('processing UCERF3-ETAS catalogs')
+    with stage('load_forecast'):
+        pipeline.run(verbose=True, num_workers=num_workers)
+        u3etas_forecast = pipeline.get_catalog_forecast()
 
     # evaluate forecasting model
     print('computing spatial test results')
-    s_test = spatial_test(u3etas_forecast, catalog)
+    with stage('spatial_test'):
+        s_test = spatial_test(u3etas_forecast, catalog, spatial_likelihoods)
 
     print('computing number test results')
-    n_test = number_test(u3etas_forecast, catalog)
-
-    # plot the results
-    ax = plot_number_test(
-        n_test,
-        show=False,
-        plot_args={
-            'title': '',
-            'xlabel_fontsize': 14,
-            'ylabel_fontsize': 14
-        })
-    ax.get_figure().savefig('../figures/figure6b.png', dpi=300)
-    ax = plot_spatial_test(s_test,
-        show=False,
-        plot_args={
-            'title': '',
-            'xlabel_fontsize': 14,
-            'ylabel_fontsize': 14
-        })
-    ax.get_figure().savefig('../figures/figure6c.png', dpi=300)
+    with stage('number_test'):
+        n_test = number_test(u3etas_forecast, catalog)
+
+    return n_test, s_test, u3etas_forecast.expected_rates, catalog
+
+
+@cached_basemaps()
+def render(n_test, s_test, expected_rates, catalog, dpi=300):
+    """ Draws the panels of the figure """
+    with stage('plot:number_test'):
+        ax = plot_number_test(
+            n_test,
+            show=False,
+            plot_args={
+                'title': '',
+                'xlabel_fontsize': 14,
+                'ylabel_fontsize': 14
+            })
+    with stage('savefig:figure6b'):
+        ax.get_figure().savefig('../figures/figure6b.png', dpi=dpi)
+    with stage('plot:spatial_test'):
+        ax = plot_spatial_test(s_test,
+            show=False,
+            plot_args={
+                'title': '',
+                'xlabel_fontsize': 14,
+                'ylabel_fontsize': 14
+            })
+    with stage('savefig:figure6c'):
+        ax.get_figure().savefig('../figures/figure6c.png', dpi=dpi)
 
     # plot forecast
     plot_args = {
@@ -137,17 +182,49 @@ def main():
         'legend_fontsize': 14,
         'mag_scale': 5
     }
-    ax = u3etas_forecast.plot(plot_args=plot_args)
-    ax = plot_catalog(catalog, plot_args=plot_args, ax=ax)
-    ax.get_figure().savefig('../figures/figure6a.png', dpi=300)
+    with stage('plot:forecast'):
+        # same defaults as CatalogForecast.plot()
+        forecast_args = {'grid_labels': True, 'grid': True, 'borders': True, 'feature_lw': 0.5,
+                         'basemap': 'ESRI_terrain'}
+        forecast_args.update(plot_args)
+        ax = expected_rates.plot(plot_args=forecast_args)
+        ax = plot_catalog(catalog, plot_args=plot_args, ax=ax)
+    with stage('savefig:figure6a'):
+        ax.get_figure().savefig('../figures/figure6a.png', dpi=dpi)
+
+
+def main(num_workers=None, result_format='json', render_only=False, dpi=300):
+    """ Creates the figure
+
+    Args:
+        num_workers (int): number of processes used to read the UCERF3-ETAS catalogs; uses all cores if None
+        result_format (str): format of the evaluation results, 'json' or 'npy' (see results_io.py)
+        render_only (bool): draw the figure from the results in ../results and the expected rates and catalog stored
+                            by an earlier run instead of processing the UCERF3-ETAS catalogs
+        dpi (int): resolution of the figure
+    """
+    figure_data = FigureData('figure6')
+    if render_only:
+        with stage('load_results'):
+            n_test = load_result(result_filename('Catalog N-Test'))
+            s_test = load_result(result_filename('S-Test'))
+            expected_rates = figure_data.load_forecast('expected_rates')
+            catalog = figure_data.load_catalog('catalog')
+    else:
+        n_test, s_test, expected_rates, catalog = evaluate(num_workers=num_workers)
+        with stage('write_figure_data'):
+            figure_data.save_forecast('expected_rates', expected_rates)
+            figure_data.save_catalog('catalog', catalog)
+
+    render(n_test, s_test, expected_rates, catalog, dpi=dpi)
 
     # saving evaluation results
-    with open(f'../results/u3etas_{s_test.name}.json'.replace(" ","_").lower(), 'w') as wf:
-        json.dump(s_test.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True, default=str)
-
-    with open(f'../results/u3etas_{n_test.name}.json'.replace(" ","_").lower(), 'w') as wf:
-        json.dump(n_test.to_dict(), wf, indent=4, separators=(',', ': '), sort_keys=True, default=str)
+    if not render_only:
+        with stage('write_results'):
+            write_result(s_test, result_filename(s_test.name), result_format=result_format)
+            write_result(n_test, result_filename(n_test.name), result_format=result_format)
 
 
 if __name__ == "__main__":
-    main()
+    args = render_arguments('Creates Fig. 6.').parse_args()
+    main(render_only=args.render_only, dpi=args.dpi)
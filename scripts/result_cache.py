@@ -0,0 +1,153 @@
+"""
+ Content-addressed cache of evaluation results.
+
+ The evaluations of the figures only depend on the forecasts, the observed catalog, the test and its parameters, e.g.,
+ the seed and the number of simulations. The cache stores each EvaluationResult under a key computed from the contents
+ of these inputs, so the results are reused when a figure is created again with unchanged inputs, e.g., while changing
+ the plotting code, and recomputed when a forecast or the catalog changes.
+
+ Cache layout (one directory per cache key in results/cache/evaluations):
+     result.json   metadata of the result in the 'npy' format of results_io.py
+     result.npy    test distribution, if numeric
+
+ The cache can be deleted at any time.
+
+ Typical usage:
+
+     cache = EvaluationResultCache()
+     n_test = cache.evaluate(lambda: poisson.number_test(fore, cat), 'number_test', fore, cat)
+"""
+# Python imports
+import hashlib
+import json
+import os
+import shutil
+
+# 3rd party imports
+import numpy as np
+
+# pycsep imports
+import csep
+
+# local imports
+from catalog_cache import region_fingerprint
+from results_io import load_result, write_result
+
+# bump this if the layout of the cache or the computation of the results changes
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = '../results/cache/evaluations'
+
+
+def forecast_fingerprint(forecast):
+    """ Computes fingerprint of a gridded forecast from its rates, region, magnitudes, name and forecast period """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(forecast.data, dtype=np.float64).tobytes())
+    h.update(region_fingerprint(forecast.region).encode())
+    h.update(np.ascontiguousarray(forecast.magnitudes, dtype=np.float64).tobytes())
+    h.update(f'{forecast.name}:{forecast.start_time}:{forecast.end_time}'.encode())
+    return h.hexdigest()
+
+
+def catalog_fingerprint(catalog):
+    """ Computes fingerprint of an observed catalog from its events, name and region """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(catalog.data).tobytes())
+    h.update(f'{catalog.name}'.encode())
+    if catalog.region is not None:
+        h.update(region_fingerprint(catalog.region).encode())
+    return h.hexdigest()
+
+
+class EvaluationResultCache:
+    """ Stores evaluation results keyed by the contents of their inputs
+
+    Args:
+        cache_dir (str): root directory of the cache
+        enabled (bool): if false, results are always computed and never stored
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, test, forecasts, catalog, seed=None, num_simulations=None, **params):
+        """ Computes the cache key of an evaluation
+
+        Args:
+            test (str): name of the test, e.g., 'spatial_test'
+            forecasts (list): evaluated forecast, or forecast and benchmark for comparison tests
+            catalog: observed catalog
+            seed (int): seed of tests that simulate catalogs
+            num_simulations (int): number of simulated catalogs
+            **params: other parameters that affect the result; must be serializable to JSON
+
+        Returns:
+            str: hex digest
+        """
+        if not isinstance(forecasts, (list, tuple)):
+            forecasts = [forecasts]
+        adict = {
+            'version': CACHE_VERSION,
+            'pycsep': csep.__version__,
+            'test': test,
+            'forecasts': [forecast_fingerprint(forecast) for forecast in forecasts],
+            'catalog': catalog_fingerprint(catalog),
+            'seed': seed,
+            'num_simulations': num_simulations,
+            'params': params
+        }
+        return hashlib.sha1(json.dumps(adict, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """ Returns cached result or None """
+        if not self.enabled:
+            return None
+        fname = os.path.join(self.cache_dir, key, 'result.json')
+        if not os.path.exists(fname):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return load_result(fname, mmap_mode=None)
+
+    def put(self, key, result):
+        """ Stores result under key
+
+        The files are written into a temporary directory that is moved into place once complete.
+        """
+        if not self.enabled:
+            return
+        key_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f'{key_dir}.tmp-{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            write_result(result, os.path.join(tmp_dir, 'result.json'), result_format='npy')
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp_dir, key_dir)
+        except OSError:
+            # another process stored the same result first
+            if not os.path.exists(key_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+
+    def evaluate(self, compute, test, forecasts, catalog, seed=None, num_simulations=None, **params):
+        """ Returns cached result of an evaluation or computes and stores it
+
+        Args:
+            compute (callable): computes the result if it is not cached
+            test, forecasts, catalog, seed, num_simulations, **params: inputs of the evaluation, see key()
+
+        Returns:
+            :class:`csep.models.EvaluationResult`
+        """
+        key = self.key(test, forecasts, catalog, seed=seed, num_simulations=num_simulations, **params)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
@@ -0,0 +1,127 @@
+"""
+ Reading and writing evaluation results.
+
+ The figures write each evaluation result as a JSON file with EvaluationResult.to_dict(). The test distributions of
+ the S-tests and the UCERF3-ETAS tests contain 100,000 values, which makes up almost all of the size of the results
+ and of the time needed to write and parse them.
+
+ Two formats are supported:
+
+     json   the format used by pyCSEP and in expected_output/results; the test distribution is stored in the JSON file
+     npy    the JSON file stores the metadata of the result, e.g., name, quantile, observed_statistic and status. The
+            test distribution is stored in a .npy file next to it, and the JSON file stores the name of the .npy
+            file in place of the distribution.
+
+ load_result reads both formats and memory-maps the .npy files, so the test distributions are only read from disk
+ when they are accessed. load_result_dict reads a result without importing pyCSEP.
+"""
+# Python imports
+import copy
+import json
+import os
+
+# 3rd party imports
+import numpy as np
+
+RESULT_FORMATS = ('json', 'npy')
+
+# result classes of csep.models that can be loaded, keyed by the 'type' stored by EvaluationResult.to_dict(). pyCSEP
+# is only imported once a result is loaded as object, because importing it takes seconds and reading results as
+# dictionaries, e.g., in check_results.py, does not need it.
+RESULT_TYPES = (
+    'EvaluationResult',
+    'CatalogNumberTestResult',
+    'CatalogSpatialTestResult',
+    'CatalogMagnitudeTestResult',
+    'CatalogPseudolikelihoodTestResult',
+    'CalibrationTestResult'
+)
+
+
+def _result_class(result_type):
+    """ Returns class of csep.models for the type of a result; defaults to EvaluationResult """
+    import csep.models
+    return getattr(csep.models, result_type if result_type in RESULT_TYPES else 'EvaluationResult')
+
+
+def sidecar_filename(fname):
+    """ Returns filename of the .npy file storing the test distribution of the result in fname """
+    return os.path.splitext(fname)[0] + '.npy'
+
+
+def result_filename(results_dir, prefix, sim_name, test_name):
+    """ Returns filename of an evaluation result, e.g., ../results/cali_ebel_poisson_n-test.json
+
+    Args:
+        results_dir (str): directory of the results
+        prefix (str): prefix of the experiment, e.g., 'cali'
+        sim_name (str or tuple): name of the forecast, or names of the forecast and the benchmark for comparison tests
+        test_name (str): name of the test, e.g., 'Poisson N-Test'
+    """
+    if isinstance(sim_name, (list, tuple)):
+        sim_name = f'{sim_name[0]}_{sim_name[1]}'
+    return os.path.join(results_dir, f'{prefix}_{sim_name}_{test_name}.json'.replace(' ', '_').lower())
+
+
+def write_result(result, fname, result_format='json'):
+    """ Writes evaluation result to fname
+
+    Args:
+        result (:class:`csep.models.EvaluationResult`): evaluation result
+        fname (str): path to the JSON file
+        result_format (str): 'json' or 'npy', see module docstring
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f'result_format must be one of {RESULT_FORMATS}, not {result_format!r}')
+    test_distribution = None
+    if result_format == 'npy':
+        test_distribution = np.asarray(result.test_distribution)
+        # non-numeric distributions, e.g., the distribution name and mean of the Poisson N-test, stay in the JSON file
+        if test_distribution.dtype.kind not in 'biuf':
+            test_distribution = None
+    if test_distribution is None:
+        adict = result.to_dict()
+    else:
+        npy_fname = sidecar_filename(fname)
+        np.save(npy_fname, test_distribution)
+        # avoid converting the test distribution into a list
+        metadata = copy.copy(result)
+        metadata.test_distribution = []
+        adict = metadata.to_dict()
+        adict['test_distribution'] = os.path.basename(npy_fname)
+    with open(fname, 'w') as wf:
+        json.dump(adict, wf, indent=4, separators=(',', ': '), sort_keys=True, default=str)
+
+
+def load_result_dict(fname, mmap_mode='r'):
+    """ Loads evaluation result written by write_result as dictionary
+
+    Args:
+        fname (str): path to the JSON file
+        mmap_mode (str): passed to numpy.load for test distributions stored in .npy files
+
+    Returns:
+        dict: same as EvaluationResult.to_dict(), but test_distribution is a numpy.ndarray for the 'npy' format
+    """
+    with open(fname, 'r') as json_file:
+        adict = json.load(json_file)
+    if isinstance(adict['test_distribution'], str):
+        npy_fname = os.path.join(os.path.dirname(fname), adict['test_distribution'])
+        adict['test_distribution'] = np.load(npy_fname, mmap_mode=mmap_mode)
+    return adict
+
+
+def load_result(fname, mmap_mode='r'):
+    """ Loads evaluation result written by write_result in either format
+
+    Same as csep.load_evaluation_result for results in the 'json' format.
+
+    Args:
+        fname (str): path to the JSON file
+        mmap_mode (str): passed to numpy.load for test distributions stored in .npy files
+
+    Returns:
+        :class:`csep.models.EvaluationResult`
+    """
+    adict = load_result_dict(fname, mmap_mode=mmap_mode)
+    return _result_class(adict.get('type')).from_dict(adict)
@@ -0,0 +1,310 @@
+"""
+ Evaluates gridded forecasts of experiments defined in configuration files.
+
+ Each experiment (see experiments/california.yml and experiments/italy.yml) lists the forecasts, the evaluation catalog
+ and its loader, the forecast period, the seed, the benchmark of the comparison tests and the tests. The experiments
+ are turned into a single task graph (see task_graph.py): forecasts and catalogs used by several experiments are loaded
+ once, evaluations with the same inputs are computed once, and the S-tests of all forecasts sharing a catalog and seed
+ are computed in one batch (see batched_evaluations.py). The comparison tests of an experiment extract the rates of
+ all forecasts at the observed events once (see comparison_tests.py). Independent tasks run in parallel.
+
+ The results are written to the results directory with the same names as the figures use, e.g.,
+ cali_ebel_poisson_n-test.json or italy_lombardi_meletti_w-test.json.
+
+ Usage:
+
+     python run_experiments.py [../experiments/california.yml ../experiments/italy.yml] [-j 4] [--result-format npy]
+"""
+# Python imports
+import argparse
+import copy
+import glob
+import os
+import time
+
+# pycsep imports
+from csep import load_catalog
+from csep import poisson_evaluations as poisson
+
+# local imports
+from batched_evaluations import SpatialTestBatch
+from catalog_bins import binned_catalog
+from comparison_tests import PairedComparisons, lazy_comparisons
+from experiment_utilities import EXPERIMENTS_DIR, COMPARISON_TESTS, load_experiment_config
+from forecast_registry import get_gridded_forecast
+from result_cache import EvaluationResultCache
+from results_io import RESULT_FORMATS, result_filename, write_result
+from task_graph import TaskGraph, TaskRef
+
+# evaluation functions of the tests of single forecasts in experiment configurations; spatial tests are batched
+TEST_FUNCTIONS = {
+    'number_test': poisson.number_test,
+    'magnitude_test': poisson.magnitude_test,
+    'likelihood_test': poisson.likelihood_test,
+    'conditional_likelihood_test': poisson.conditional_likelihood_test
+}
+
+# methods of PairedComparisons computing the comparison tests of a forecast against the benchmark
+COMPARISON_METHODS = {
+    'paired_t_test': PairedComparisons.paired_t_test,
+    'w_test': PairedComparisons.w_test
+}
+
+# tests that simulate catalogs and need a seed and the number of simulations
+SIMULATION_TESTS = ('magnitude_test', 'likelihood_test', 'conditional_likelihood_test')
+
+
+def load_evaluation_catalog(path, loader, min_magnitude=None):
+    """ Loads evaluation catalog and applies a fixed magnitude threshold
+
+    The catalog is binned once for each grid of the forecasts, see catalog_bins.py.
+    """
+    catalog = binned_catalog(load_catalog(path, loader=loader))
+    if min_magnitude is not None:
+        catalog.filter(f'magnitude >= {min_magnitude}')
+    return catalog
+
+
+def load_forecast(path, start_time, end_time, options):
+    """ Loads gridded forecast and sets the forecast period """
+    fore = get_gridded_forecast(path, **options)
+    fore.start_time = start_time
+    fore.end_time = end_time
+    return fore
+
+
+def _prepare(forecast, name, catalog=None, min_magnitude=None):
+    """ Returns copy of forecast with name and catalog with the region of the forecast """
+    forecast = copy.copy(forecast)
+    forecast.name = name
+    if catalog is None:
+        return forecast
+    if min_magnitude == 'forecast':
+        catalog = catalog.filter(f'magnitude >= {forecast.min_magnitude}', in_place=False)
+    catalog.region = forecast.region
+    return forecast, catalog
+
+
+def evaluate(test, forecast, name, catalog, min_magnitude=None, seed=None, num_simulations=1000,
+             use_result_cache=True):
+    """ Evaluates single forecast
+
+    Args:
+        test (str): name of the test in TEST_FUNCTIONS
+        forecast (:class:`csep.core.forecasts.GriddedForecast`): evaluated forecast
+        name (str): name of the forecast in the result
+        catalog (:class:`csep.core.catalogs.CSEPCatalog`): evaluation catalog
+        min_magnitude: 'forecast' filters the catalog to the minimum magnitude of the forecast
+        seed (int): seed of tests that simulate catalogs
+        num_simulations (int): number of simulated catalogs
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+
+    Returns:
+        :class:`csep.models.EvaluationResult`
+    """
+    cache = EvaluationResultCache(enabled=use_result_cache)
+    func = TEST_FUNCTIONS[test]
+    forecast, catalog = _prepare(forecast, name, catalog, min_magnitude)
+    if test in SIMULATION_TESTS:
+        return cache.evaluate(lambda: func(forecast, catalog, num_simulations=num_simulations, seed=seed),
+                              test, forecast, catalog, seed=seed, num_simulations=num_simulations)
+    return cache.evaluate(lambda: func(forecast, catalog), test, forecast, catalog)
+
+
+def comparison_tests(tests, forecasts, names, benchmark, benchmark_name, catalog, min_magnitude=None,
+                     use_result_cache=True):
+    """ Compares several forecasts against the benchmark
+
+    The rates of all forecasts at the observed events are extracted once (see comparison_tests.py), and only if a
+    result is not cached.
+
+    Args:
+        tests (list): names of the tests in COMPARISON_METHODS
+        forecasts (list): :class:`csep.core.forecasts.GriddedForecast` compared against the benchmark
+        names (list): names of the forecasts in the results
+        benchmark (:class:`csep.core.forecasts.GriddedForecast`): benchmark
+        benchmark_name (str): name of the benchmark in the results
+        catalog (:class:`csep.core.catalogs.CSEPCatalog`): evaluation catalog
+        min_magnitude: 'forecast' filters the catalog to the minimum magnitude of the benchmark
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+
+    Returns:
+        list: :class:`csep.models.EvaluationResult` for each test and forecast, ordered by test
+    """
+    cache = EvaluationResultCache(enabled=use_result_cache)
+    benchmark, catalog = _prepare(benchmark, benchmark_name, catalog, min_magnitude)
+    forecasts = [_prepare(forecast, name) for forecast, name in zip(forecasts, names)]
+    get_comparisons = lazy_comparisons(forecasts + [benchmark], catalog)
+    results = []
+    for test in tests:
+        method = COMPARISON_METHODS[test]
+        for forecast in forecasts:
+            results.append(cache.evaluate(lambda: method(get_comparisons(), forecast.name, benchmark.name),
+                                          test, [forecast, benchmark], catalog))
+    return results
+
+
+def spatial_tests(forecasts, names, catalog, min_magnitude=None, seed=None, num_simulations=1000,
+                  use_result_cache=True):
+    """ Computes the S-tests of several forecasts sharing the simulated catalogs
+
+    Only forecasts without a cached result are simulated.
+
+    Returns:
+        list: :class:`csep.models.EvaluationResult` for each forecast
+    """
+    cache = EvaluationResultCache(enabled=use_result_cache)
+    batch = SpatialTestBatch(num_simulations=num_simulations, seed=seed)
+    keys = []
+    results = []
+    for forecast, name in zip(forecasts, names):
+        forecast, forecast_catalog = _prepare(forecast, name, catalog, min_magnitude)
+        keys.append(cache.key('spatial_test', forecast, forecast_catalog, seed=seed, num_simulations=num_simulations,
+                              seed_stream=batch.seed_stream))
+        results.append(cache.get(keys[-1]))
+        if results[-1] is None:
+            batch.add(forecast, forecast_catalog)
+    if batch.tests:
+        computed = iter(batch.run())
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = next(computed)
+                cache.put(key, results[i])
+    return results
+
+
+def build_task_graph(configs, use_result_cache=True):
+    """ Creates task graph evaluating the experiments
+
+    Args:
+        configs (list): :class:`experiment_utilities.EvaluationConfig` of each experiment
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+
+    Returns:
+        graph (:class:`task_graph.TaskGraph`): tasks of all experiments
+        outputs (list): (result_prefix, task key, index) of each result; index is None unless the task computes a
+                        list of results
+    """
+    graph = TaskGraph()
+    outputs = []
+    spatial_groups = {}
+    for config in configs:
+        fixed_min_magnitude = None if config.min_magnitude == 'forecast' else config.min_magnitude
+        catalog = graph.add(
+            ('catalog', config.evaluation_catalog, config.catalog_loader, fixed_min_magnitude),
+            load_evaluation_catalog,
+            args=(config.evaluation_catalog, config.catalog_loader, fixed_min_magnitude),
+            label=f'load_catalog:{config.name}'
+        )
+        options = tuple(sorted(config.forecast_options.items()))
+        forecasts = {}
+        for name, path in config.forecasts.items():
+            forecasts[name] = graph.add(
+                ('forecast', path, options, config.start_time, config.end_time),
+                load_forecast,
+                args=(path, config.start_time, config.end_time, config.forecast_options),
+                label=f'load_forecast:{name}'
+            )
+        # the catalog is only filtered in the evaluations if its threshold depends on the forecast
+        min_magnitude = config.min_magnitude if config.min_magnitude == 'forecast' else None
+        tests = [test for test in config.tests if test in COMPARISON_TESTS]
+        if tests:
+            members = [(forecast.key, name.upper()) for name, forecast in forecasts.items()
+                       if name != config.t_test_benchmark]
+            benchmark = forecasts[config.t_test_benchmark]
+            result = graph.add(
+                ('comparison_tests', tuple(tests), tuple(members), benchmark.key, config.t_test_benchmark,
+                 catalog.key, min_magnitude),
+                comparison_tests,
+                args=(tests, [TaskRef(forecast_key) for forecast_key, _ in members], [name for _, name in members],
+                      benchmark, config.t_test_benchmark, catalog),
+                kwargs={'min_magnitude': min_magnitude, 'use_result_cache': use_result_cache},
+                label=f'comparison_tests:{config.name}'
+            )
+            for index in range(len(tests) * len(members)):
+                outputs.append((config.result_prefix, result.key, index))
+        for test in config.tests:
+            if test in COMPARISON_TESTS:
+                continue
+            if test == 'spatial_test':
+                group = spatial_groups.setdefault((catalog.key, min_magnitude, config.seed, config.num_simulations),
+                                                  {'catalog': catalog, 'members': {}})
+                for name, forecast in forecasts.items():
+                    member = group['members'].setdefault((forecast.key, name.upper()), [])
+                    member.append(config.result_prefix)
+                continue
+            for name, forecast in forecasts.items():
+                kwargs = {'min_magnitude': min_magnitude}
+                if test in SIMULATION_TESTS:
+                    kwargs['seed'] = config.seed
+                    kwargs['num_simulations'] = config.num_simulations
+                key = (test, forecast.key, name.upper(), catalog.key) + tuple(
+                    value.key if hasattr(value, 'key') else value for _, value in sorted(kwargs.items()))
+                kwargs['use_result_cache'] = use_result_cache
+                result = graph.add(key, evaluate, args=(test, forecast, name.upper(), catalog), kwargs=kwargs,
+                                   label=f'{test}:{config.name}:{name}')
+                outputs.append((config.result_prefix, result.key, None))
+    for (catalog_key, min_magnitude, seed, num_simulations), group in spatial_groups.items():
+        members = list(group['members'])
+        forecasts = [TaskRef(forecast_key) for forecast_key, _ in members]
+        names = [name for _, name in members]
+        result = graph.add(
+            ('spatial_test', catalog_key, min_magnitude, seed, num_simulations, tuple(members)),
+            spatial_tests,
+            args=(forecasts, names, group['catalog']),
+            kwargs={'min_magnitude': min_magnitude, 'seed': seed, 'num_simulations': num_simulations,
+                    'use_result_cache': use_result_cache},
+            label=f'spatial_test:{len(members)} forecasts'
+        )
+        for index, member in enumerate(members):
+            for prefix in group['members'][member]:
+                outputs.append((prefix, result.key, index))
+    return graph, outputs
+
+
+def run_experiments(config_files, results_dir='../results', num_workers=None, result_format='json', verbose=True,
+                    use_result_cache=True):
+    """ Evaluates the experiments and writes the results
+
+    Args:
+        config_files (list): paths to the experiment configurations
+        results_dir (str): directory for the evaluation results
+        num_workers (int): number of processes; uses all cores if None
+        result_format (str): format of the evaluation results, 'json' or 'npy' (see results_io.py)
+        verbose (bool): print progress
+        use_result_cache (bool): reuse results of earlier runs with the same inputs (see result_cache.py)
+
+    Returns:
+        list: filenames of the written results
+    """
+    configs = [load_experiment_config(fname) for fname in config_files]
+    graph, outputs = build_task_graph(configs, use_result_cache=use_result_cache)
+    if verbose:
+        print(f'Evaluating {len(configs)} experiments with {len(graph)} tasks')
+    results = graph.run(num_workers=num_workers, verbose=verbose)
+    os.makedirs(results_dir, exist_ok=True)
+    fnames = []
+    # experiments listed more than once produce the same outputs
+    for prefix, key, index in dict.fromkeys(outputs):
+        result = results[key] if index is None else results[key][index]
+        fname = result_filename(results_dir, prefix, result.sim_name, result.name)
+        write_result(result, fname, result_format=result_format)
+        fnames.append(fname)
+    return fnames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluates the experiments defined in configuration files.')
+    parser.add_argument('configs', nargs='*', help='experiment configurations (default: all in ../experiments)')
+    parser.add_argument('--results', default='../results', help='directory for the results (default: ../results)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--result-format', choices=RESULT_FORMATS, default='json',
+                        help='format of the evaluation results (default: json)')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='recompute all evaluations instead of reusing results of earlier runs with the same inputs')
+    args = parser.parse_args()
+    config_files = args.configs or sorted(glob.glob(os.path.join(EXPERIMENTS_DIR, '*.yml')))
+    t0 = time.time()
+    fnames = run_experiments(config_files, results_dir=args.results, num_workers=args.jobs,
+                             result_format=args.result_format, use_result_cache=not args.no_result_cache)
+    print(f'Wrote {len(fnames)} results in {time.time() - t0:.3f} seconds.')
@@ -0,0 +1,121 @@
+"""
+ Benchmark of the startup time of the scripts.
+
+ Every process pays the time needed to import its script, e.g., each figure created by plot_all.py --jobs, each worker
+ started by a batch job and each run of check_results.py. Importing pyCSEP takes seconds, because it imports
+ matplotlib, scipy and pandas, so scripts that only dispatch work or read results must not import it at startup.
+
+ Each module is imported in a new Python process with -X importtime, which reports the time spent importing each
+ module. The benchmark reports the import time of each module, the time until the process exits and the heaviest
+ import of the module, and fails if one of BUDGETED_MODULES takes longer than the time budget to import.
+
+ Usage:
+
+     python startup_benchmark.py [--repeat 5] [--budget 0.5] [modules ...]
+"""
+# Python imports
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# scripts that must start quickly, followed by scripts whose startup time is only reported
+BUDGETED_MODULES = ('plot_all', 'check_results', 'results_io')
+REPORTED_MODULES = ('run_experiments', 'plot_figure4')
+
+# time budget to import each of BUDGETED_MODULES in seconds
+DEFAULT_BUDGET = 0.5
+
+
+def parse_importtime(stderr):
+    """ Parses the output of python -X importtime
+
+    Returns:
+        list: (depth, module, self time, cumulative time) of each imported module in the order of the output; times
+              in seconds. Modules are listed after the modules they import.
+    """
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        # the name is preceded by one space and two spaces for each level of nesting
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        records.append((depth, name.strip(), int(self_time) / 1e6, int(cumulative_time) / 1e6))
+    return records
+
+
+def measure_import(module, cwd=None):
+    """ Imports module in a new Python process
+
+    Args:
+        module (str): name of the module
+        cwd (str): working directory of the process; defaults to the directory of this script
+
+    Returns:
+        dict: import time and wall time of the process in seconds, and name and cumulative import time of the
+              heaviest module imported directly by module
+    """
+    cwd = cwd or os.path.dirname(os.path.abspath(__file__))
+    t0 = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=cwd,
+                             capture_output=True, text=True)
+    wall_time = time.perf_counter() - t0
+    if process.returncode != 0:
+        raise RuntimeError(f'Unable to import {module}:\n{process.stderr}')
+    children = []
+    import_time = None
+    for depth, name, _, cumulative_time in parse_importtime(process.stderr):
+        if depth == 0:
+            if name == module:
+                import_time = cumulative_time
+                break
+            children = []
+        elif depth == 1:
+            children.append((cumulative_time, name))
+    heaviest_time, heaviest = max(children, default=(0.0, None))
+    return {'module': module, 'import_time': import_time, 'wall_time': wall_time, 'heaviest': heaviest,
+            'heaviest_time': heaviest_time}
+
+
+def run_benchmark(modules, repeat=5):
+    """ Measures the startup time of each module
+
+    The fastest of repeat runs is reported, because slower runs only add noise, e.g., from writing the .pyc files or
+    from other processes.
+
+    Returns:
+        list: fastest measurement of each module, see measure_import()
+    """
+    results = []
+    for module in modules:
+        runs = [measure_import(module) for _ in range(repeat)]
+        results.append(min(runs, key=lambda run: run['import_time']))
+    return results
+
+
+def print_summary(results, budget):
+    print(f'{"module":<20}{"import [s]":>12}{"process [s]":>13}{"budget [s]":>12}  heaviest import')
+    for result in results:
+        limit = f'{budget:.3f}' if result['module'] in BUDGETED_MODULES else '-'
+        heaviest = f'{result["heaviest"]} ({result["heaviest_time"]:.3f} s)' if result['heaviest'] else '-'
+        print(f'{result["module"]:<20}{result["import_time"]:>12.3f}{result["wall_time"]:>13.3f}{limit:>12}  '
+              f'{heaviest}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the time needed to import the scripts.')
+    parser.add_argument('modules', nargs='*', help='modules to import (default: all modules listed in this script)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of imports of each module (default: 5)')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help=f'time budget to import the scripts that must start quickly in seconds '
+                             f'(default: {DEFAULT_BUDGET})')
+    args = parser.parse_args()
+    results = run_benchmark(args.modules or BUDGETED_MODULES + REPORTED_MODULES, repeat=args.repeat)
+    print_summary(results, args.budget)
+    over_budget = [result['module'] for result in results
+                   if result['module'] in BUDGETED_MODULES and result['import_time'] > args.budget]
+    if over_budget:
+        print(f'Startup time over budget: {", ".join(over_budget)}')
+        sys.exit(1)
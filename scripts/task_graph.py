@@ -0,0 +1,142 @@
+"""
+ Minimal task graph with deduplication of tasks and parallel execution.
+
+ Tasks are identified by a key that describes their inputs, e.g., ('forecast', path, options). Adding a task with a key
+ that is already in the graph returns the existing task, so loads and evaluations shared by several experiments are
+ executed once. Arguments of a task can refer to the results of other tasks with the TaskRef returned by add():
+
+     graph = TaskGraph()
+     catalog = graph.add(('catalog', path), load_catalog, args=(path,))
+     forecast = graph.add(('forecast', fname), load_forecast, args=(fname,))
+     n_test = graph.add(('number_test', fname, path), number_test, args=(forecast, catalog))
+     results = graph.run(num_workers=4)
+     results[n_test.key]
+
+ Tasks can only refer to tasks that were added before, so the order in which tasks are added is a valid execution
+ order. With num_workers > 1, every task whose inputs are available is submitted to a process pool; the functions of
+ the tasks and their arguments must be picklable.
+"""
+# Python imports
+import multiprocessing
+import os
+import queue
+import time
+
+
+class TaskRef:
+    """ Placeholder for the result of a task in the arguments of another task """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return f'TaskRef({self.key!r})'
+
+
+class Task:
+
+    def __init__(self, key, func, args, kwargs, label):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.label = label
+        self.deps = [ref.key for ref in _iter_refs(list(args) + list(kwargs.values()))]
+
+
+def _iter_refs(values):
+    """ Yields TaskRefs in values and in lists or tuples contained in values """
+    for value in values:
+        if isinstance(value, TaskRef):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            yield from _iter_refs(value)
+
+
+def _resolve(value, results):
+    """ Replaces TaskRefs in value with the results of the tasks """
+    if isinstance(value, TaskRef):
+        return results[value.key]
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(item, results) for item in value)
+    return value
+
+
+def _run_task(func, args, kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - t0
+
+
+class TaskGraph:
+
+    def __init__(self):
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, key, func, args=(), kwargs=None, label=None):
+        """ Adds task to the graph unless a task with the same key exists
+
+        Args:
+            key (tuple): hashable description of the inputs of the task
+            func (callable): function computing the result of the task
+            args (tuple): positional arguments of func; may contain TaskRefs
+            kwargs (dict): keyword arguments of func; may contain TaskRefs
+            label (str): name printed in progress messages
+
+        Returns:
+            :class:`TaskRef`: reference to the result of the task
+        """
+        if key not in self.tasks:
+            task = Task(key, func, tuple(args), dict(kwargs or {}), label or str(key[0]))
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise KeyError(f'Task {task.label} depends on {dep!r}, which is not in the graph.')
+            self.tasks[key] = task
+        return TaskRef(key)
+
+    def _resolve_args(self, task, results):
+        return _resolve(task.args, results), {name: _resolve(value, results) for name, value in task.kwargs.items()}
+
+    def run(self, num_workers=1, verbose=False):
+        """ Executes all tasks
+
+        Args:
+            num_workers (int): number of processes; uses all cores if None
+            verbose (bool): print a line for each finished task
+
+        Returns:
+            dict: results of the tasks keyed by task key
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        results = {}
+        if num_workers <= 1 or len(self.tasks) <= 1:
+            for key, task in self.tasks.items():
+                args, kwargs = self._resolve_args(task, results)
+                results[key], wall_time = _run_task(task.func, args, kwargs)
+                if verbose:
+                    print(f'Finished {task.label} in {wall_time:.3f} seconds', flush=True)
+            return results
+        finished = queue.Queue()
+        waiting = list(self.tasks)
+        num_running = 0
+        with multiprocessing.Pool(min(num_workers, len(self.tasks))) as pool:
+            while waiting or num_running:
+                for key in [key for key in waiting if all(dep in results for dep in self.tasks[key].deps)]:
+                    waiting.remove(key)
+                    args, kwargs = self._resolve_args(self.tasks[key], results)
+                    pool.apply_async(_run_task, (self.tasks[key].func, args, kwargs),
+                                     callback=lambda value, key=key: finished.put((key, value, None)),
+                                     error_callback=lambda err, key=key: finished.put((key, None, err)))
+                    num_running += 1
+                key, value, err = finished.get()
+                num_running -= 1
+                if err is not None:
+                    raise err
+                results[key], wall_time = value
+                if verbose:
+                    print(f'Finished {self.tasks[key].label} in {wall_time:.3f} seconds', flush=True)
+        return results
@@ -0,0 +1,434 @@
+"""
+ Local cache of the basemap tiles of the maps in Fig. 2, Fig. 3, Fig. 6 and Fig. 7.
+
+ pyCSEP draws web map tiles below the forecasts and catalogs ('ESRI_terrain' in Fig. 2, Fig. 3 and Fig. 6 and
+ 'stamen_terrain-background' in Fig. 7), which are downloaded from the tile servers every time a figure is drawn. While
+ the figures are drawn within cached_basemaps(), the tiles are read from a cache on disk instead:
+
+     @cached_basemaps()
+     def render(forecast):
+         ax = forecast.plot(plot_args={'basemap': 'ESRI_terrain'})
+         ax.get_figure().savefig('../figures/figure.png')
+
+ Tiles missing from the cache are downloaded and stored, unless the cache is configured offline. Offline, no network
+ access is attempted and missing tiles are drawn as blank tiles, the same as pyCSEP does without network access, so
+ the figures can be drawn in containers without network access. The tiles of the maps of each figure are downloaded
+ ahead of time with
+
+     python tile_cache.py seed [figure2 figure3 figure6 figure7]
+
+ which also downloads the Natural Earth coastlines and borders drawn by pyCSEP into the data directory of cartopy.
+
+ Cache layout (one directory per basemap in results/cache/tiles):
+     <basemap>/<z>/<x>/<y>.<ext>   tile as returned by the tile server
+
+ The modification time of a tile is updated whenever it is read. If the size of the cache exceeds the configured limit,
+ the least recently used tiles are deleted.
+"""
+# Python imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import threading
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+# 3rd party imports
+import numpy as np
+import cartopy.crs as ccrs
+import cartopy.feature
+from cartopy.io import img_tiles
+from cartopy.io.shapereader import natural_earth
+from PIL import Image
+from shapely.geometry import box
+
+# pycsep imports
+import csep.utils.plots
+from csep import load_json
+from csep.core.regions import california_relm_region, masked_region, Polygon
+from csep.models import Event
+from csep.utils.scaling_relationships import WellsAndCoppersmith
+
+# local imports
+from experiment_utilities import california_experiment, italy_experiment
+from forecast_registry import get_gridded_forecast
+
+DEFAULT_CACHE_DIR = '../results/cache/tiles'
+
+# size limit of the cache in MiB
+DEFAULT_MAX_SIZE = 1024
+
+# basemaps and extents ([min(lon), max(lon), min(lat), max(lat)]) are padded by this fraction before seeding, because
+# the axes can show a slightly larger area than requested
+EXTENT_PADDING = 0.05
+
+_options = {'cache_dir': DEFAULT_CACHE_DIR, 'offline': False, 'max_size': DEFAULT_MAX_SIZE}
+
+# tile source of pyCSEP for each basemap name
+_get_basemap = csep.utils.plots._get_basemap
+
+
+def configure(cache_dir=None, offline=None, max_size=None):
+    """ Sets the options of cached_basemaps()
+
+    Args:
+        cache_dir (str): root directory of the cache
+        offline (bool): if true, tiles missing from the cache are not downloaded and drawn blank
+        max_size (float): size limit of the cache in MiB
+    """
+    if cache_dir is not None:
+        _options['cache_dir'] = cache_dir
+    if offline is not None:
+        _options['offline'] = offline
+    if max_size is not None:
+        _options['max_size'] = max_size
+
+
+def basemap_dirname(basemap):
+    """ Returns name of the cache directory of a basemap, which can also be the URL of a tile server """
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', basemap).strip('_')
+
+
+class TileCache:
+    """ Stores tiles on disk and deletes the least recently used tiles if the cache exceeds max_size
+
+    Args:
+        cache_dir (str): root directory of the cache
+        max_size (float): size limit of the cache in MiB
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def tile_filename(self, basemap, tile, extension):
+        x, y, z = tile
+        return os.path.join(self.cache_dir, basemap_dirname(basemap), str(z), str(x), f'{y}{extension}')
+
+    def find(self, basemap, tile):
+        """ Returns filename of a cached tile or None """
+        tile_dir = os.path.dirname(self.tile_filename(basemap, tile, ''))
+        prefix = f'{tile[1]}.'
+        try:
+            names = [name for name in os.listdir(tile_dir) if name.startswith(prefix) and '.tmp-' not in name]
+        except FileNotFoundError:
+            return None
+        return os.path.join(tile_dir, names[0]) if names else None
+
+    def get(self, basemap, tile):
+        """ Returns contents of a cached tile or None and marks the tile as used """
+        fname = self.find(basemap, tile)
+        if fname is None:
+            return None
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+            os.utime(fname)
+        except FileNotFoundError:
+            # deleted by another process
+            return None
+        return data
+
+    def put(self, basemap, tile, data, extension):
+        """ Stores tile and deletes the least recently used tiles if the cache is full """
+        fname = self.tile_filename(basemap, tile, extension)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = f'{fname}.tmp-{os.getpid()}-{threading.get_ident()}'
+        with open(tmp_fname, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_fname, fname)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+        if self.size() > self.max_size * 1024 ** 2:
+            self.evict(keep=fname)
+
+    def _tiles(self):
+        """ Returns (modification time, size, filename) of each cached tile """
+        tiles = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if '.tmp-' in name:
+                    continue
+                fname = os.path.join(root, name)
+                try:
+                    stat = os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, fname))
+        return tiles
+
+    def size(self):
+        """ Returns size of the cache in bytes """
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._tiles())
+            return self._size
+
+    def evict(self, keep=None):
+        """ Deletes the least recently used tiles until the cache is within max_size
+
+        Args:
+            keep (str): filename of a tile that is not deleted
+
+        Returns:
+            int: number of deleted tiles
+        """
+        with self._lock:
+            tiles = sorted(self._tiles())
+            size = sum(size for _, size, _ in tiles)
+            num_deleted = 0
+            for _, tile_size, fname in tiles:
+                if size <= self.max_size * 1024 ** 2:
+                    break
+                if fname == keep:
+                    continue
+                try:
+                    os.remove(fname)
+                except FileNotFoundError:
+                    pass
+                size -= tile_size
+                num_deleted += 1
+            self._size = size
+        return num_deleted
+
+    def info(self):
+        """ Returns number of tiles and size in bytes of each cached basemap """
+        out = {}
+        for _, size, fname in self._tiles():
+            basemap = os.path.relpath(fname, self.cache_dir).split(os.sep)[0]
+            num_tiles, total = out.get(basemap, (0, 0))
+            out[basemap] = (num_tiles + 1, total + size)
+        return out
+
+
+def download_tile(url, user_agent):
+    """ Returns contents of a tile downloaded from url """
+    with urlopen(Request(url, headers={'User-Agent': user_agent}), timeout=30) as response:
+        return response.read()
+
+
+class CachedTiles(img_tiles.GoogleWTS):
+    """ Tile source that reads the tiles of a pyCSEP basemap from a TileCache
+
+    Args:
+        basemap (str): name of the basemap as passed to pyCSEP, e.g., 'ESRI_terrain'
+        cache (:class:`TileCache`): cache of the tiles
+        offline (bool): if true, tiles missing from the cache are drawn blank instead of being downloaded
+    """
+
+    def __init__(self, basemap, cache, offline=False):
+        super().__init__()
+        self.basemap = basemap
+        self.source = _get_basemap(basemap)
+        self.cache = cache
+        self.offline = offline
+        self.missing = 0
+
+    def _image_url(self, tile):
+        return self.source._image_url(tile)
+
+    def fetch(self, tile):
+        """ Returns contents of a tile from the cache or downloads and stores it; returns None if unavailable """
+        data = self.cache.get(self.basemap, tile)
+        if data is not None or self.offline:
+            return data
+        url = self._image_url(tile)
+        try:
+            data = download_tile(url, self.user_agent)
+        except OSError as err:
+            print(f'Unable to download basemap tile {url}: {err}')
+            return None
+        extension = os.path.splitext(urlparse(url).path)[1] or '.img'
+        self.cache.put(self.basemap, tile, data, extension)
+        return data
+
+    def get_image(self, tile):
+        data = self.fetch(tile)
+        if data is None:
+            self.missing += 1
+            # same blank tile as cartopy draws if a tile cannot be downloaded
+            img = Image.fromarray(np.full((256, 256, 3), (250, 250, 250), dtype=np.uint8))
+        else:
+            img = Image.open(io.BytesIO(data))
+        img = img.convert(self.desired_tile_form or 'RGB')
+        return img, self.tileextent(tile), 'lower'
+
+
+@contextlib.contextmanager
+def cached_basemaps():
+    """ Draws the basemaps of pyCSEP plots created within the context from the tile cache
+
+    The tiles are fetched when the figure is drawn, e.g., by savefig(), which therefore needs to be called within the
+    context to report missing tiles.
+    """
+    cache = TileCache(_options['cache_dir'], max_size=_options['max_size'])
+    sources = []
+
+    def get_cached_basemap(basemap):
+        tiles = CachedTiles(basemap, cache, offline=_options['offline'])
+        sources.append(tiles)
+        return tiles
+
+    csep.utils.plots._get_basemap = get_cached_basemap
+    try:
+        yield
+    finally:
+        csep.utils.plots._get_basemap = _get_basemap
+    missing = sum(tiles.missing for tiles in sources)
+    if missing:
+        print(f'Drew {missing} basemap tiles blank, because they are not in {cache.cache_dir}. '
+              f'Run python tile_cache.py seed with network access to download them.')
+
+
+def tile_depth(extent):
+    """ Returns zoom level of the tiles pyCSEP draws for extent with tile_scaling='auto' """
+    return cartopy.feature.AdaptiveScaler(5, ((6, 50), (7, 15))).scale_from_extent(extent)
+
+
+def find_tiles(basemap, extent, depth=None, padding=EXTENT_PADDING):
+    """ Returns tiles of a basemap covering extent
+
+    Args:
+        basemap (str): name of the basemap as passed to pyCSEP
+        extent (list): [min(lon), max(lon), min(lat), max(lat)]
+        depth (int): zoom level; defaults to the zoom level pyCSEP uses for extent
+        padding (float): fraction of the extent added to each side
+
+    Returns:
+        list: (x, y, z) of each tile
+    """
+    if depth is None:
+        depth = tile_depth(extent)
+    dlon = (extent[1] - extent[0]) * padding
+    dlat = (extent[3] - extent[2]) * padding
+    lon_min, lon_max = max(extent[0] - dlon, -180.0), min(extent[1] + dlon, 180.0)
+    lat_min, lat_max = max(extent[2] - dlat, -85.0), min(extent[3] + dlat, 85.0)
+    source = _get_basemap(basemap)
+    x0, y0 = source.crs.transform_point(lon_min, lat_min, ccrs.PlateCarree())
+    x1, y1 = source.crs.transform_point(lon_max, lat_max, ccrs.PlateCarree())
+    return list(source.find_images(box(x0, y0, x1, y1), depth))
+
+
+def _forecast_extent(region):
+    """ Extent of plot_spatial_dataset() for region """
+    bbox = region.get_bbox()
+    return [bbox[0], bbox[1], bbox[2] + region.dh, bbox[3] + region.dh]
+
+
+def _catalog_extent(region):
+    """ Extent of plot_catalog() for a catalog with region """
+    bbox = region.get_bbox()
+    dh = (bbox[1] - bbox[0]) / 20.
+    dv = (bbox[3] - bbox[2]) / 20.
+    return [bbox[0] - dh, bbox[1] + dh, bbox[2] - dv, bbox[3] + dv]
+
+
+def _aftershock_region(event_fname, use_midpoint=True, num_radii=3):
+    """ Aftershock region of the UCERF3-ETAS forecast in Fig. 3 and Fig. 6 """
+    if not os.path.exists(event_fname):
+        raise FileNotFoundError(f'{event_fname} not found; only included in the full version.')
+    event = load_json(Event(), event_fname)
+    rupture_length = WellsAndCoppersmith.mag_length_strike_slip(event.magnitude) * 1000
+    aftershock_polygon = Polygon.from_great_circle_radius((event.longitude, event.latitude),
+                                                          num_radii*rupture_length, num_points=100)
+    return masked_region(california_relm_region(dh_scale=4, use_midpoint=use_midpoint), aftershock_polygon)
+
+
+def figure_basemaps(figure):
+    """ Returns basemap and extent of each map drawn by a figure
+
+    Args:
+        figure (str): 'figure2', 'figure3', 'figure6' or 'figure7'
+
+    Returns:
+        list: (basemap, extent) of each map
+    """
+    if figure == 'figure2':
+        regions = [
+            get_gridded_forecast(california_experiment.forecasts['helmstetter']).region,
+            get_gridded_forecast(italy_experiment.forecasts['meletti'], swap_latlon=True).region
+        ]
+        return [(basemap, extent(region)) for region in regions for basemap, extent in (
+            ('ESRI_terrain', _forecast_extent), ('ESRI_terrain', _catalog_extent))]
+    if figure == 'figure3':
+        region = _aftershock_region('../forecasts/m71_event.json')
+        return [('ESRI_terrain', _forecast_extent(region)), ('ESRI_terrain', _catalog_extent(region))]
+    if figure == 'figure6':
+        region = _aftershock_region('../forecasts/m71_event.json', use_midpoint=False)
+        return [('ESRI_terrain', _forecast_extent(region))]
+    if figure == 'figure7':
+        # plot_figure7 draws its maps within cached_basemaps()
+        from plot_figure7 import EXTENT
+        return [('stamen_terrain-background', EXTENT)]
+    raise ValueError(f'{figure} does not draw basemaps.')
+
+
+def seed_natural_earth():
+    """ Downloads the Natural Earth coastlines and borders drawn by pyCSEP into the data directory of cartopy """
+    for resolution in ('110m', '50m', '10m'):
+        natural_earth(resolution=resolution, category='physical', name='coastline')
+        natural_earth(resolution=resolution, category='cultural', name='admin_0_boundary_lines_land')
+
+
+def seed(figures=('figure2', 'figure3', 'figure6', 'figure7'), cache_dir=DEFAULT_CACHE_DIR,
+         max_size=DEFAULT_MAX_SIZE, verbose=True):
+    """ Downloads the tiles of the maps of the figures into the cache
+
+    Args:
+        figures (list): names of the figures
+        cache_dir (str): root directory of the cache
+        max_size (float): size limit of the cache in MiB
+        verbose (bool): print progress
+
+    Returns:
+        dict: number of tiles and number of tiles that could not be downloaded
+    """
+    cache = TileCache(cache_dir, max_size=max_size)
+    num_tiles = 0
+    num_failed = 0
+    for figure in figures:
+        try:
+            basemaps = figure_basemaps(figure)
+        except FileNotFoundError as err:
+            print(f'Skipping {figure}: {err}')
+            continue
+        tiles = {(basemap, tile) for basemap, extent in basemaps for tile in find_tiles(basemap, extent)}
+        if verbose:
+            print(f'Seeding {len(tiles)} basemap tiles of {figure}', flush=True)
+        sources = {basemap: CachedTiles(basemap, cache) for basemap, _ in basemaps}
+        for basemap, tile in sorted(tiles):
+            num_tiles += 1
+            if sources[basemap].fetch(tile) is None:
+                num_failed += 1
+    seed_natural_earth()
+    return {'num_tiles': num_tiles, 'num_failed': num_failed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Downloads the basemap tiles of the figures into a local cache.')
+    parser.add_argument('command', choices=('seed', 'info', 'evict'),
+                        help="'seed' downloads the tiles of the figures, 'info' lists the cached basemaps and 'evict' "
+                             "deletes the least recently used tiles until the cache is within --max-size")
+    parser.add_argument('figures', nargs='*', default=['figure2', 'figure3', 'figure6', 'figure7'],
+                        help='figures to seed (default: all figures with maps)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'directory of the cache (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--max-size', type=float, default=DEFAULT_MAX_SIZE,
+                        help=f'size limit of the cache in MiB (default: {DEFAULT_MAX_SIZE})')
+    args = parser.parse_args()
+    tile_cache = TileCache(args.cache_dir, max_size=args.max_size)
+    if args.command == 'seed':
+        summary = seed(args.figures, cache_dir=args.cache_dir, max_size=args.max_size)
+        print(json.dumps(summary))
+        if summary['num_failed']:
+            raise SystemExit(1)
+    elif args.command == 'evict':
+        print(f'Deleted {tile_cache.evict()} tiles.')
+    for name, (count, total) in sorted(tile_cache.info().items()):
+        print(f'{name}: {count} tiles, {total / 1024 ** 2:.1f} MiB')
@@ -0,0 +1,195 @@
+"""
+ Timing of the stages of the figures.
+
+ The figures wrap their main steps, e.g., loading forecasts and catalogs, the evaluations, plotting and saving the
+ figure, in stages:
+
+     with stage('load_forecast:meletti') as record:
+         fore = get_gridded_forecast(path)
+     print(f'Loaded forecast in {record["wall_time"]:.3f} seconds')
+
+ Stages can be nested, and the name of a nested stage is prefixed with the names of the enclosing stages, e.g.,
+ figure4/spatial_test. For each stage, the wall time, the CPU time of the process, the CPU time of finished child
+ processes (e.g., worker pools) and the memory of the process are recorded. The records of a process are written as
+ JSON or CSV with write_trace().
+
+ Memory is reported in MiB:
+
+     peak_rss           peak resident memory of the process during the stage, including enclosed stages. Measured on
+                        linux by resetting the high-water mark of the process (/proc/self/clear_refs) when a stage
+                        starts and reading it (VmHWM) when the stage ends; None on other platforms.
+     rss_start          resident memory when the stage starts; None if not available
+     rss_end            resident memory when the stage ends; None if not available
+     process_peak_rss   peak resident memory of the process since it started, i.e., over this and all earlier stages
+
+ If a profile directory is configured, the stages at the configured depth are also profiled with cProfile, and the
+ statistics of each stage are dumped into a .prof file that can be inspected with pstats or snakeviz.
+"""
+# Python imports
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# columns of the trace
+TRACE_FIELDS = ('stage', 'depth', 'pid', 'start', 'wall_time', 'cpu_time', 'children_cpu_time', 'peak_rss',
+                'rss_start', 'rss_end', 'process_peak_rss')
+
+# records of finished stages and names of the running stages in this process
+_records = []
+_stack = []
+# peak memory of each running stage observed before the high-water mark was last reset, in KiB
+_peaks = []
+# peak memory of the process observed before the high-water mark was last reset, in KiB; resetting the high-water mark
+# also resets ru_maxrss
+_process_peak = {'kib': 0}
+_options = {'profile_dir': None, 'profile_depth': 0}
+
+
+def get_peak_rss():
+    """ Returns peak resident set size of the current process in MiB or None if not available """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB on linux
+    if sys.platform == 'darwin':
+        return max_rss / 1024 ** 2
+    return max(max_rss, _process_peak['kib']) / 1024
+
+
+def _read_status(field):
+    """ Returns field of /proc/self/status in KiB or None if not available """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """ Resets the high-water mark of the resident memory of the process; returns False if not supported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _to_mib(kib):
+    return kib / 1024 if kib is not None else None
+
+
+def configure(profile_dir=None, profile_depth=0):
+    """ Enables cProfile for stages
+
+    Args:
+        profile_dir (str): directory for the .prof files; profiling is disabled if None
+        profile_depth (int): nesting depth of the profiled stages; 0 profiles the outermost stages. Only one stage
+                             can be profiled at a time, so the enclosed stages are not profiled separately.
+    """
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    _options['profile_dir'] = profile_dir
+    _options['profile_depth'] = profile_depth
+
+
+def profile_filename(stage_name):
+    """ Returns filename of the cProfile dump of a stage """
+    return os.path.join(_options['profile_dir'], re.sub(r'[^\w.-]+', '_', stage_name.replace('/', '.')) + '.prof')
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Records wall time, CPU time and peak memory of the enclosed code
+
+    Yields:
+        dict: record of the stage; the times and the memory are set when the stage finishes
+    """
+    # the peak of the enclosing stage so far is kept before the high-water mark is reset for this stage
+    hwm = _read_status('VmHWM')
+    if hwm is not None:
+        _process_peak['kib'] = max(_process_peak['kib'], hwm)
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], hwm)
+    measure_peak = hwm is not None and _reset_peak_rss()
+    _stack.append(name)
+    _peaks.append(0)
+    record = {'stage': '/'.join(_stack), 'depth': len(_stack) - 1, 'pid': os.getpid(),
+              'rss_start': _to_mib(_read_status('VmRSS'))}
+    profiler = None
+    if _options['profile_dir'] is not None and record['depth'] == _options['profile_depth']:
+        profiler = cProfile.Profile()
+    t0 = time.time()
+    times0 = os.times()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        times1 = os.times()
+        record['start'] = t0
+        record['wall_time'] = time.time() - t0
+        record['cpu_time'] = (times1.user + times1.system) - (times0.user + times0.system)
+        record['children_cpu_time'] = ((times1.children_user + times1.children_system)
+                                       - (times0.children_user + times0.children_system))
+        peak = _peaks.pop()
+        hwm = _read_status('VmHWM')
+        if measure_peak and hwm is not None:
+            peak = max(peak, hwm)
+            # the peak of this stage is also a peak of the enclosing stage
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+            record['peak_rss'] = _to_mib(peak)
+        else:
+            record['peak_rss'] = None
+        record['rss_end'] = _to_mib(_read_status('VmRSS'))
+        record['process_peak_rss'] = get_peak_rss()
+        if profiler is not None:
+            profiler.dump_stats(profile_filename(record['stage']))
+        _records.append(record)
+        _stack.pop()
+
+
+def get_records():
+    """ Returns records of the finished stages of this process ordered by start time """
+    return sorted(_records, key=lambda record: record['start'])
+
+
+def reset():
+    """ Removes all records """
+    _records.clear()
+
+
+def write_trace(fname, records=None):
+    """ Writes records into a CSV file if fname ends with .csv and into a JSON file otherwise
+
+    Args:
+        fname (str): path to trace file
+        records (list): records to write; defaults to the records of this process
+    """
+    if records is None:
+        records = get_records()
+    if fname.endswith('.csv'):
+        with open(fname, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=TRACE_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(fname, 'w') as f:
+            json.dump(records, f, indent=4, separators=(',', ': '))
@@ -0,0 +1,363 @@
+"""
+ Low-level readers for the merged UCERF3-ETAS binary catalog format (results_complete.bin[.gz]).
+
+ The merged file contains a 4-byte header with the number of simulations followed by one record per simulated
+ catalog. Each record starts with a 2-byte file version and a version dependent header that stores the number of
+ events in the catalog. The layouts are taken from csep.core.catalogs.UCERF3Catalog so that the events returned
+ here are identical to those read by pyCSEP.
+
+ UCERF3ForecastFile records the offset of every catalog record while the file is read. For gzipped files, the
+ decompressor state is also saved every checkpoint_interval compressed bytes, so that a single catalog can be read
+ again later by restarting decompression at the nearest checkpoint instead of at the start of the file.
+
+ A regular gzip stream can only be decompressed from its start. BlockGzipWriter re-compresses the merged file as a
+ sequence of gzip members that each contain whole catalog records, along with an index of the members. The result is
+ still a valid gzip file that decompresses to the original merged file, but each member can be decompressed
+ independently, e.g., by a worker process.
+"""
+import bisect
+import gzip
+import io
+import os
+import zlib
+
+import numpy as np
+
+from csep.core.catalogs import UCERF3Catalog
+
+
+def open_ucerf3_file(filename):
+    """ Opens merged UCERF3-ETAS binary file, decompressing inline if the file is gzipped """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_exact(f, nbytes):
+    """ Reads exactly nbytes from file-like object f
+
+    Raises:
+        EOFError: if the file ends before nbytes are read
+    """
+    data = f.read(nbytes)
+    if len(data) != nbytes:
+        raise EOFError(f'Expected {nbytes} bytes but found {len(data)}. UCERF3-ETAS file might be truncated.')
+    return data
+
+
+def read_number_of_catalogs(f):
+    """ Parses the 4-byte header of the merged file """
+    return int(np.frombuffer(read_exact(f, 4), dtype='>i4')[0])
+
+
+def read_catalog_record(f, return_bytes=False):
+    """ Reads a single catalog record from the current position of f
+
+    Args:
+        f: file-like object
+        return_bytes (bool): if true, also returns the raw bytes of the record
+
+    Returns:
+        events (numpy.ndarray): structured array with the big-endian UCERF3-ETAS event layout
+        record (bytes): raw bytes of the record, only if return_bytes is true
+    """
+    version_bytes = read_exact(f, 2)
+    version = int(np.frombuffer(version_bytes, dtype='>i2')[0])
+    header_dtype = UCERF3Catalog._get_header_dtype(version)
+    header_bytes = read_exact(f, header_dtype.itemsize)
+    catalog_size = int(np.frombuffer(header_bytes, dtype=header_dtype)['catalog_size'][0])
+    catalog_dtype = UCERF3Catalog._get_catalog_dtype(version)
+    event_bytes = read_exact(f, catalog_dtype.itemsize * catalog_size)
+    events = np.frombuffer(event_bytes, dtype=catalog_dtype)
+    if return_bytes:
+        return events, version_bytes + header_bytes + event_bytes
+    return events
+
+
+class IndexedGzipReader:
+    """ Read-only file-like object for gzip files that supports seeking to any uncompressed offset
+
+    While reading, a copy of the decompressor is stored every checkpoint_interval compressed bytes. Seeking restarts
+    decompression from the closest checkpoint before the requested offset. Checkpoints are kept in memory and cost
+    roughly the size of the deflate window (32 KiB) each. Files with multiple gzip members are supported.
+
+    Args:
+        filename (str): path to gzip file
+        checkpoint_interval (int): number of compressed bytes between checkpoints
+        chunk_size (int): number of compressed bytes read from disk at a time
+    """
+
+    def __init__(self, filename, checkpoint_interval=64*1024*1024, chunk_size=1024*1024):
+        self.filename = filename
+        self.checkpoint_interval = checkpoint_interval
+        self.chunk_size = chunk_size
+        self._file = open(filename, 'rb')
+        # checkpoints are stored as (uncompressed_offset, compressed_offset, decompressor)
+        self.checkpoints = [(0, 0, zlib.decompressobj(zlib.MAX_WBITS | 16))]
+        self._restore(self.checkpoints[0])
+
+    def _restore(self, checkpoint):
+        uncompressed_offset, compressed_offset, decompressor = checkpoint
+        self._file.seek(compressed_offset)
+        self._compressed_offset = compressed_offset
+        self._decompressor = decompressor.copy()
+        self._buffer = b''
+        self._buffer_pos = 0
+        self._buffer_start = uncompressed_offset
+
+    def _decompress(self, data):
+        parts = []
+        while data:
+            if self._decompressor.eof:
+                # start of the next gzip member
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            parts.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data if self._decompressor.eof else b''
+        return b''.join(parts)
+
+    def _fill(self):
+        """ Replaces the buffer with the next decompressed chunk. Returns false at the end of the file. """
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._compressed_offset >= self.checkpoints[-1][1] + self.checkpoint_interval:
+            self.checkpoints.append((buffer_end, self._compressed_offset, self._decompressor.copy()))
+        data = self._file.read(self.chunk_size)
+        if not data:
+            return False
+        self._compressed_offset += len(data)
+        self._buffer = self._decompress(data)
+        self._buffer_pos = 0
+        self._buffer_start = buffer_end
+        return True
+
+    def tell(self):
+        return self._buffer_start + self._buffer_pos
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            available = len(self._buffer) - self._buffer_pos
+            if available == 0:
+                if not self._fill():
+                    break
+                continue
+            n = min(available, size)
+            parts.append(self._buffer[self._buffer_pos:self._buffer_pos + n])
+            self._buffer_pos += n
+            size -= n
+        return b''.join(parts)
+
+    def seek(self, offset):
+        """ Seeks to absolute uncompressed offset """
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not self._buffer_start <= offset <= buffer_end:
+            idx = bisect.bisect_right([c[0] for c in self.checkpoints], offset) - 1
+            checkpoint = self.checkpoints[idx]
+            # restart from checkpoint when going backwards or when the checkpoint skips decompressing data
+            if offset < self._buffer_start or checkpoint[0] > buffer_end:
+                self._restore(checkpoint)
+            while self._buffer_start + len(self._buffer) < offset:
+                if not self._fill():
+                    raise EOFError(f'Cannot seek to {offset}. Offset beyond end of file.')
+        self._buffer_pos = offset - self._buffer_start
+        return offset
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class UCERF3ForecastFile:
+    """ Merged UCERF3-ETAS binary file with random access to individual catalogs
+
+    The offset of each catalog record is stored the first time the record is reached, so that the catalog can be read
+    again later without parsing the catalogs before it. Memory use is one int per catalog plus the gzip checkpoints.
+
+    Args:
+        filename (str): path to results_complete.bin or results_complete.bin.gz
+        checkpoint_interval (int): number of compressed bytes between gzip checkpoints
+    """
+
+    def __init__(self, filename, checkpoint_interval=64*1024*1024):
+        self.filename = filename
+        if filename.endswith('.gz'):
+            self._file = IndexedGzipReader(filename, checkpoint_interval=checkpoint_interval)
+        else:
+            self._file = open(filename, 'rb')
+        self.num_catalogs = read_number_of_catalogs(self._file)
+        # offsets[i] is the offset of catalog i; only catalogs that have been reached are stored
+        self.offsets = [self._file.tell()]
+
+    def __len__(self):
+        return self.num_catalogs
+
+    def read_catalog(self, catalog_id, return_bytes=False):
+        """ Reads the raw events of a single catalog
+
+        Args:
+            catalog_id (int): index of catalog in file
+            return_bytes (bool): if true, also returns the raw bytes of the record
+
+        Returns:
+            events (numpy.ndarray): structured array with the big-endian UCERF3-ETAS event layout
+            record (bytes): raw bytes of the record, only if return_bytes is true
+        """
+        if not 0 <= catalog_id < self.num_catalogs:
+            raise IndexError(f'Catalog {catalog_id} not in file with {self.num_catalogs} catalogs.')
+        # catalogs before catalog_id have not been reached yet, so parse forward from the last known catalog
+        self._file.seek(self.offsets[min(catalog_id, len(self.offsets) - 1)])
+        while len(self.offsets) <= catalog_id:
+            read_catalog_record(self._file)
+            self.offsets.append(self._file.tell())
+        out = read_catalog_record(self._file, return_bytes=return_bytes)
+        if len(self.offsets) == catalog_id + 1:
+            self.offsets.append(self._file.tell())
+        return out
+
+    def iter_catalogs(self, return_bytes=False):
+        """ Yields catalog_id and raw events (and raw bytes if return_bytes is true) for each catalog in the file """
+        for catalog_id in range(self.num_catalogs):
+            if return_bytes:
+                yield (catalog_id, *self.read_catalog(catalog_id, return_bytes=True))
+            else:
+                yield catalog_id, self.read_catalog(catalog_id)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_ucerf3_catalogs(filename):
+    """ Streams raw catalogs from a merged UCERF3-ETAS binary file
+
+    Args:
+        filename (str): path to results_complete.bin or results_complete.bin.gz
+
+    Yields:
+        catalog_id (int), events (numpy.ndarray)
+    """
+    with UCERF3ForecastFile(filename) as forecast_file:
+        yield from forecast_file.iter_catalogs()
+
+
+def block_index_filename(filename):
+    """ Returns the filename of the member index belonging to a block-gzip file """
+    return filename + '.idx.npz'
+
+
+class BlockGzipWriter:
+    """ Writes a merged UCERF3-ETAS file as a sequence of independently decodable gzip members
+
+    Each member contains whole catalog records and is closed once it holds at least block_size uncompressed bytes. The
+    first member also contains the 4-byte header. The index stores the compressed offset and the first catalog of each
+    member. The files are written to temporary names and moved into place by commit(); the index is moved last.
+
+    Args:
+        filename (str): output filename
+        num_catalogs (int): number of catalogs in the merged file
+        block_size (int): minimum number of uncompressed bytes in each member
+        compresslevel (int): gzip compression level
+    """
+
+    def __init__(self, filename, num_catalogs, block_size=16*1024*1024, compresslevel=1):
+        self.filename = filename
+        self.num_catalogs = num_catalogs
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.compressed_offsets = [0]
+        self.first_catalog = [0]
+        self._num_written = 0
+        self._block = [np.array([num_catalogs], dtype='>i4').tobytes()]
+        self._block_bytes = 4
+        self._block_catalogs = 0
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._tmp_filename = f'{filename}.tmp-{os.getpid()}'
+        self._file = open(self._tmp_filename, 'wb')
+
+    def write_record(self, record):
+        """ Appends the raw bytes of the next catalog record """
+        self._block.append(record)
+        self._block_bytes += len(record)
+        self._block_catalogs += 1
+        if self._block_bytes >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        self._file.write(gzip.compress(b''.join(self._block), compresslevel=self.compresslevel, mtime=0))
+        self._num_written += self._block_catalogs
+        self.compressed_offsets.append(self._file.tell())
+        self.first_catalog.append(self._num_written)
+        self._block = []
+        self._block_bytes = 0
+        self._block_catalogs = 0
+
+    def commit(self):
+        """ Writes the last member and the index """
+        if self._block_bytes > 0:
+            self._flush()
+        self._file.close()
+        if self._num_written != self.num_catalogs:
+            os.remove(self._tmp_filename)
+            raise ValueError(f'Expected {self.num_catalogs} catalogs but found {self._num_written}.')
+        os.replace(self._tmp_filename, self.filename)
+        tmp_index = f'{self._tmp_filename}.idx.npz'
+        np.savez(tmp_index,
+                 num_catalogs=self.num_catalogs,
+                 compressed_offsets=np.array(self.compressed_offsets, dtype=np.int64),
+                 first_catalog=np.array(self.first_catalog, dtype=np.int64))
+        os.replace(tmp_index, block_index_filename(self.filename))
+
+    def abort(self):
+        """ Removes the partially written file """
+        self._file.close()
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+
+class BlockGzipIndex:
+    """ Index of the gzip members in a file written by :class:`BlockGzipWriter`
+
+    Args:
+        filename (str): path to block-gzip file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with np.load(block_index_filename(filename)) as index:
+            self.num_catalogs = int(index['num_catalogs'])
+            self.compressed_offsets = index['compressed_offsets']
+            self.first_catalog = index['first_catalog']
+
+    @property
+    def num_blocks(self):
+        return len(self.compressed_offsets) - 1
+
+    @staticmethod
+    def exists(filename):
+        return os.path.exists(filename) and os.path.exists(block_index_filename(filename))
+
+    def iter_catalogs(self, start_block=0, stop_block=None):
+        """ Yields catalog_id and raw events for each catalog stored in blocks [start_block, stop_block)
+
+        Each block is decompressed independently, so different block ranges can be read by different processes.
+        """
+        if stop_block is None:
+            stop_block = self.num_blocks
+        with open(self.filename, 'rb') as f:
+            for block in range(start_block, stop_block):
+                f.seek(self.compressed_offsets[block])
+                compressed = read_exact(f, int(self.compressed_offsets[block + 1] - self.compressed_offsets[block]))
+                buffer = io.BytesIO(zlib.decompress(compressed, zlib.MAX_WBITS | 16))
+                if block == 0:
+                    read_number_of_catalogs(buffer)
+                for catalog_id in range(self.first_catalog[block], self.first_catalog[block + 1]):
+                    yield int(catalog_id), read_catalog_record(buffer)